@@ -0,0 +1,129 @@
+"""
+Gmail accounts served by the worker, and their distribution across processes.
+
+Account 0 is the mailbox configured on the settings page (`gmail_credentials_path`);
+further mailboxes are rows in the `accounts` table. Per-account settings, and
+runtime state such as the history cursor (see state.py), use keys suffixed
+with `:<account id>`, with the default account keeping the unsuffixed keys.
+
+Each worker process heartbeats into `worker_heartbeats` and holds leases in
+`account_leases` for the accounts it runs. A process takes at most its fair
+share of accounts; when a process dies its heartbeat and leases expire, the
+share of the survivors grows and they pick the orphaned accounts up.
+
+Work that must run in one process at a time, such as WhatsApp delivery (the
+Twilio rate limit and per-recipient caps are only enforced within a process),
+is a role leased in `role_leases` the same way.
+"""
+
+import math
+import os
+import socket
+import time
+from dataclasses import dataclass
+import config
+import storage
+
+DEFAULT_ACCOUNT_ID = 0
+
+# A lease or heartbeat not renewed for this long belongs to a dead process
+LEASE_SECONDS = 60
+
+# How often a process renews its leases and looks for accounts to take over
+LEASE_RENEW_SECONDS = 15
+
+# Role of the process that sends queued WhatsApp messages and Gmail replies
+DELIVERY_ROLE = 'delivery'
+
+@dataclass(frozen=True)
+class Account:
+    """A Gmail mailbox the worker forwards from"""
+    id: int
+    name: str
+    credentials_path: str
+    email_address: str = None
+    
+    def key(self, name):
+        """Settings or runtime state key holding this account's value for `name`"""
+        return setting_key(name, self.id)
+
+def setting_key(name, account_id):
+    return name if account_id == DEFAULT_ACCOUNT_ID else f"{name}:{account_id}"
+
+def default_account(snapshot=None):
+    snapshot = snapshot or config.get_snapshot()
+    return Account(DEFAULT_ACCOUNT_ID, 'default', snapshot.get('gmail_credentials_path'),
+                   snapshot.get('gmail_email_address'))
+
+def get_accounts(snapshot=None):
+    """All enabled accounts, the default one first if it is configured"""
+    snapshot = snapshot or config.get_snapshot()
+    accounts = []
+    default = default_account(snapshot)
+    if default.credentials_path:
+        accounts.append(default)
+    for row in snapshot.accounts:
+        accounts.append(Account(row['id'], row['name'], row['credentials_path'], row['email_address']))
+    return accounts
+
+def get_account(account_id, snapshot=None):
+    """The account with this ID, or None if it no longer exists or is disabled"""
+    if account_id == DEFAULT_ACCOUNT_ID:
+        return default_account(snapshot)
+    return next((account for account in get_accounts(snapshot) if account.id == account_id), None)
+
+def owner_id():
+    """Identifies this process in heartbeats and leases"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def sync_leases(owner, account_ids):
+    """Heartbeat, renew this process's leases and take over free accounts up to its share
+    
+    Returns the set of account IDs this process should run. When the share
+    shrinks (another process joined), surplus leases are no longer renewed:
+    the caller stops those accounts and the leases expire for others to take.
+    """
+    now = time.time()
+    with storage.immediate_transaction() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO worker_heartbeats (owner, heartbeat_at) VALUES (?, ?)
+        ''', (owner, now))
+        conn.execute('DELETE FROM worker_heartbeats WHERE heartbeat_at < ?', (now - LEASE_SECONDS,))
+        workers = conn.execute('SELECT COUNT(*) FROM worker_heartbeats').fetchone()[0]
+        share = math.ceil(len(account_ids) / max(1, workers))
+        
+        leases = {row['account_id']: row for row in conn.execute('SELECT * FROM account_leases')}
+        owned = sorted(a for a in account_ids if a in leases and leases[a]['owner'] == owner)[:share]
+        free = [
+            a for a in account_ids
+            if a not in leases or leases[a]['expires_at'] < now
+        ]
+        owned += [a for a in free if a not in owned][:share - len(owned)]
+        
+        conn.executemany('''
+            INSERT OR REPLACE INTO account_leases (account_id, owner, expires_at) VALUES (?, ?, ?)
+        ''', [(account_id, owner, now + LEASE_SECONDS) for account_id in owned])
+        # Leases of removed or disabled accounts
+        conn.execute(f'''
+            DELETE FROM account_leases WHERE account_id NOT IN ({','.join('?' * len(account_ids))})
+        ''', account_ids)
+    return set(owned)
+
+def hold_role(owner, role):
+    """Take or renew the lease on `role` unless another live process holds it; returns whether `owner` holds it"""
+    now = time.time()
+    with storage.immediate_transaction() as conn:
+        conn.execute('''
+            INSERT INTO role_leases (role, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (role) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE role_leases.owner = excluded.owner OR role_leases.expires_at < ?
+        ''', (role, owner, now + LEASE_SECONDS, now))
+        row = conn.execute('SELECT owner FROM role_leases WHERE role = ?', (role,)).fetchone()
+    return row['owner'] == owner
+
+def release_leases(owner):
+    """Give up this process's leases and heartbeat, e.g. on a clean shutdown"""
+    with storage.transaction() as conn:
+        conn.execute('DELETE FROM account_leases WHERE owner = ?', (owner,))
+        conn.execute('DELETE FROM role_leases WHERE owner = ?', (owner,))
+        conn.execute('DELETE FROM worker_heartbeats WHERE owner = ?', (owner,))
@@ -1,21 +1,34 @@
 import os
-import sqlite3
 import json
+import logging
+import hmac
 import base64
+import mimetypes
 from datetime import datetime
 from functools import wraps
-from flask import Flask, request, render_template, redirect, url_for, flash, session, jsonify
+from flask import Flask, Response, request, render_template, redirect, url_for, flash, session, jsonify, g, send_file
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
-import google.auth.transport.requests
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.request_validator import RequestValidator
 import threading
 import time
+import accounts
+import config
+import conversations
+import delivery_status
+import gmail_auth
+import logs
+import media_cache
+import metrics
+import reply_outbox
+import scheduler
+import state
+import storage
+import wakeup
+
+logs.configure()
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
@@ -23,10 +36,12 @@ app.secret_key = 'your-secret-key-change-this-in-production'
 # Configuration
 UPLOAD_FOLDER = 'credentials'
 ALLOWED_EXTENSIONS = {'json'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Gmail API scopes
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+# /health reports degraded once the oldest account's last completed cycle is
+# older than this many poll_max_interval_seconds, and never sooner than the floor
+POLL_LAG_DEGRADED_INTERVALS = 3
+POLL_LAG_DEGRADED_MIN_SECONDS = 900
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 # Hardcoded credentials
 ADMIN_USERNAME = 'ErmalAlija'
@@ -35,98 +50,39 @@ ADMIN_PASSWORD = 'Prishtina1997!'
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db_connection():
-    conn = sqlite3.connect('config.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
 def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Create settings table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    ''')
-    
-    # Create filters table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS filters (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            keyword TEXT UNIQUE
-        )
-    ''')
-    
-    # Create conversation_map table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversation_map (
-            thread_id TEXT PRIMARY KEY,
-            whatsapp_user_number TEXT,
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    # Creates or upgrades the schema; shared with start.sh
+    storage.migrate()
+
+def warm_up():
+    """Open this process's database connections and load the configuration before the first request"""
+    storage.get_connection()
+    config.get_snapshot()
 
 def get_setting(key, default=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-    result = cursor.fetchone()
-    conn.close()
-    return result['value'] if result else default
+    # Served from the in-memory snapshot; no SQLite round-trip on the hot path
+    return config.get_setting(key, default)
 
 def set_setting(key, value):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-    conn.commit()
-    conn.close()
+    with storage.transaction() as conn:
+        conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+    config.invalidate()
 
 def get_filters():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT keyword FROM filters ORDER BY keyword')
-    filters = [row['keyword'] for row in cursor.fetchall()]
-    conn.close()
-    return filters
+    return config.get_filters()
 
 def set_filters(keywords):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM filters')
-    for keyword in keywords:
-        if keyword.strip():
-            cursor.execute('INSERT INTO filters (keyword) VALUES (?)', (keyword.strip(),))
-    conn.commit()
-    conn.close()
-
-def store_conversation_mapping(thread_id, whatsapp_number):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO conversation_map (thread_id, whatsapp_user_number, last_updated)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-    ''', (thread_id, whatsapp_number))
-    conn.commit()
-    conn.close()
+    with storage.transaction() as conn:
+        conn.execute('DELETE FROM filters')
+        for keyword in keywords:
+            if keyword.strip():
+                conn.execute('INSERT INTO filters (keyword) VALUES (?)', (keyword.strip(),))
+    config.invalidate()
 
 def get_thread_id_for_whatsapp(whatsapp_number):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT thread_id FROM conversation_map 
-        WHERE whatsapp_user_number = ? 
-        ORDER BY last_updated DESC 
-        LIMIT 1
-    ''', (whatsapp_number,))
-    result = cursor.fetchone()
-    conn.close()
-    return result['thread_id'] if result else None
+    """The (account_id, thread_id) last forwarded to this number, or None"""
+    # Served from the in-process routing cache
+    return conversations.lookup(whatsapp_number)
 
 def login_required(f):
     @wraps(f)
@@ -136,6 +92,19 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+    return response
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -158,7 +127,55 @@ def logout():
 @app.route('/health')
 def health():
     """Health check endpoint for Docker"""
-    return {'status': 'healthy', 'message': 'Gmail-to-WhatsApp Bridge is running'}, 200
+    # One key per account; report the soonest
+    snapshot = config.get_snapshot()
+    polls = [int(value) for value in state.values('worker_next_poll_at').values() if value]
+    next_poll_at = min(polls) if polls else None
+    
+    # Lag of the account whose last completed cycle is oldest; None until every account has one
+    last_cycles = [state.get(account.key('worker_last_cycle_at')) for account in accounts.get_accounts(snapshot)]
+    poll_lag = None
+    if last_cycles and all(last_cycles):
+        poll_lag = max(0, int(time.time()) - min(int(value) for value in last_cycles))
+    
+    max_interval = snapshot.get_float('poll_max_interval_seconds', scheduler.DEFAULT_MAX_INTERVAL)
+    degraded = poll_lag is not None and poll_lag > max(
+        POLL_LAG_DEGRADED_INTERVALS * max_interval, POLL_LAG_DEGRADED_MIN_SECONDS
+    )
+    return {
+        'status': 'degraded' if degraded else 'healthy',
+        'message': 'Gmail sync is lagging' if degraded else 'Gmail-to-WhatsApp Bridge is running',
+        'next_poll_at': datetime.utcfromtimestamp(next_poll_at).isoformat() + 'Z' if next_poll_at else None,
+        'poll_lag_seconds': poll_lag
+    }, 503 if degraded else 200
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of the web app and all worker processes"""
+    # Open unless metrics_token is set; scrapers then send it as a bearer token
+    expected_token = get_setting('metrics_token')
+    if expected_token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied, expected_token):
+            return 'Invalid token', 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/media/<digest>/<filename>')
+def media(digest, filename):
+    """Cached email attachments, downloaded by Twilio through signed links"""
+    path = media_cache.verify(digest, filename, request.args.get('expires', ''), request.args.get('sig', ''))
+    if path is None:
+        return 'Invalid or expired link', 403
+    if not os.path.exists(path):
+        return 'Not found', 404
+    # Served as a file so the server can use sendfile; conditional=True answers Range requests
+    return send_file(
+        os.path.abspath(path),
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        download_name=filename,
+        conditional=True,
+        max_age=3600
+    )
 
 @app.route('/')
 @login_required
@@ -178,6 +195,8 @@ def settings():
                     os.makedirs(UPLOAD_FOLDER)
                 filepath = os.path.join(UPLOAD_FOLDER, filename)
                 file.save(filepath)
+                # Tokens issued for the previous client secrets are no longer valid
+                gmail_auth.discard_credentials(filepath)
                 set_setting('gmail_credentials_path', filepath)
                 flash('Gmail credentials uploaded successfully')
         
@@ -213,9 +232,8 @@ def settings():
     
     return render_template('settings.html', settings=current_settings)
 
-@app.route('/twilio-webhook', methods=['POST'])
-def twilio_webhook():
-    # Validate Twilio request
+def twilio_request_error():
+    """The error response for a request not signed by the configured Twilio account, or None"""
     twilio_sid = get_setting('twilio_sid')
     twilio_token = get_setting('twilio_token')
     
@@ -229,30 +247,39 @@ def twilio_webhook():
     
     if not validator.validate(url, params, signature):
         return 'Invalid signature', 403
+    return None
+
+@app.route('/twilio-webhook', methods=['POST'])
+def twilio_webhook():
+    # Validate Twilio request
+    error = twilio_request_error()
+    if error:
+        return error
     
     # Process incoming message
     from_number = request.form.get('From', '')
     message_body = request.form.get('Body', '')
+    message_sid = request.form.get('MessageSid', '')
     
-    if from_number and message_body:
+    if from_number and message_body and message_sid:
         # Remove 'whatsapp:' prefix if present
         whatsapp_number = from_number.replace('whatsapp:', '')
         
         # Get the thread ID for this WhatsApp number
-        thread_id = get_thread_id_for_whatsapp(whatsapp_number)
+        conversation = get_thread_id_for_whatsapp(whatsapp_number)
         
-        if thread_id:
-            # Send reply to Gmail
+        if conversation:
+            account_id, thread_id = conversation
+            # Queue the reply; the worker sends it to Gmail and reports back over WhatsApp
             try:
-                send_gmail_reply(thread_id, message_body)
-                response = MessagingResponse()
-                response.message("Message sent to Gmail successfully!")
-                return str(response)
+                if reply_outbox.enqueue(message_sid, account_id, whatsapp_number, thread_id, message_body):
+                    wakeup.notify_reply()
             except Exception as e:
-                print(f"Error sending Gmail reply: {e}")
+                log.error(f"Error queueing Gmail reply: {e}")
                 response = MessagingResponse()
                 response.message("Sorry, there was an error sending your message to Gmail.")
                 return str(response)
+            return str(MessagingResponse())
         else:
             response = MessagingResponse()
             response.message("No active conversation found. Please wait for an email to be forwarded to you first.")
@@ -260,39 +287,48 @@ def twilio_webhook():
     
     return 'OK'
 
-def send_gmail_reply(thread_id, message_body):
-    """Send a reply to a Gmail thread"""
+@app.route('/twilio-status', methods=['POST'])
+def twilio_status():
+    """Delivery status callbacks for the WhatsApp messages the worker sends"""
+    error = twilio_request_error()
+    if error:
+        return error
+    
+    message_sid = request.form.get('MessageSid', '')
+    message_status = request.form.get('MessageStatus', '')
+    if not message_sid or not message_status:
+        return 'Missing MessageSid or MessageStatus', 400
+    
+    error_code = request.form.get('ErrorCode', '')
+    # Buffered; the write-behind thread stores it, so a burst of callbacks never queues on the database
+    delivery_status.record(message_sid, message_status, int(error_code) if error_code.isdigit() else None)
+    return '', 204
+
+@app.route('/gmail-push', methods=['POST'])
+def gmail_push():
+    """Receive Gmail users.watch notifications delivered by a Pub/Sub push subscription"""
+    # The subscription's push endpoint must carry ?token=<gmail_push_token>
+    expected_token = get_setting('gmail_push_token')
+    if not expected_token:
+        return 'Push notifications not configured', 404
+    if not hmac.compare_digest(request.args.get('token', ''), expected_token):
+        return 'Invalid token', 403
+    
+    envelope = request.get_json(silent=True) or {}
     try:
-        credentials_path = get_setting('gmail_credentials_path')
-        if not credentials_path or not os.path.exists(credentials_path):
-            raise Exception("Gmail credentials not found")
-        
-        # Load credentials and build service
-        flow = InstalledAppFlow.from_client_secrets_file(credentials_path, SCOPES)
-        creds = flow.run_local_server(port=0)
-        
-        service = build('gmail', 'v1', credentials=creds)
-        
-        # Create the message
-        message = {
-            'threadId': thread_id,
-            'raw': base64.urlsafe_b64encode(
-                f'Content-Type: text/plain; charset="UTF-8"\n'
-                f'MIME-Version: 1.0\n'
-                f'Content-Transfer-Encoding: 7bit\n'
-                f'In-Reply-To: <{thread_id}@gmail.com>\n'
-                f'References: <{thread_id}@gmail.com>\n'
-                f'Subject: Re: WhatsApp Reply\n\n'
-                f'{message_body}'.encode('utf-8')
-            ).decode('utf-8')
-        }
-        
-        # Send the message
-        service.users().messages().send(userId='me', body=message).execute()
-        
-    except Exception as e:
-        print(f"Error in send_gmail_reply: {e}")
-        raise
+        data = json.loads(base64.b64decode(envelope['message']['data']))
+        history_id = int(data['historyId'])
+    except (KeyError, TypeError, ValueError) as e:
+        log.warning(f"Malformed Gmail push notification: {e}")
+        return 'Malformed notification', 400
+    
+    log.info(f"Gmail push notification for {data.get('emailAddress')}: historyId {history_id}")
+    
+    # Wake the worker now; its regular poll is the fallback if it isn't listening
+    wakeup.notify(history_id, data.get('emailAddress'))
+    
+    # Any 2xx acknowledges the message to Pub/Sub
+    return '', 204
 
 if __name__ == '__main__':
     init_db()
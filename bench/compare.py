@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Compare two bench/run.py result files scenario by scenario.
+
+    python bench/compare.py baseline.json candidate.json --threshold 10
+
+Exits with status 1 when any metric regressed by more than --threshold percent.
+"""
+
+import argparse
+import json
+import sys
+
+# (label, path into a scenario, True if higher is better)
+METRICS = [
+    ('emails/sec', ('emails_per_second',), True),
+    ('forward p50 ms', ('forward_latency_ms', 'p50_ms'), False),
+    ('forward p99 ms', ('forward_latency_ms', 'p99_ms'), False),
+    ('webhook p50 ms', ('webhook_latency_ms', 'p50_ms'), False),
+    ('webhook p99 ms', ('webhook_latency_ms', 'p99_ms'), False),
+    ('status p99 ms', ('status_callback_latency_ms', 'p99_ms'), False),
+    ('gmail requests', ('gmail_requests',), False),
+]
+
+def _get(scenario, path):
+    for key in path:
+        scenario = scenario.get(key) if isinstance(scenario, dict) else None
+    return scenario
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10, help='Allowed regression in percent')
+    args = parser.parse_args()
+    
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    
+    print(f"baseline {baseline.get('revision')} vs candidate {candidate.get('revision')}")
+    before = {s['keywords']: s for s in baseline['scenarios']}
+    regressions = 0
+    for scenario in candidate['scenarios']:
+        old = before.get(scenario['keywords'])
+        if old is None:
+            continue
+        print(f"\n{scenario['keywords']} keyword(s)")
+        for label, path, higher_is_better in METRICS:
+            old_value, new_value = _get(old, path), _get(scenario, path)
+            if old_value is None or new_value is None:
+                continue
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            regressed = (-change if higher_is_better else change) > args.threshold
+            regressions += regressed
+            print(f"  {label:<16} {old_value:>10} -> {new_value:>10}  {change:+6.1f}%{'  REGRESSION' if regressed else ''}")
+    
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Gmail REST API, for benchmarks and offline testing.
+
+Serves the calls the worker makes (profile, messages.list/get/modify/
+batchModify/send, history.list, watch and HTTP batch requests) from an
+in-memory mailbox. Every request can be delayed by a fixed latency and fails
+with a 500 at a configurable rate. Point the app at it with
+GMAIL_API_ENDPOINT=http://127.0.0.1:<port>/.
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+API_PREFIX = '/gmail/v1/users/me'
+
+# History records returned per history.list page
+HISTORY_PAGE_SIZE = 500
+
+class Mailbox:
+    """Messages, their labels and the history of additions"""
+    
+    def __init__(self, email_address='bench@example.com'):
+        self.email_address = email_address
+        self.messages = {}
+        self.history = []
+        self.history_id = 1000
+        self.sent = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+    
+    def add(self, subject, body='', sender='sender@example.com', unread=True):
+        """Deliver a message; returns its ID. internalDate records the arrival time"""
+        with self._lock:
+            message_id = f'{next(self._ids):016x}'
+            self.history_id += 1
+            self.messages[message_id] = {
+                'id': message_id,
+                'threadId': message_id,
+                'labelIds': ['INBOX', 'UNREAD'] if unread else ['INBOX'],
+                'historyId': str(self.history_id),
+                'internalDate': str(int(time.time() * 1000)),
+                'payload': {
+                    'mimeType': 'text/plain',
+                    'headers': [
+                        {'name': 'Subject', 'value': subject},
+                        {'name': 'From', 'value': sender},
+                        {'name': 'Message-ID', 'value': f'<{message_id}@bench.local>'},
+                    ],
+                    'body': {'data': base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')},
+                },
+            }
+            self.history.append((self.history_id, message_id))
+            return message_id
+    
+    def unread_ids(self):
+        """Newest first, like Gmail"""
+        with self._lock:
+            return [i for i, m in reversed(self.messages.items()) if 'UNREAD' in m['labelIds']]
+    
+    def get(self, message_id, format='full', metadata_headers=()):
+        with self._lock:
+            msg = self.messages.get(message_id)
+            if msg is None:
+                return None
+            msg = json.loads(json.dumps(msg))
+        if format == 'metadata':
+            wanted = {name.lower() for name in metadata_headers}
+            headers = [h for h in msg['payload']['headers'] if not wanted or h['name'].lower() in wanted]
+            msg['payload'] = {'mimeType': msg['payload']['mimeType'], 'headers': headers}
+        return msg
+    
+    def remove_labels(self, message_ids, labels):
+        with self._lock:
+            for message_id in message_ids:
+                msg = self.messages.get(message_id)
+                if msg is not None:
+                    msg['labelIds'] = [label for label in msg['labelIds'] if label not in labels]
+    
+    def history_since(self, start_history_id):
+        with self._lock:
+            return [(h, i) for h, i in self.history if h > start_history_id], self.history_id
+    
+    def record_sent(self, message):
+        with self._lock:
+            message_id = uuid.uuid4().hex[:16]
+            self.sent.append(dict(message, id=message_id, received_at=time.time()))
+            return message_id
+
+class FakeGmail:
+    """Threaded HTTP server exposing a Mailbox through the Gmail API"""
+    
+    def __init__(self, mailbox=None, latency=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        self.mailbox = mailbox or Mailbox()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._server.daemon_threads = True
+        self._thread = None
+    
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/'
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-gmail', daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+    
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+    
+    def _fails(self):
+        return self.error_rate and random.random() < self.error_rate
+    
+    def handle(self, method, path, query, body):
+        """Route one API call; returns (status, JSON-serializable body)"""
+        self._count()
+        if self._fails():
+            return 500, {'error': {'code': 500, 'message': 'Injected backend error'}}
+        
+        if not path.startswith(API_PREFIX):
+            return 404, {'error': {'code': 404, 'message': 'Not found'}}
+        route = path[len(API_PREFIX):].strip('/').split('/')
+        mailbox = self.mailbox
+        
+        if method == 'GET' and route == ['profile']:
+            return 200, {'emailAddress': mailbox.email_address, 'historyId': str(mailbox.history_id)}
+        
+        if method == 'GET' and route == ['messages']:
+            ids = mailbox.unread_ids() if 'UNREAD' in query.get('labelIds', []) else list(reversed(mailbox.messages))
+            offset = int(query.get('pageToken', ['0'])[0] or 0)
+            limit = int(query.get('maxResults', ['100'])[0])
+            page = ids[offset:offset + limit]
+            result = {'messages': [{'id': i, 'threadId': i} for i in page], 'resultSizeEstimate': len(ids)}
+            if offset + limit < len(ids):
+                result['nextPageToken'] = str(offset + limit)
+            return 200, result
+        
+        if method == 'GET' and route == ['history']:
+            start = int(query['startHistoryId'][0])
+            records, latest = mailbox.history_since(start)
+            offset = int(query.get('pageToken', ['0'])[0] or 0)
+            page = records[offset:offset + HISTORY_PAGE_SIZE]
+            result = {
+                'history': [
+                    {'id': str(h), 'messagesAdded': [{'message': {'id': i, 'threadId': i,
+                                                                  'labelIds': mailbox.messages[i]['labelIds']}}]}
+                    for h, i in page
+                ],
+                'historyId': str(latest),
+            }
+            if offset + HISTORY_PAGE_SIZE < len(records):
+                result['nextPageToken'] = str(offset + HISTORY_PAGE_SIZE)
+            return 200, result
+        
+        if method == 'GET' and len(route) == 2 and route[0] == 'messages':
+            msg = mailbox.get(route[1], query.get('format', ['full'])[0], query.get('metadataHeaders', []))
+            if msg is None:
+                return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+            return 200, msg
+        
+        if method == 'POST' and route == ['messages', 'batchModify']:
+            mailbox.remove_labels(body.get('ids', []), body.get('removeLabelIds', []))
+            return 204, None
+        
+        if method == 'POST' and len(route) == 3 and route[0] == 'messages' and route[2] == 'modify':
+            mailbox.remove_labels([route[1]], body.get('removeLabelIds', []))
+            return 200, mailbox.get(route[1], 'minimal') or {}
+        
+        if method == 'POST' and route == ['messages', 'send']:
+            return 200, {'id': mailbox.record_sent(body), 'threadId': body.get('threadId')}
+        
+        if method == 'POST' and route == ['watch']:
+            return 200, {'historyId': str(mailbox.history_id),
+                         'expiration': str(int((time.time() + 7 * 24 * 3600) * 1000))}
+        
+        return 404, {'error': {'code': 404, 'message': 'Not found'}}
+    
+    def handle_batch(self, content_type, body):
+        """Answer a multipart/mixed batch the way googleapiclient expects; returns (content_type, body)"""
+        parsed = Parser().parsestr(f'Content-Type: {content_type}\r\n\r\n{body}')
+        boundary = f'batch_{uuid.uuid4().hex}'
+        parts = []
+        for part in parsed.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            method, target, _ = request_line.split(' ', 2)
+            _, _, request_body = rest.partition('\r\n\r\n')
+            url = urlsplit(target)
+            status, result = self.handle(method, url.path, parse_qs(url.query),
+                                         json.loads(request_body) if request_body.strip() else {})
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(
+                f'--{boundary}\r\n'
+                f'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status < 400 else "Error"}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                f'{json.dumps(result) if result is not None else ""}\r\n'
+            )
+        return f'multipart/mixed; boundary={boundary}', ''.join(parts) + f'--{boundary}--\r\n'
+
+def _handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def _respond(self, status, content_type, payload):
+            data = payload.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def _dispatch(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length).decode('utf-8') if length else ''
+            if fake.latency:
+                time.sleep(fake.latency)
+            url = urlsplit(self.path)
+            if method == 'POST' and url.path.rstrip('/') == '/batch':
+                content_type, payload = fake.handle_batch(self.headers['Content-Type'], raw)
+                self._respond(200, content_type, payload)
+                return
+            status, result = fake.handle(method, url.path, parse_qs(url.query), json.loads(raw) if raw else {})
+            self._respond(status, 'application/json; charset=UTF-8', json.dumps(result) if result is not None else '')
+        
+        def do_GET(self):
+            self._dispatch('GET')
+        
+        def do_POST(self):
+            self._dispatch('POST')
+        
+        def log_message(self, format, *args):
+            pass
+    
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--messages', type=int, default=100, help='Unread messages to seed the mailbox with')
+    parser.add_argument('--keyword', default='invoice', help='Keyword put in every other subject')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every request')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with a 500')
+    args = parser.parse_args()
+    
+    fake = FakeGmail(latency=args.latency_ms / 1000, error_rate=args.error_rate, port=args.port)
+    for n in range(args.messages):
+        subject = f'{args.keyword} #{n}' if n % 2 == 0 else f'Newsletter #{n}'
+        fake.mailbox.add(subject, body=f'Body of message {n}.')
+    print(f"Fake Gmail serving {args.messages} messages at {fake.url}")
+    fake.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == '__main__':
+    main()
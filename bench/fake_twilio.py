@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Twilio Messages API, for benchmarks and offline testing.
+
+Accepts messages.create and answers messages.list from the messages it has
+accepted, recording when each one arrived. Every request can be delayed by a
+fixed latency and fails at a configurable rate, alternating 429 (with
+Retry-After) and 500. Point the app at it with
+TWILIO_API_BASE=http://127.0.0.1:<port>.
+
+Given the auth token, messages created with a StatusCallback are reported
+back like Twilio does: signed `sent` and `delivered` callbacks are posted to
+that URL from a small thread pool.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import URLError
+from urllib.parse import parse_qs, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+# Retry-After sent with injected 429s, in seconds
+RETRY_AFTER_SECONDS = 0.1
+
+# Statuses reported to a message's StatusCallback, in order
+CALLBACK_STATUSES = ('sent', 'delivered')
+
+class FakeTwilio:
+    """Threaded HTTP server recording WhatsApp messages sent through it"""
+    
+    def __init__(self, latency=0.0, error_rate=0.0, host='127.0.0.1', port=0, auth_token=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.auth_token = auth_token
+        self.messages = []
+        self.requests = 0
+        self.callback_latencies = []
+        self.callback_errors = 0
+        self._callbacks = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fake-twilio-callback')
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._server = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._server.daemon_threads = True
+    
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+    
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-twilio', daemon=True).start()
+        return self
+    
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._callbacks.shutdown(wait=False)
+    
+    def _post_callbacks(self, url, message):
+        from twilio.request_validator import RequestValidator
+        validator = RequestValidator(self.auth_token)
+        for status in CALLBACK_STATUSES:
+            params = {'MessageSid': message['sid'], 'MessageStatus': status, 'AccountSid': message['account_sid'],
+                      'To': message['to'], 'From': message['from']}
+            request = Request(url, data=urlencode(params).encode('utf-8'),
+                              headers={'X-Twilio-Signature': validator.compute_signature(url, params)})
+            started = time.perf_counter()
+            try:
+                with urlopen(request, timeout=30) as response:
+                    ok = 200 <= response.status < 300
+            except (URLError, OSError):
+                ok = False
+            with self._lock:
+                self.callback_latencies.append(time.perf_counter() - started)
+                self.callback_errors += not ok
+    
+    def _injected_error(self):
+        """(status, headers) of an injected failure, or None"""
+        with self._lock:
+            self.requests += 1
+            if not (self.error_rate and random.random() < self.error_rate):
+                return None
+            self._failures += 1
+            if self._failures % 2:
+                return 429, {'Retry-After': str(RETRY_AFTER_SECONDS)}
+            return 500, {}
+    
+    def create(self, account_sid, form):
+        message = {
+            'sid': f'SM{uuid.uuid4().hex}',
+            'account_sid': account_sid,
+            'to': form.get('To', ''),
+            'from': form.get('From', ''),
+            'body': form.get('Body', ''),
+            'status': 'queued',
+            'direction': 'outbound-api',
+            'num_segments': '1',
+            'date_created': formatdate(usegmt=True),
+            'date_updated': formatdate(usegmt=True),
+            'uri': f'/2010-04-01/Accounts/{account_sid}/Messages.json',
+        }
+        with self._lock:
+            self.messages.append(dict(message, received_at=time.time()))
+        if self.auth_token and form.get('StatusCallback'):
+            self._callbacks.submit(self._post_callbacks, form['StatusCallback'], message)
+        return message
+    
+    def list(self, account_sid, query):
+        to_number = query.get('To', [None])[0]
+        from_number = query.get('From', [None])[0]
+        page_size = int(query.get('PageSize', ['50'])[0])
+        with self._lock:
+            matching = [
+                {k: v for k, v in m.items() if k != 'received_at'} for m in reversed(self.messages)
+                if (to_number is None or m['to'] == to_number) and (from_number is None or m['from'] == from_number)
+            ]
+        return {
+            'messages': matching[:page_size],
+            'page': 0,
+            'page_size': page_size,
+            'start': 0,
+            'end': min(page_size, len(matching)),
+            'first_page_uri': f'/2010-04-01/Accounts/{account_sid}/Messages.json',
+            'next_page_uri': None,
+            'previous_page_uri': None,
+            'uri': f'/2010-04-01/Accounts/{account_sid}/Messages.json',
+        }
+
+def _handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def _respond(self, status, payload, headers=None):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def _dispatch(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length).decode('utf-8') if length else ''
+            if fake.latency:
+                time.sleep(fake.latency)
+            
+            error = fake._injected_error()
+            if error:
+                status, headers = error
+                self._respond(status, {'code': 20429 if status == 429 else 20500,
+                                       'message': 'Injected error', 'status': status}, headers)
+                return
+            
+            url = urlsplit(self.path)
+            route = url.path.strip('/').split('/')
+            # /2010-04-01/Accounts/{AccountSid}/Messages.json
+            if len(route) != 4 or route[1] != 'Accounts' or route[3] != 'Messages.json':
+                self._respond(404, {'code': 20404, 'message': 'Not found', 'status': 404})
+                return
+            if method == 'POST':
+                form = {k: v[0] for k, v in parse_qs(raw).items()}
+                self._respond(201, fake.create(route[2], form))
+            else:
+                self._respond(200, fake.list(route[2], parse_qs(url.query)))
+        
+        def do_GET(self):
+            self._dispatch('GET')
+        
+        def do_POST(self):
+            self._dispatch('POST')
+        
+        def log_message(self, format, *args):
+            pass
+    
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every request')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with 429/500')
+    parser.add_argument('--auth-token', help="The app's twilio_token, to sign status callbacks with")
+    args = parser.parse_args()
+    
+    fake = FakeTwilio(latency=args.latency_ms / 1000, error_rate=args.error_rate, port=args.port,
+                      auth_token=args.auth_token)
+    print(f"Fake Twilio listening at {fake.url}")
+    fake.start()
+    try:
+        while True:
+            time.sleep(60)
+            print(f"{len(fake.messages)} messages received")
+    except KeyboardInterrupt:
+        fake.stop()
+
+if __name__ == '__main__':
+    main()
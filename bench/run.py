@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the Gmail-to-WhatsApp bridge.
+
+Runs the worker's pipeline one cycle at a time (pipeline.run_once())
+against bench/fake_gmail.py and bench/fake_twilio.py on a scratch database,
+while inbound WhatsApp replies are posted concurrently to the real
+/twilio-webhook and the fake reports each sent message's delivery to
+/twilio-status. One scenario runs per
+keyword-set size, each in a fresh process, and the results are written as
+JSON for bench/compare.py:
+    
+    python bench/run.py --emails 2000 --keywords 1,10,100 --output results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Marks each synthetic email so its forward can be traced in Twilio's messages
+TRACE_PATTERN = re.compile(r'\[bench-(\d+)\]')
+
+TWILIO_SID = 'ACbench'
+TWILIO_TOKEN = 'bench-token'
+TWILIO_NUMBER = '+15550000000'
+TARGET_NUMBER = '+15551110000'
+
+def percentile(values, pct):
+    """Nearest-rank percentile, or None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))]
+
+def latency_summary(seconds):
+    return {
+        'count': len(seconds),
+        'p50_ms': _ms(percentile(seconds, 50)),
+        'p90_ms': _ms(percentile(seconds, 90)),
+        'p99_ms': _ms(percentile(seconds, 99)),
+        'max_ms': _ms(max(seconds) if seconds else None),
+    }
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+def _write_credentials(directory):
+    """Client secrets and a long-lived token so gmail_auth never starts an OAuth flow"""
+    credentials_path = os.path.join(directory, 'bench_credentials.json')
+    with open(credentials_path, 'w') as f:
+        json.dump({'installed': {'client_id': 'bench', 'client_secret': 'bench'}}, f)
+    with open(os.path.join(directory, 'bench_credentials.token.json'), 'w') as f:
+        json.dump({
+            'token': 'bench-access-token',
+            'refresh_token': 'bench-refresh-token',
+            'client_id': 'bench',
+            'client_secret': 'bench',
+            'token_uri': 'http://127.0.0.1:9/token',
+            'expiry': '2099-01-01T00:00:00Z',
+        }, f)
+    return credentials_path
+
+def run_scenario(args, keyword_count):
+    """Run one scenario in this process and return its results"""
+    sys.path.insert(0, REPO_DIR)
+    from fake_gmail import FakeGmail
+    from fake_twilio import CALLBACK_STATUSES, FakeTwilio
+    
+    gmail = FakeGmail(latency=args.gmail_latency_ms / 1000, error_rate=args.gmail_error_rate).start()
+    twilio = FakeTwilio(latency=args.twilio_latency_ms / 1000, error_rate=args.twilio_error_rate,
+                        auth_token=TWILIO_TOKEN).start()
+    
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    os.environ['CONFIG_DB'] = os.path.join(scratch, 'config.db')
+    os.environ['GMAIL_API_ENDPOINT'] = gmail.url
+    os.environ['TWILIO_API_BASE'] = twilio.url
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    
+    # Imported only now: the overrides above are read at import time
+    import app
+    import config
+    import delivery_status
+    import gmail_client
+    import job_queue
+    import pipeline
+    import reply_outbox
+    import storage
+    import worker
+    from twilio.request_validator import RequestValidator
+    from werkzeug.serving import make_server
+    import requests
+    
+    # Injected errors should cost retries, not the production backoff's idle minutes
+    job_queue.BACKOFF_BASE_SECONDS = reply_outbox.BACKOFF_BASE_SECONDS = args.retry_backoff_ms / 1000
+    gmail_client.BACKOFF_BASE_SECONDS = args.retry_backoff_ms / 1000
+    
+    storage.migrate()
+    keywords = [f'kw{n:05d}' for n in range(keyword_count)]
+    settings = {
+        'gmail_credentials_path': _write_credentials(scratch),
+        'twilio_sid': TWILIO_SID,
+        'twilio_token': TWILIO_TOKEN,
+        'twilio_whatsapp_number': TWILIO_NUMBER,
+        'target_whatsapp_number': TARGET_NUMBER,
+        'twilio_rate_per_second': str(args.twilio_rate),
+        'twilio_send_workers': str(args.twilio_workers),
+        'gmail_quota_units_per_second': str(args.gmail_quota),
+        'job_max_attempts': '100',
+        'reply_max_attempts': '100',
+    }
+    with storage.transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', settings.items())
+        conn.executemany('INSERT INTO filters (keyword) VALUES (?)', [(k,) for k in keywords])
+    config.invalidate()
+    
+    # Threads the inbound replies answer, already read so the worker ignores them
+    reply_numbers = [f'+1555200{n:04d}' for n in range(args.reply_senders)]
+    for number in reply_numbers:
+        thread_id = gmail.mailbox.add(f'Conversation with {number}', unread=False)
+        worker.store_conversation_mapping(thread_id, number)
+    
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-webhook', daemon=True).start()
+    webhook_url = f'http://127.0.0.1:{server.server_port}/twilio-webhook'
+    # Also where the fake Twilio posts status callbacks
+    app.set_setting('public_base_url', f'http://127.0.0.1:{server.server_port}')
+    validator = RequestValidator(TWILIO_TOKEN)
+    
+    rng = random.Random(args.seed)
+    reply_rng = random.Random(args.seed + 1)
+    webhook_latencies = []
+    webhook_errors = 0
+    webhook_lock = threading.Lock()
+    
+    def post_reply(n):
+        nonlocal webhook_errors
+        params = {'From': f'whatsapp:{reply_rng.choice(reply_numbers)}', 'Body': f'Reply {n}',
+                  'MessageSid': f'SMbench{n:08d}'}
+        headers = {'X-Twilio-Signature': validator.compute_signature(webhook_url, params)}
+        started = time.perf_counter()
+        try:
+            ok = requests.post(webhook_url, data=params, headers=headers, timeout=30).status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with webhook_lock:
+            webhook_latencies.append(elapsed)
+            webhook_errors += not ok
+    
+    def reply_load():
+        with ThreadPoolExecutor(max_workers=args.reply_concurrency) as pool:
+            for n in range(args.replies):
+                pool.submit(post_reply, n)
+                if args.reply_interval_ms:
+                    time.sleep(args.reply_interval_ms / 1000)
+    
+    arrivals = {}
+    matching = set()
+    
+    def deliver_arrivals(count):
+        for _ in range(count):
+            n = len(arrivals)
+            if rng.random() < args.match_rate:
+                subject = f'Action needed {rng.choice(keywords)} [bench-{n}]'
+                matching.add(n)
+            else:
+                subject = f'Weekly newsletter [bench-{n}]'
+            arrivals[n] = time.time()
+            gmail.mailbox.add(subject, body=f'Synthetic message {n}. ' * args.body_sentences)
+    
+    def forwarded():
+        first_seen = {}
+        for message in list(twilio.messages):
+            for token in TRACE_PATTERN.findall(message['body']):
+                first_seen.setdefault(int(token), message['received_at'])
+        return first_seen
+    
+    # Warm-up: builds the clients and stores a history cursor, as on a worker that has been running,
+    # so arrivals are found incrementally rather than by the bounded first-run resync
+    pipeline.run_once()
+    
+    replies_thread = threading.Thread(target=reply_load, name='bench-replies')
+    replies_thread.start()
+    
+    cycle_seconds = []
+    started = time.perf_counter()
+    deadline = time.monotonic() + args.timeout
+    for _ in range(args.max_cycles):
+        deliver_arrivals(min(args.batch, args.emails - len(arrivals)))
+        cycle_started = time.perf_counter()
+        pipeline.run_once()
+        cycle_seconds.append(time.perf_counter() - cycle_started)
+        
+        done_emails = len(arrivals) == args.emails and matching <= set(forwarded())
+        done_replies = not replies_thread.is_alive() and len(gmail.mailbox.sent) >= args.replies
+        if (done_emails and done_replies) or time.monotonic() > deadline:
+            break
+    wall_seconds = time.perf_counter() - started
+    replies_thread.join()
+    
+    first_seen = forwarded()
+    forward_latencies = [first_seen[n] - arrivals[n] for n in matching if n in first_seen]
+    busy_seconds = sum(cycle_seconds)
+    
+    # Let the last callbacks arrive, then write what the web app buffered
+    expected_callbacks = len(twilio.messages) * len(CALLBACK_STATUSES)
+    callback_deadline = time.monotonic() + 30
+    while len(twilio.callback_latencies) < expected_callbacks and time.monotonic() < callback_deadline:
+        time.sleep(0.05)
+    delivery_status.flush()
+    delivered = storage.get_connection().execute(
+        "SELECT COUNT(*) FROM message_status WHERE status = 'delivered'"
+    ).fetchone()[0]
+    server.shutdown()
+    
+    return {
+        'keywords': keyword_count,
+        'emails': len(arrivals),
+        'matched': len(matching),
+        'forwarded': len(forward_latencies),
+        'cycles': len(cycle_seconds),
+        'wall_seconds': round(wall_seconds, 3),
+        'emails_per_second': round(len(arrivals) / busy_seconds, 2) if busy_seconds else None,
+        'cycle_ms': latency_summary(cycle_seconds),
+        'forward_latency_ms': latency_summary(forward_latencies),
+        'webhook_latency_ms': latency_summary(webhook_latencies),
+        'webhook_errors': webhook_errors,
+        'status_callback_latency_ms': latency_summary(twilio.callback_latencies),
+        'status_callback_errors': twilio.callback_errors,
+        'messages_delivered': delivered,
+        'replies_sent_to_gmail': len(gmail.mailbox.sent),
+        'gmail_requests': gmail.requests,
+        'twilio_requests': twilio.requests,
+        'whatsapp_messages': len(twilio.messages),
+    }
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--emails', type=int, default=2000, help='Synthetic emails per scenario')
+    parser.add_argument('--batch', type=int, default=200, help='Emails arriving before each worker cycle')
+    parser.add_argument('--keywords', default='1,10,100', help='Comma-separated keyword-set sizes, one scenario each')
+    parser.add_argument('--match-rate', type=float, default=0.2, help='Fraction of emails matching a keyword')
+    parser.add_argument('--body-sentences', type=int, default=5, help='Sentences in each email body')
+    parser.add_argument('--replies', type=int, default=200, help='Inbound WhatsApp replies posted to the webhook')
+    parser.add_argument('--reply-concurrency', type=int, default=8, help='Concurrent webhook clients')
+    parser.add_argument('--reply-interval-ms', type=float, default=5, help='Delay between submitted replies')
+    parser.add_argument('--reply-senders', type=int, default=20, help='Distinct WhatsApp numbers replying')
+    parser.add_argument('--gmail-latency-ms', type=float, default=20)
+    parser.add_argument('--gmail-error-rate', type=float, default=0)
+    parser.add_argument('--gmail-quota', type=float, default=0,
+                        help='gmail_quota_units_per_second for the run; the fake has no quota, so 0 (unbudgeted)')
+    parser.add_argument('--twilio-latency-ms', type=float, default=50)
+    parser.add_argument('--twilio-error-rate', type=float, default=0)
+    parser.add_argument('--twilio-rate', type=float, default=100, help='twilio_rate_per_second for the run')
+    parser.add_argument('--twilio-workers', type=int, default=8, help='twilio_send_workers for the run')
+    parser.add_argument('--retry-backoff-ms', type=float, default=100, help='Base retry delay for failed sends')
+    parser.add_argument('--max-cycles', type=int, default=500, help='Give up on a scenario after this many cycles')
+    parser.add_argument('--timeout', type=float, default=600, help='Give up on a scenario after this many seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write the results here instead of stdout')
+    parser.add_argument('--scenario', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--scenario-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.scenario is not None:
+        with open(args.scenario_output, 'w') as f:
+            json.dump(run_scenario(args, args.scenario), f)
+        return
+    
+    scenarios = []
+    for keyword_count in [int(k) for k in args.keywords.split(',') if k.strip()]:
+        print(f"Running scenario with {keyword_count} keyword(s)...", file=sys.stderr)
+        with tempfile.NamedTemporaryFile(suffix='.json') as result:
+            # A fresh process per scenario: new database, caches and connection pools
+            subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                            '--scenario', str(keyword_count), '--scenario-output', result.name],
+                           check=True, stdout=subprocess.DEVNULL)
+            with open(result.name) as f:
+                scenarios.append(json.load(f))
+    
+    params = {k: v for k, v in vars(args).items() if k not in ('output', 'scenario', 'scenario_output')}
+    report = json.dumps({
+        'revision': _git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'params': params,
+        'scenarios': scenarios,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
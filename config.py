@@ -0,0 +1,88 @@
+"""
+In-memory snapshot of the settings, filters, accounts and routing_rules tables.
+
+Readers get an immutable snapshot without touching SQLite. At most once per
+CHECK_INTERVAL_SECONDS the snapshot reads the `config` row of `counters`,
+which triggers on these tables bump on every change, and only reloads the
+tables when it moved. Commits to other tables (metrics, heartbeats, leases,
+queues, and the worker's per-cycle state in state.py) never cause a reload.
+"""
+
+import threading
+import time
+from dataclasses import dataclass, field
+import storage
+
+# How often readers look for changes made by other connections or processes
+CHECK_INTERVAL_SECONDS = 1.0
+
+# Name of the row in `counters` versioning the configuration tables
+VERSION_COUNTER = 'config'
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """Immutable view of the configuration tables"""
+    settings: dict = field(default_factory=dict)
+    filters: tuple = ()
+    accounts: tuple = ()
+    routes: tuple = ()
+    version: int = -1
+    
+    def get(self, key, default=None):
+        value = self.settings.get(key)
+        return value if value is not None else default
+    
+    def get_int(self, key, default=None):
+        value = self.settings.get(key)
+        try:
+            return int(value) if value not in (None, '') else default
+        except ValueError:
+            return default
+    
+    def get_float(self, key, default=None):
+        value = self.settings.get(key)
+        try:
+            return float(value) if value not in (None, '') else default
+        except ValueError:
+            return default
+
+_lock = threading.Lock()
+_snapshot = None
+_checked_at = 0.0
+
+def _load(conn, version):
+    settings = {row['key']: row['value'] for row in conn.execute('SELECT key, value FROM settings')}
+    filters = tuple(row['keyword'] for row in conn.execute('SELECT keyword FROM filters ORDER BY keyword'))
+    accounts = tuple(dict(row) for row in conn.execute('SELECT * FROM accounts WHERE enabled = 1 ORDER BY id'))
+    routes = tuple(dict(row) for row in conn.execute('SELECT * FROM routing_rules ORDER BY id'))
+    return ConfigSnapshot(settings=settings, filters=filters, accounts=accounts, routes=routes, version=version)
+
+def get_snapshot():
+    """Get the current configuration snapshot, reloading it only if the database changed"""
+    global _snapshot, _checked_at
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - _checked_at < CHECK_INTERVAL_SECONDS:
+        return snapshot
+    
+    with _lock:
+        if _snapshot is not None and time.monotonic() - _checked_at < CHECK_INTERVAL_SECONDS:
+            return _snapshot
+        
+        conn = storage.get_connection()
+        version = conn.execute('SELECT value FROM counters WHERE name = ?', (VERSION_COUNTER,)).fetchone()[0]
+        if _snapshot is None or _snapshot.version != version:
+            _snapshot = _load(conn, version)
+        _checked_at = time.monotonic()
+        return _snapshot
+
+def invalidate():
+    """Make the next read check for changes, e.g. right after this process wrote settings"""
+    global _checked_at
+    _checked_at = 0.0
+
+def get_setting(key, default=None):
+    return get_snapshot().get(key, default)
+
+def get_filters():
+    # The same tuple is returned until the filters change, which lets callers cache on it
+    return get_snapshot().filters
@@ -0,0 +1,170 @@
+"""
+Routing of inbound WhatsApp replies to the Gmail thread last forwarded to the number.
+
+Lookups are served from an in-process LRU cache. Every write to
+`conversation_map` takes the next value of the `conversation_map` counter and
+stores it on the row (or, for expired mappings, on their archive row). At most
+once per VERSION_CHECK_SECONDS a lookup compares the counter with the value
+the cache was last synced at and drops just the numbers written since, so
+writes by other processes reach this cache within that interval. Writes made
+by this process update its cache immediately.
+
+Each mapping also keeps the Message-ID, Subject, From and References of the
+email last forwarded from the thread, so a reply can be threaded without
+reading the original back from Gmail.
+
+Mappings not refreshed for `conversation_ttl_days` are moved to
+`conversation_archive` by expire_stale(), which the worker runs periodically.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+import accounts
+import config
+import storage
+
+# Numbers kept in the routing cache
+CACHE_SIZE = 4096
+
+# How often lookups look for mappings written by other processes
+VERSION_CHECK_SECONDS = 1.0
+
+# Name of the row in `counters` versioning conversation_map
+VERSION_COUNTER = 'conversation_map'
+
+# Retention defaults, overridable with the settings of the same name
+DEFAULT_TTL_DAYS = 30
+DEFAULT_ARCHIVE_DAYS = 365
+
+# Mappings archived per transaction, so a large backlog never holds the write lock for long
+EXPIRE_BATCH_SIZE = 1000
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+_version = None
+_checked_at = 0.0
+
+def _next_version(conn):
+    conn.execute('UPDATE counters SET value = value + 1 WHERE name = ?', (VERSION_COUNTER,))
+    return conn.execute('SELECT value FROM counters WHERE name = ?', (VERSION_COUNTER,)).fetchone()[0]
+
+def _remember(number, conversation):
+    _cache[number] = conversation
+    _cache.move_to_end(number)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+def _sync(conn):
+    """Drop cached numbers written by other connections since the last sync; call with _lock held"""
+    global _version, _checked_at
+    now = time.monotonic()
+    if _version is not None and now - _checked_at < VERSION_CHECK_SECONDS:
+        return
+    _checked_at = now
+    
+    version = conn.execute('SELECT value FROM counters WHERE name = ?', (VERSION_COUNTER,)).fetchone()[0]
+    if version == _version:
+        return
+    if _version is None or version - _version > CACHE_SIZE:
+        _cache.clear()
+    else:
+        changed = conn.execute('''
+            SELECT whatsapp_user_number FROM conversation_map WHERE version > ?
+            UNION
+            SELECT whatsapp_user_number FROM conversation_archive WHERE archived_version > ?
+        ''', (_version, _version))
+        for row in changed:
+            _cache.pop(row['whatsapp_user_number'], None)
+    _version = version
+
+def store(thread_id, whatsapp_number, account_id=accounts.DEFAULT_ACCOUNT_ID, headers=None):
+    """Route replies from this number to the thread from now on
+    
+    `headers` holds the message_id, subject, sender and references of the
+    forwarded email, as returned by worker.reply_headers().
+    """
+    headers = headers or {}
+    with storage.transaction() as conn:
+        version = _next_version(conn)
+        conn.execute('''
+            INSERT OR REPLACE INTO conversation_map
+                (account_id, thread_id, whatsapp_user_number, last_updated, version,
+                 message_id_header, subject, sender, references_header)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?, ?, ?, ?, ?)
+        ''', (account_id, thread_id, whatsapp_number, version, headers.get('message_id'),
+              headers.get('subject'), headers.get('sender'), headers.get('references')))
+    with _lock:
+        _remember(whatsapp_number, (account_id, thread_id))
+
+def lookup(whatsapp_number):
+    """The (account_id, thread_id) last forwarded to this number, or None"""
+    conn = storage.get_connection()
+    with _lock:
+        _sync(conn)
+        if whatsapp_number in _cache:
+            _cache.move_to_end(whatsapp_number)
+            return _cache[whatsapp_number]
+    
+    # Served by idx_conversation_map_number_updated
+    row = conn.execute('''
+        SELECT account_id, thread_id FROM conversation_map
+        WHERE whatsapp_user_number = ?
+        ORDER BY last_updated DESC
+        LIMIT 1
+    ''', (whatsapp_number,)).fetchone()
+    conversation = (row['account_id'], row['thread_id']) if row else None
+    # Misses are cached too; a later store() for the number invalidates them like any write
+    with _lock:
+        _remember(whatsapp_number, conversation)
+    return conversation
+
+def thread_headers(account_id, thread_id):
+    """Headers of the email last forwarded from a thread, or None if none were recorded"""
+    row = storage.get_connection().execute('''
+        SELECT message_id_header, subject, sender, references_header FROM conversation_map
+        WHERE account_id = ? AND thread_id = ?
+    ''', (account_id, thread_id)).fetchone()
+    if row is None or not row['message_id_header']:
+        return None
+    return {
+        'message_id': row['message_id_header'],
+        'subject': row['subject'],
+        'sender': row['sender'],
+        'references': row['references_header'],
+    }
+
+def expire_stale(snapshot=None):
+    """Archive mappings older than conversation_ttl_days and prune the archive; returns the number archived"""
+    snapshot = snapshot or config.get_snapshot()
+    ttl_days = snapshot.get_float('conversation_ttl_days', DEFAULT_TTL_DAYS)
+    archive_days = snapshot.get_float('conversation_archive_days', DEFAULT_ARCHIVE_DAYS)
+    
+    archived = 0
+    if ttl_days > 0:
+        cutoff = f'-{ttl_days} days'
+        while True:
+            with storage.immediate_transaction() as conn:
+                rowids = [row[0] for row in conn.execute('''
+                    SELECT rowid FROM conversation_map
+                    WHERE last_updated < datetime('now', ?)
+                    LIMIT ?
+                ''', (cutoff, EXPIRE_BATCH_SIZE))]
+                if not rowids:
+                    break
+                version = _next_version(conn)
+                placeholders = ','.join('?' * len(rowids))
+                conn.execute(f'''
+                    INSERT INTO conversation_archive
+                        (account_id, thread_id, whatsapp_user_number, last_updated, archived_at, archived_version)
+                    SELECT account_id, thread_id, whatsapp_user_number, last_updated, CURRENT_TIMESTAMP, ?
+                    FROM conversation_map WHERE rowid IN ({placeholders})
+                ''', (version, *rowids))
+                conn.execute(f'DELETE FROM conversation_map WHERE rowid IN ({placeholders})', rowids)
+            archived += len(rowids)
+    
+    if archive_days > 0:
+        with storage.transaction() as conn:
+            conn.execute("DELETE FROM conversation_archive WHERE archived_at < datetime('now', ?)",
+                         (f'-{archive_days} days',))
+    return archived
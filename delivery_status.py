@@ -0,0 +1,132 @@
+"""
+Delivery status of WhatsApp messages, reported by Twilio status callbacks.
+
+Every message the sender creates asks Twilio to POST its status changes
+(queued, sent, delivered, read, failed, ...) to the web app's /twilio-status
+route. The route only records the change in an in-memory write-behind buffer:
+a background thread per process writes the buffered statuses to
+`message_status` in one executemany transaction every FLUSH_INTERVAL_SECONDS,
+or as soon as FLUSH_BATCH_SIZE SIDs are waiting. A burst of callbacks
+therefore costs a handful of SQLite writes instead of one per request, and
+gunicorn workers never wait on the database lock to answer Twilio.
+
+Callbacks can arrive out of order, so each status has a rank and a status is
+never replaced by one of lower rank, neither in the buffer nor in the table.
+When the worker records a send, job_queue links the SID to the Gmail messages
+the WhatsApp message carried, in `message_status_emails`.
+"""
+
+import threading
+import time
+import config
+import metrics
+import storage
+from flusher import Flusher
+
+FLUSH_INTERVAL_SECONDS = 1.0
+
+# Buffered SIDs that trigger a flush before the interval is up
+FLUSH_BATCH_SIZE = 500
+
+# Retention default, overridable with the setting of the same name
+DEFAULT_RETENTION_DAYS = 30
+
+# Later stages of a message's life rank higher; final states share a rank
+STATUS_RANKS = {
+    'accepted': 0,
+    'scheduled': 0,
+    'queued': 0,
+    'sending': 1,
+    'sent': 2,
+    'delivered': 3,
+    'undelivered': 3,
+    'failed': 3,
+    'canceled': 3,
+    'read': 4,
+}
+
+QUEUED = 'queued'
+
+_lock = threading.Lock()
+_pending = {}
+
+def callback_url(snapshot=None):
+    """StatusCallback URL for new messages, or None while public_base_url is not configured"""
+    snapshot = snapshot or config.get_snapshot()
+    base_url = snapshot.get('public_base_url')
+    return f"{base_url.rstrip('/')}/twilio-status" if base_url else None
+
+def _merge(sid, update):
+    """Buffer an update unless a higher-ranked one is already waiting; call with _lock held"""
+    current = _pending.get(sid)
+    if current is None or update[1] >= current[1]:
+        _pending[sid] = update
+
+def record(sid, status, error_code=None):
+    """Buffer a status reported by Twilio; it reaches the database with the next flush"""
+    status = status.lower()
+    update = (status, STATUS_RANKS.get(status, 0), error_code, time.time())
+    _flusher.ensure_started()
+    with _lock:
+        _merge(sid, update)
+        waiting = len(_pending)
+    metrics.inc('message_status_callbacks_total', status=status)
+    if waiting >= FLUSH_BATCH_SIZE:
+        _flusher.wake()
+
+def link(conn, sid, to_number, jobs, now):
+    """Record, in the caller's transaction, which Gmail messages a sent WhatsApp message carried"""
+    # A callback flushed before the send was recorded has already created the row; keep its status
+    conn.execute('''
+        INSERT INTO message_status (sid, to_number, status, status_rank, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (sid) DO UPDATE SET to_number = excluded.to_number, created_at = excluded.created_at
+    ''', (sid, to_number, QUEUED, STATUS_RANKS[QUEUED], now, now))
+    conn.executemany('''
+        INSERT OR IGNORE INTO message_status_emails (sid, account_id, message_id) VALUES (?, ?, ?)
+    ''', [(sid, job['account_id'], job['message_id']) for job in jobs])
+
+def flush():
+    """Write the buffered statuses to the database; returns the number written"""
+    with _lock:
+        if not _pending:
+            return 0
+        pending = dict(_pending)
+        _pending.clear()
+    
+    rows = [(sid, status, rank, error_code, updated_at)
+            for sid, (status, rank, error_code, updated_at) in pending.items()]
+    try:
+        with metrics.timed('message_status_flush'), storage.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO message_status (sid, status, status_rank, error_code, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (sid) DO UPDATE SET
+                    status = excluded.status,
+                    status_rank = excluded.status_rank,
+                    error_code = excluded.error_code,
+                    updated_at = excluded.updated_at
+                WHERE excluded.status_rank >= message_status.status_rank
+            ''', rows)
+    except Exception:
+        # Put the statuses back, behind any newer ones, for the next flush to retry
+        with _lock:
+            for sid, update in pending.items():
+                _merge(sid, update)
+        raise
+    return len(rows)
+
+# Forked children drop the parent's buffer: the parent flushes it
+_flusher = Flusher('message statuses', flush, FLUSH_INTERVAL_SECONDS, on_fork=_pending.clear)
+
+def prune(snapshot=None):
+    """Forget statuses not updated for message_status_retention_days; returns the number removed"""
+    snapshot = snapshot or config.get_snapshot()
+    retention_days = snapshot.get_float('message_status_retention_days', DEFAULT_RETENTION_DAYS)
+    if retention_days <= 0:
+        return 0
+    with storage.transaction() as conn:
+        removed = conn.execute('DELETE FROM message_status WHERE updated_at < ?',
+                               (time.time() - retention_days * 86400,)).rowcount
+        conn.execute('DELETE FROM message_status_emails WHERE sid NOT IN (SELECT sid FROM message_status)')
+    return removed
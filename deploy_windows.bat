@@ -40,7 +40,7 @@ echo Creating credentials directory...
 if not exist "credentials" mkdir credentials
 
 echo Initializing database...
-python -c "import sqlite3; conn = sqlite3.connect('config.db'); cursor = conn.cursor(); cursor.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)'); cursor.execute('CREATE TABLE IF NOT EXISTS filters (id INTEGER PRIMARY KEY AUTOINCREMENT, keyword TEXT UNIQUE)'); cursor.execute('CREATE TABLE IF NOT EXISTS conversation_map (thread_id TEXT PRIMARY KEY, whatsapp_user_number TEXT, last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'); conn.commit(); conn.close(); print('Database initialized successfully')"
+python -c "import storage; storage.migrate(); print('Database initialized successfully')"
 
 echo.
 echo ========================================
@@ -66,37 +66,8 @@ if (!(Test-Path "credentials")) {
 Write-Host "Initializing database..." -ForegroundColor Yellow
 try {
     python -c "
-import sqlite3
-conn = sqlite3.connect('config.db')
-cursor = conn.cursor()
-
-# Create settings table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )
-''')
-
-# Create filters table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS filters (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        keyword TEXT UNIQUE
-    )
-''')
-
-# Create conversation_map table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS conversation_map (
-        thread_id TEXT PRIMARY KEY,
-        whatsapp_user_number TEXT,
-        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-''')
-
-conn.commit()
-conn.close()
+import storage
+storage.migrate()
 print('Database initialized successfully')
 "
     Write-Host "✓ Database initialized successfully" -ForegroundColor Green
@@ -0,0 +1,61 @@
+"""
+Lease and retry bookkeeping shared by the durable queues.
+
+job_queue and reply_outbox both move rows through pending -> sending -> sent.
+Claiming a due row leases it to one process by moving it to `sending`; a
+failed send goes back to pending with exponential backoff, and a row that runs
+out of attempts ends in the dead state. Each queue keeps its own table, row
+key and limits and passes them in.
+"""
+
+import time
+import storage
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+DEAD = 'dead'
+
+def select_due(conn, table, limit, now):
+    """Up to `limit` pending rows of `table` that are due, oldest first"""
+    return conn.execute(f'''
+        SELECT * FROM {table}
+        WHERE status = ? AND next_attempt_at <= ?
+        ORDER BY next_attempt_at, created_at
+        LIMIT ?
+    ''', (PENDING, now, limit)).fetchall()
+
+def retry_schedule(attempts, max_attempts, backoff_base, backoff_max, now):
+    """Status and next attempt time after failed attempt number `attempts`
+    
+    Retries wait backoff_base * 2 ** (attempts - 1) seconds, capped at
+    backoff_max; after max_attempts the row is dead.
+    """
+    if attempts >= max_attempts:
+        return DEAD, now
+    return PENDING, now + min(backoff_max, backoff_base * 2 ** (attempts - 1))
+
+def mark_failed(table, where, params, attempts, error, max_attempts, backoff_base, backoff_max):
+    """Schedule a retry of the rows matching `where`, or dead-letter them; returns the new status"""
+    now = time.time()
+    status, next_attempt_at = retry_schedule(attempts, max_attempts, backoff_base, backoff_max, now)
+    with storage.transaction() as conn:
+        conn.execute(f'''
+            UPDATE {table}
+            SET status = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+            WHERE {where}
+        ''', (status, next_attempt_at, str(error), now, *params))
+    return status
+
+def release(conn, table, where, params, now):
+    """Put the leased rows matching `where` back in the queue, due now; returns how many"""
+    return conn.execute(f'''
+        UPDATE {table} SET status = ?, next_attempt_at = ?, updated_at = ?
+        WHERE status = ? AND {where}
+    ''', (PENDING, now, now, SENDING, *params)).rowcount
+
+def purge_sent(conn, table, retention_seconds, now):
+    """Drop rows of `table` sent longer than `retention_seconds` ago"""
+    conn.execute(f'''
+        DELETE FROM {table} WHERE status = ? AND updated_at < ?
+    ''', (SENT, now - retention_seconds))
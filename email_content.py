@@ -0,0 +1,124 @@
+"""
+Plain-text extraction from Gmail message payloads.
+
+Walks the whole MIME tree (nested multipart/alternative, multipart/mixed,
+forwarded message/rfc822 parts) instead of only the top level, prefers
+text/plain and falls back to text/html converted to text. Decoding stops at a
+size cap so a huge body never has to be held in memory in full. Named
+attachments are listed for media_cache, which downloads them.
+"""
+
+import base64
+import re
+from html.parser import HTMLParser
+
+# Decoded bytes kept from a body part; the rest is never decoded
+MAX_BODY_BYTES = 64 * 1024
+
+# Guard against pathological nesting
+MAX_DEPTH = 20
+
+NO_TEXT_CONTENT = "No plain text content found"
+
+class _HTMLToText(HTMLParser):
+    """Collects visible text, turning block elements into line breaks"""
+    
+    BLOCK_TAGS = {'br', 'p', 'div', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'table'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self._skip_depth = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+    
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append('\n')
+    
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.chunks.append(data)
+
+def html_to_text(html):
+    parser = _HTMLToText()
+    parser.feed(html)
+    parser.close()
+    text = ''.join(parser.chunks)
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+def _charset(part):
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = re.search(r'charset="?([\w.:-]+)"?', header['value'], re.IGNORECASE)
+            if match:
+                return match.group(1)
+    return 'utf-8'
+
+def decode_part_body(part, max_bytes=MAX_BODY_BYTES):
+    """Decode at most `max_bytes` of a part's inline body data; returns (text, truncated)"""
+    data = part.get('body', {}).get('data')
+    if not data:
+        return '', False
+    
+    # Every 4 base64 characters decode to 3 bytes, so only decode the prefix we keep
+    limit = -(-max_bytes // 3) * 4
+    truncated = len(data) > limit
+    raw = base64.urlsafe_b64decode(data[:limit] + '=' * (-len(data[:limit]) % 4))[:max_bytes]
+    
+    charset = _charset(part)
+    try:
+        text = raw.decode(charset, errors='replace')
+    except LookupError:
+        text = raw.decode('utf-8', errors='replace')
+    return text, truncated
+
+def _is_attachment(part):
+    return bool(part.get('filename')) or 'attachmentId' in part.get('body', {})
+
+def iter_parts(payload, depth=0):
+    """Yield every leaf part of the MIME tree, depth-first in document order"""
+    if depth > MAX_DEPTH:
+        return
+    children = payload.get('parts')
+    if children:
+        for child in children:
+            yield from iter_parts(child, depth + 1)
+    else:
+        yield payload
+
+def attachment_parts(payload):
+    """The parts carrying named attachments, in document order"""
+    # Unnamed parts with an attachmentId are inline images of the HTML body
+    return [part for part in iter_parts(payload) if part.get('filename')]
+
+def extract_text(payload, max_bytes=MAX_BODY_BYTES):
+    """Extract the message text, preferring text/plain over text/html"""
+    html_part = None
+    for part in iter_parts(payload):
+        if _is_attachment(part):
+            continue
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type == 'text/plain':
+            text, truncated = decode_part_body(part, max_bytes)
+            if text.strip():
+                return text + ('\n[…truncated]' if truncated else '')
+        elif mime_type == 'text/html' and html_part is None:
+            html_part = part
+    
+    if html_part is not None:
+        html, truncated = decode_part_body(html_part, max_bytes)
+        text = html_to_text(html)
+        if text:
+            return text + ('\n[…truncated]' if truncated else '')
+    
+    return NO_TEXT_CONTENT
@@ -0,0 +1,61 @@
+"""
+Background thread that writes a process's in-memory buffer to the database.
+
+Used by the write-behind buffers of metrics and delivery_status. Each process
+starts its own thread on first use, including processes forked from one that
+already had it (a preloaded gunicorn app), and flushes once more at exit.
+"""
+
+import atexit
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+class Flusher:
+    """Calls `flush` every `interval` seconds on a daemon thread, or sooner when woken"""
+    
+    def __init__(self, name, flush, interval, on_fork=None):
+        self.name = name
+        self.flush = flush
+        self.interval = interval
+        # Called in a forked child before its thread starts, e.g. to drop the parent's buffer
+        self.on_fork = on_fork
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        atexit.register(self._flush_at_exit)
+    
+    def ensure_started(self):
+        """Start this process's thread unless it is already running"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None and self.on_fork:
+                self.on_fork()
+            self._pid = os.getpid()
+        threading.Thread(target=self._loop, name=f'{self.name}-flush', daemon=True).start()
+    
+    def wake(self):
+        """Flush now instead of at the end of the interval"""
+        self._wake.set()
+    
+    def _loop(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # A failed flush must never take the process down; the next one retries
+                log.error(f"Error flushing {self.name}: {e}")
+    
+    def _flush_at_exit(self):
+        if self._pid == os.getpid():
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"Error flushing {self.name} at exit: {e}")
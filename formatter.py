@@ -0,0 +1,71 @@
+"""
+Outbound WhatsApp message formatting.
+
+Matches queued for the same recipient are coalesced into one digest, and any
+text longer than a single WhatsApp message is split into numbered segments at
+sentence boundaries. Splitting only ever moves whitespace, so no content is
+lost; the output is deterministic, which lets an interrupted delivery resume
+from the first segment that was not sent.
+"""
+
+import re
+
+# Twilio rejects WhatsApp bodies longer than this
+MAX_SEGMENT_CHARS = 1600
+
+# Room reserved for the "(12/34) " segment marker
+SEGMENT_MARKER_RESERVE = 12
+
+DIGEST_SEPARATOR = '\n\n———\n\n'
+
+# A sentence runs up to terminal punctuation followed by whitespace, or a line break
+_SENTENCE = re.compile(r'.*?(?:[.!?…]+["\')\]]*(?=\s)|\n|$)\s*', re.DOTALL)
+
+def format_digest(bodies):
+    """Combine the message bodies for one recipient into a single text"""
+    if len(bodies) == 1:
+        return bodies[0]
+    entries = [f"{i}) {body}" for i, body in enumerate(bodies, 1)]
+    return f"📬 {len(bodies)} new emails\n\n" + DIGEST_SEPARATOR.join(entries)
+
+def _sentences(text):
+    for match in _SENTENCE.finditer(text):
+        if match.group():
+            yield match.group()
+
+def _split_long(sentence, size):
+    """Split a single over-long sentence at whitespace, or hard-cut if there is none"""
+    while len(sentence) > size:
+        cut = sentence.rfind(' ', 0, size + 1)
+        if cut <= 0:
+            cut = size
+        yield sentence[:cut]
+        sentence = sentence[cut:]
+    if sentence:
+        yield sentence
+
+def split_segments(text, limit=MAX_SEGMENT_CHARS):
+    """Split text into ordered segments of at most `limit` characters"""
+    if len(text) <= limit:
+        return [text]
+    
+    size = limit - SEGMENT_MARKER_RESERVE
+    chunks = []
+    current = ''
+    for sentence in _sentences(text):
+        for piece in _split_long(sentence, size):
+            if current and len(current) + len(piece) > size:
+                chunks.append(current)
+                current = ''
+            current += piece
+    if current:
+        chunks.append(current)
+    
+    chunks = [chunk.strip() for chunk in chunks]
+    chunks = [chunk for chunk in chunks if chunk]
+    total = len(chunks)
+    return [f"({i}/{total}) {chunk}" for i, chunk in enumerate(chunks, 1)]
+
+def segments_for(bodies, limit=MAX_SEGMENT_CHARS):
+    """Digest and split the bodies of one batch into the messages to send"""
+    return split_segments(format_digest(bodies), limit)
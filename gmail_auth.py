@@ -0,0 +1,210 @@
+"""
+Persistent Gmail OAuth token store and cached Gmail API clients.
+
+The interactive OAuth flow runs once per credentials file, from
+`manage_accounts.py authorize` and never from the worker, which has no browser
+and raises AuthorizationRequired instead. Afterwards the refresh token is read
+from disk and kept fresh in the background, and each thread reuses one Gmail
+service built from the bundled discovery document.
+The services' requests go through gmail_client, which budgets and retries them.
+The Google SDKs take a noticeable share of startup to import, so they are
+only imported on first use; the web app imports this module but rarely
+needs them.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+import gmail_client
+
+log = logging.getLogger(__name__)
+
+# Gmail API scopes
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+# Refresh access tokens this many seconds before they expire
+REFRESH_MARGIN_SECONDS = 300
+
+# Delay before retrying a failed background refresh
+REFRESH_RETRY_SECONDS = 60
+
+GMAIL_API_ROOT = 'https://gmail.googleapis.com/'
+
+# Base URL replacing GMAIL_API_ROOT, e.g. bench/fake_gmail.py
+GMAIL_API_ENDPOINT = os.environ.get('GMAIL_API_ENDPOINT')
+
+# One lock per credentials file, never held during a network call
+_locks = {}
+_locks_lock = threading.Lock()
+_credentials = {}
+_refreshers = {}
+_local = threading.local()
+
+class AuthorizationRequired(Exception):
+    """Raised when a credentials file has no usable stored token"""
+
+def _lock_for(credentials_path):
+    with _locks_lock:
+        return _locks.setdefault(credentials_path, threading.Lock())
+
+def token_path_for(credentials_path):
+    """Path of the persisted token for a client secrets file"""
+    base, _ = os.path.splitext(credentials_path)
+    return f"{base}.token.json"
+
+def _save_token(creds, token_path):
+    # Threads and processes may save the same token at once; each writes its own temporary file
+    tmp_path = f"{token_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(creds.to_json())
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, token_path)
+
+def _refresh(credentials_path, creds):
+    from google.auth.transport.requests import Request
+    creds.refresh(Request())
+    _save_token(creds, token_path_for(credentials_path))
+
+def _seconds_until_refresh(creds):
+    if not creds.expiry:
+        return REFRESH_RETRY_SECONDS
+    # google-auth keeps expiry as a naive UTC datetime
+    remaining = (creds.expiry - datetime.utcnow()).total_seconds()
+    return max(0, remaining - REFRESH_MARGIN_SECONDS)
+
+def _refresh_loop(credentials_path):
+    lock = _lock_for(credentials_path)
+    while True:
+        with lock:
+            creds = _credentials.get(credentials_path)
+        if creds is None:
+            return
+        
+        time.sleep(_seconds_until_refresh(creds))
+        
+        with lock:
+            if _credentials.get(credentials_path) is not creds:
+                # Credentials were discarded or replaced; the new ones have their own refresher
+                return
+        try:
+            _refresh(credentials_path, creds)
+            continue
+        except Exception as e:
+            log.error(f"Error refreshing Gmail token: {e}")
+        
+        time.sleep(REFRESH_RETRY_SECONDS)
+
+def _start_refresher(credentials_path):
+    thread = _refreshers.get(credentials_path)
+    if thread is not None and thread.is_alive():
+        return
+    thread = threading.Thread(target=_refresh_loop, args=(credentials_path,), daemon=True)
+    _refreshers[credentials_path] = thread
+    thread.start()
+
+def get_credentials(credentials_path, interactive=False):
+    """Get valid Gmail credentials from the stored token
+    
+    Without a usable token, raises AuthorizationRequired, or with `interactive`
+    runs the consent flow in a browser and stores the new token.
+    """
+    if not credentials_path or not os.path.exists(credentials_path):
+        raise Exception("Gmail credentials not found")
+    
+    lock = _lock_for(credentials_path)
+    with lock:
+        creds = _credentials.get(credentials_path)
+    if creds is not None and creds.valid:
+        return creds
+    
+    token_path = token_path_for(credentials_path)
+    if creds is None and os.path.exists(token_path):
+        from google.oauth2.credentials import Credentials
+        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+    
+    if creds is not None and not creds.valid and creds.refresh_token:
+        try:
+            _refresh(credentials_path, creds)
+        except Exception as e:
+            log.warning(f"Stored Gmail token could not be refreshed: {e}")
+            creds = None
+    
+    if creds is None or not creds.valid:
+        if not interactive:
+            raise AuthorizationRequired(f"Gmail access for {credentials_path} is not authorized; "
+                                        f"run `python manage_accounts.py authorize <account id>`")
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file(credentials_path, SCOPES)
+        creds = flow.run_local_server(port=0)
+        _save_token(creds, token_path)
+    
+    with lock:
+        current = _credentials.get(credentials_path)
+        if current is not None and current is not creds and current.valid:
+            # Another thread loaded or refreshed the token meanwhile; keep one copy
+            return current
+        _credentials[credentials_path] = creds
+        _start_refresher(credentials_path)
+    return creds
+
+def get_gmail_service(credentials_path):
+    """Get the cached Gmail service for this thread, building it on first use"""
+    creds = get_credentials(credentials_path)
+    
+    # httplib2 connections are not thread-safe, so each thread keeps its own client
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    
+    cached = services.get(credentials_path)
+    if cached is not None and cached[0] is creds:
+        return cached[1]
+    
+    # The discovery document ships with google-api-python-client; never fetch it
+    service = _build_service(creds, credentials_path)
+    services[credentials_path] = (creds, service)
+    return service
+
+def _build_service(creds, credentials_path):
+    from googleapiclient.discovery import build, build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+    request_builder = gmail_client.request_builder(credentials_path)
+    if not GMAIL_API_ENDPOINT:
+        return build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False,
+                     requestBuilder=request_builder)
+    # Rewrite rootUrl rather than pass api_endpoint, which batch requests ignore
+    document = json.loads(get_static_doc('gmail', 'v1'))
+    document['rootUrl'] = GMAIL_API_ENDPOINT.rstrip('/') + '/'
+    return build_from_document(document, credentials=creds, requestBuilder=request_builder)
+
+def api_url(path):
+    """Absolute URL of a Gmail REST path, honoring GMAIL_API_ENDPOINT"""
+    return (GMAIL_API_ENDPOINT or GMAIL_API_ROOT).rstrip('/') + '/' + path.lstrip('/')
+
+def get_authorized_session(credentials_path):
+    """Get this thread's requests session for calls the Gmail client can't stream, e.g. attachment downloads"""
+    from google.auth.transport.requests import AuthorizedSession
+    creds = get_credentials(credentials_path)
+    
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    
+    cached = sessions.get(credentials_path)
+    if cached is not None and cached[0] is creds:
+        return cached[1]
+    
+    session = AuthorizedSession(creds)
+    sessions[credentials_path] = (creds, session)
+    return session
+
+def discard_credentials(credentials_path):
+    """Forget cached credentials and the stored token, e.g. after new client secrets are uploaded"""
+    with _lock_for(credentials_path):
+        _credentials.pop(credentials_path, None)
+        token_path = token_path_for(credentials_path)
+        if os.path.exists(token_path):
+            os.remove(token_path)
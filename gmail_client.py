@@ -0,0 +1,246 @@
+"""
+Quota budgeting, retries and a circuit breaker for every Gmail API call.
+
+Gmail charges each method a number of quota units and allows a user about
+250 units per second. Services built by gmail_auth create their requests
+through GmailRequest, so each `.execute()` first takes the method's units
+from the user's token bucket (refilled at `gmail_quota_units_per_second`).
+429s, rate-limit 403s, 5xx responses and connection errors are retried with
+exponential backoff, honoring Retry-After; a 429 also pauses the bucket.
+Methods that are not idempotent (sending a message) are only retried when
+Gmail rejected the call for its rate limit: after a 5xx or a dropped
+connection the message may already have been sent.
+
+After BREAKER_FAILURE_THRESHOLD calls in a row fail even after retries, the
+user's breaker opens and ingestion calls fail fast for BREAKER_OPEN_SECONDS,
+doubling while failures continue. Calls made inside `with priority():`, the
+replies to WhatsApp messages, are exempt: they bypass the open breaker (a
+success closes it) and draw on units that ingestion leaves in reserve.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import config
+import metrics
+from ratelimit import TokenBucket, retry_delay
+
+log = logging.getLogger(__name__)
+
+# Units charged per call by Gmail; https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.watch': 100,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.send': 100,
+    'gmail.users.messages.attachments.get': 5,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+# Budget default, overridable with the setting of the same name (0 disables it); Gmail's per-user limit is 250
+DEFAULT_UNITS_PER_SECOND = 200
+
+# Units ingestion leaves in the bucket so a reply (one messages.send) never waits behind it
+PRIORITY_RESERVE_UNITS = 100
+
+MAX_RETRIES = 3
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# Consecutive failed calls that open the breaker, and how long it then stays open
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_OPEN_SECONDS = 30
+BREAKER_MAX_OPEN_SECONDS = 900
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Reasons Gmail gives for a 403 that means "slow down" rather than "forbidden"
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+# Calls that must not run twice, so they are only retried when Gmail rejected them outright
+NON_IDEMPOTENT_METHODS = {'gmail.users.messages.send'}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gmail while the user's breaker is open"""
+
+_local = threading.local()
+
+@contextmanager
+def priority():
+    """Mark the Gmail calls made by this thread inside the block as replies"""
+    previous = getattr(_local, 'priority', False)
+    _local.priority = True
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+def _is_priority():
+    return getattr(_local, 'priority', False)
+
+def _status(error):
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+def _error_reasons(error):
+    """The `reason` of each entry in the JSON error body of an HttpError"""
+    try:
+        body = json.loads(error.content or b'{}')
+        return {entry.get('reason') for entry in body['error'].get('errors', [])}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+def _is_rate_limited(error):
+    from googleapiclient.errors import HttpError
+    if not isinstance(error, HttpError):
+        return False
+    status = _status(error)
+    # Gmail also signals rate limiting as 403 rateLimitExceeded / userRateLimitExceeded
+    return status == 429 or (status == 403 and bool(_error_reasons(error) & RATE_LIMIT_REASONS))
+
+def _is_retryable(error, method_id):
+    from googleapiclient.errors import HttpError
+    from httplib2 import HttpLib2Error
+    if _is_rate_limited(error):
+        return True
+    if method_id in NON_IDEMPOTENT_METHODS:
+        return False
+    if isinstance(error, HttpError):
+        return _status(error) in RETRYABLE_STATUSES
+    return isinstance(error, (OSError, HttpLib2Error))
+
+def _label(method_id):
+    return method_id.removeprefix('gmail.users.')
+
+class GmailClient:
+    """Quota bucket and circuit breaker for one Gmail user, shared by this process's threads"""
+    
+    def __init__(self, name):
+        self.name = name
+        self._bucket = None
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._open_seconds = BREAKER_OPEN_SECONDS
+    
+    def breaker_open(self):
+        return time.monotonic() < self._open_until
+    
+    def acquire(self, method_id, units=None):
+        """Take the quota units of a call, failing fast while the breaker is open for ingestion"""
+        units = units if units is not None else QUOTA_UNITS.get(method_id, DEFAULT_QUOTA_UNITS)
+        is_priority = _is_priority()
+        if not is_priority and self.breaker_open():
+            raise CircuitOpenError(f"Gmail calls for {self.name} paused for "
+                                   f"{self._open_until - time.monotonic():.0f}s after repeated failures")
+        
+        rate = config.get_snapshot().get_float('gmail_quota_units_per_second', DEFAULT_UNITS_PER_SECOND)
+        if rate > 0:
+            with self._lock:
+                if self._bucket is None or self._bucket.rate != rate:
+                    self._bucket = TokenBucket(rate)
+                bucket = self._bucket
+            bucket.acquire(units, reserve=0 if is_priority else PRIORITY_RESERVE_UNITS)
+        metrics.inc('gmail_quota_units_total', units, method=_label(method_id))
+    
+    def _record_success(self):
+        with self._lock:
+            if self._open_until:
+                log.info(f"Gmail calls for {self.name} are succeeding again")
+            self._failures = 0
+            self._open_until = 0.0
+            self._open_seconds = BREAKER_OPEN_SECONDS
+    
+    def _record_failure(self):
+        with self._lock:
+            self._failures += 1
+            # Once it has opened, the breaker reopens on the first failure until a call succeeds
+            if self._failures < BREAKER_FAILURE_THRESHOLD and not self._open_until:
+                return
+            self._open_until = time.monotonic() + self._open_seconds
+            log.warning(f"Pausing Gmail ingestion for {self.name} for {self._open_seconds}s after repeated failures")
+            metrics.inc('gmail_breaker_opened_total')
+            self._open_seconds = min(BREAKER_MAX_OPEN_SECONDS, self._open_seconds * 2)
+            self._failures = 0
+    
+    def call(self, method_id, fn, units=None):
+        """Run `fn`, one Gmail API round-trip, within the budget and with retries"""
+        attempt = 0
+        while True:
+            self.acquire(method_id, units)
+            try:
+                result = fn()
+            except Exception as e:
+                if not _is_retryable(e, method_id):
+                    raise
+                if attempt >= MAX_RETRIES:
+                    self._record_failure()
+                    raise
+                
+                resp = getattr(e, 'resp', None)
+                delay = retry_delay(resp.get('retry-after') if resp is not None else None,
+                                    attempt, BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS)
+                if _status(e) == 429 and self._bucket is not None:
+                    # Throttling applies to the whole user, so hold every thread back
+                    self._bucket.pause(delay)
+                
+                log.warning(f"Gmail {_label(method_id)} failed ({_status(e) or type(e).__name__}), "
+                            f"retrying in {delay:.1f}s")
+                metrics.inc('gmail_retries_total', method=_label(method_id))
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._record_success()
+            return result
+
+_clients = {}
+_clients_lock = threading.Lock()
+_request_class = None
+
+def get_client(credentials_path):
+    """The process-wide client of the Gmail user behind a credentials file"""
+    with _clients_lock:
+        client = _clients.get(credentials_path)
+        if client is None:
+            name = os.path.splitext(os.path.basename(credentials_path))[0]
+            client = _clients[credentials_path] = GmailClient(name)
+        return client
+
+def request_builder(credentials_path):
+    """`requestBuilder` for googleapiclient that sends every request through the user's client"""
+    global _request_class
+    # Imported on first use, like the rest of the Google SDK (see gmail_auth)
+    from googleapiclient.http import HttpRequest
+    
+    if _request_class is None:
+        class GmailRequest(HttpRequest):
+            client = None
+            
+            def execute(self, http=None, num_retries=0):
+                return self.client.call(
+                    self.methodId, lambda: super(GmailRequest, self).execute(http=http, num_retries=num_retries)
+                )
+        
+        _request_class = GmailRequest
+    
+    client = get_client(credentials_path)
+    
+    def build(*args, **kwargs):
+        request = _request_class(*args, **kwargs)
+        request.client = client
+        return request
+    
+    return build
+
+def execute_batch(batch, requests):
+    """Execute a BatchHttpRequest of requests built by request_builder, charging all their units"""
+    if not requests:
+        return
+    units = sum(QUOTA_UNITS.get(request.methodId, DEFAULT_QUOTA_UNITS) for request in requests)
+    requests[0].client.call(requests[0].methodId, batch.execute, units=units)
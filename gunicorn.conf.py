@@ -0,0 +1,35 @@
+"""
+Gunicorn settings for the web app (used by start.sh).
+
+The app is imported once in the master and forked into the workers, so the
+import cost is paid once per container start instead of once per worker.
+Each worker then opens its own database connections before taking requests.
+"""
+
+import logging
+import time
+
+bind = '0.0.0.0:5000'
+workers = 2
+timeout = 120
+preload_app = True
+
+# Seconds the preloaded app may take to import before startup logs a warning
+IMPORT_BUDGET_SECONDS = 1.0
+
+# This file is read just before the app is preloaded
+_config_loaded_at = time.perf_counter()
+
+def on_starting(server):
+    import logs
+    logs.configure()
+    elapsed = time.perf_counter() - _config_loaded_at
+    log = logging.getLogger('gunicorn.startup')
+    level = logging.WARNING if elapsed > IMPORT_BUDGET_SECONDS else logging.INFO
+    log.log(level, f"App imported in {elapsed * 1000:.0f} ms (budget {IMPORT_BUDGET_SECONDS * 1000:.0f} ms)",
+            extra={'import_seconds': round(elapsed, 3), 'import_budget_seconds': IMPORT_BUDGET_SECONDS})
+
+def post_fork(server, worker):
+    # Connections must not be shared with the master, so they are opened here, per worker
+    import app
+    app.warm_up()
@@ -0,0 +1,239 @@
+"""
+Durable outbound job queue decoupling Gmail ingestion from WhatsApp delivery.
+
+Each matching email becomes one row in `outbound_jobs` per recipient, keyed by
+account, Gmail message ID and recipient, so re-ingesting a message never
+creates a second job. Delivery moves a job through pending -> sending -> sent;
+failures go back to pending with exponential backoff and end in the dead state
+after too many attempts.
+
+A job left in `sending` means the process died around the Twilio call. Before
+such a job is retried, Twilio is asked whether the message already went out,
+so a crash never turns into a duplicate send.
+
+Due jobs for the same recipient are claimed together as a batch and delivered
+as one digest, split into segments when it is too long for one message. The
+batch records how many segments went out, so a retry resumes after the last
+one sent, and per-recipient caps defer the rest of a batch instead of
+dropping it. Attachments cached by media_cache follow the text segments, one
+message each.
+"""
+
+import json
+import time
+import uuid
+import delivery_status
+import durable_queue
+import formatter
+import storage
+from durable_queue import PENDING, SENDING, SENT, DEAD
+
+DEFAULT_MAX_ATTEMPTS = 8
+
+# Retry delays: BACKOFF_BASE_SECONDS * 2 ** (attempt - 1), capped at BACKOFF_MAX_SECONDS
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+
+# A job still `sending` after this long belongs to a process that died mid-send
+SENDING_LEASE_SECONDS = 300
+
+# Sent jobs are kept this long so late re-ingestion is still deduplicated
+SENT_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Most emails coalesced into a single digest
+DIGEST_MAX_JOBS = 20
+
+# Window over which per-recipient send caps are counted
+RECIPIENT_CAP_WINDOW_SECONDS = 3600
+
+def enqueue(account_id, message_id, thread_id, to_number, body, digest_window=0, media=None, headers=None):
+    """Queue a message for delivery; returns False if the message was already queued
+    
+    With a digest window the job is held until the window closes. The window
+    opens with the first job waiting for the recipient, and later jobs join it
+    so they all go out as one digest.
+    
+    `media` lists the attachments sent after the text, as returned by
+    media_cache.store_attachment(). `headers` are kept for threading replies
+    and recorded with the conversation once the message is sent.
+    """
+    now = time.time()
+    with storage.immediate_transaction() as conn:
+        due = now
+        if digest_window > 0:
+            row = conn.execute('''
+                SELECT MIN(next_attempt_at) AS due FROM outbound_jobs
+                WHERE to_number = ? AND status = ? AND attempts = 0 AND next_attempt_at > ?
+            ''', (to_number, PENDING, now)).fetchone()
+            due = row['due'] if row['due'] is not None else now + digest_window
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO outbound_jobs
+                (account_id, message_id, thread_id, to_number, body, media, headers,
+                 status, next_attempt_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (account_id, message_id, thread_id, to_number, body, json.dumps(media) if media else None,
+              json.dumps(headers) if headers else None, PENDING, due, now, now))
+        return cursor.rowcount == 1
+
+def _batch(batch_id, jobs):
+    jobs = sorted(jobs, key=lambda job: (job['created_at'], job['account_id'], job['message_id']))
+    return {
+        'batch_id': batch_id,
+        'to_number': jobs[0]['to_number'],
+        'parts_sent': max(job['parts_sent'] for job in jobs),
+        'attempts': max(job['attempts'] for job in jobs),
+        'claimed_at': max(job['claimed_at'] or 0 for job in jobs),
+        'jobs': jobs,
+    }
+
+def claim_due(limit):
+    """Move due jobs to `sending`, grouped into per-recipient batches, and return the batches
+    
+    A batch that already sent some segments keeps its jobs so the digest is
+    rebuilt identically; other due jobs are grouped by recipient, at most
+    DIGEST_MAX_JOBS per batch.
+    """
+    now = time.time()
+    with storage.immediate_transaction() as conn:
+        rows = durable_queue.select_due(conn, 'outbound_jobs', limit, now)
+        
+        grouped = {}
+        fresh = {}
+        for row in rows:
+            job = dict(row)
+            if job['batch_id']:
+                grouped.setdefault(job['batch_id'], [])
+            else:
+                fresh.setdefault(job['to_number'], []).append(job)
+        
+        # Resumed batches are claimed whole, even past the limit
+        for batch_id in grouped:
+            grouped[batch_id] = [dict(row) for row in conn.execute('''
+                SELECT * FROM outbound_jobs WHERE batch_id = ? AND status = ?
+            ''', (batch_id, PENDING)).fetchall()]
+        
+        for jobs in fresh.values():
+            for start in range(0, len(jobs), DIGEST_MAX_JOBS):
+                grouped[uuid.uuid4().hex] = jobs[start:start + DIGEST_MAX_JOBS]
+        
+        batches = []
+        for batch_id, jobs in grouped.items():
+            if not jobs:
+                continue
+            for job in jobs:
+                job.update(status=SENDING, attempts=job['attempts'] + 1, claimed_at=now, batch_id=batch_id)
+            conn.executemany('''
+                UPDATE outbound_jobs
+                SET status = ?, attempts = ?, claimed_at = ?, batch_id = ?, updated_at = ?
+                WHERE account_id = ? AND message_id = ? AND to_number = ?
+            ''', [
+                (SENDING, job['attempts'], now, batch_id, now, job['account_id'], job['message_id'], job['to_number'])
+                for job in jobs
+            ])
+            batches.append(_batch(batch_id, jobs))
+    return batches
+
+def segments(batch):
+    """The messages a batch is delivered as, in order, as (body, attachment or None) pairs"""
+    parts = [(text, None) for text in formatter.segments_for([job['body'] for job in batch['jobs']])]
+    for job in batch['jobs']:
+        for attachment in json.loads(job.get('media') or '[]'):
+            parts.append((f"📎 {attachment['filename']}", attachment))
+    return parts
+
+def mark_part_sent(batch, parts_sent, twilio_sid):
+    """Record that the first `parts_sent` segments of a batch were accepted by Twilio"""
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.execute('''
+            UPDATE outbound_jobs SET parts_sent = ?, twilio_sid = ?, updated_at = ?
+            WHERE batch_id = ?
+        ''', (parts_sent, twilio_sid, now, batch['batch_id']))
+        conn.execute('''
+            INSERT INTO send_log (to_number, twilio_sid, sent_at) VALUES (?, ?, ?)
+        ''', (batch['to_number'], twilio_sid, now))
+        delivery_status.link(conn, twilio_sid, batch['to_number'], batch['jobs'], now)
+    batch['parts_sent'] = parts_sent
+
+def mark_sent(batch):
+    """Complete a batch once its last segment was sent"""
+    with storage.transaction() as conn:
+        conn.execute('''
+            UPDATE outbound_jobs SET status = ?, last_error = NULL, updated_at = ?
+            WHERE batch_id = ?
+        ''', (SENT, time.time(), batch['batch_id']))
+
+def mark_failed(batch, error, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Schedule a retry with exponential backoff, or dead-letter the batch"""
+    return durable_queue.mark_failed('outbound_jobs', 'batch_id = ?', (batch['batch_id'],), batch['attempts'],
+                                     error, max_attempts, BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS)
+
+def defer(batch, until):
+    """Put a batch back until `until` without counting it as a failed attempt"""
+    with storage.transaction() as conn:
+        conn.execute('''
+            UPDATE outbound_jobs
+            SET status = ?, attempts = MAX(0, attempts - 1), next_attempt_at = ?, updated_at = ?
+            WHERE batch_id = ?
+        ''', (PENDING, until, time.time(), batch['batch_id']))
+
+def recipient_sends(to_number, window=RECIPIENT_CAP_WINDOW_SECONDS):
+    """Messages sent to `to_number` within the window, and when the oldest of them was sent"""
+    row = storage.get_connection().execute('''
+        SELECT COUNT(*) AS total, MIN(sent_at) AS oldest FROM send_log
+        WHERE to_number = ? AND sent_at > ?
+    ''', (to_number, time.time() - window)).fetchone()
+    return row['total'], row['oldest']
+
+def recover_stale(find_sent_sid):
+    """Resolve batches stuck in `sending` after a crash
+    
+    `find_sent_sid(body, to_number, since)` must return the Twilio SID if that
+    message was in fact sent, or None. Segments go out one at a time, so only
+    the first unrecorded one can have been sent. Finished batches are
+    completed; the rest are released for retry.
+    """
+    cutoff = time.time() - SENDING_LEASE_SECONDS
+    rows = storage.get_connection().execute('''
+        SELECT * FROM outbound_jobs WHERE status = ? AND claimed_at < ?
+    ''', (SENDING, cutoff)).fetchall()
+    
+    # Claiming assigns the batch, so every job in `sending` has one
+    stale = {}
+    for row in rows:
+        stale.setdefault(row['batch_id'], []).append(dict(row))
+    
+    for batch_id, jobs in stale.items():
+        batch = _batch(batch_id, jobs)
+        parts = segments(batch)
+        if batch['parts_sent'] < len(parts):
+            body, _ = parts[batch['parts_sent']]
+            sid = find_sent_sid(body, batch['to_number'], batch['claimed_at'])
+            if sid:
+                mark_part_sent(batch, batch['parts_sent'] + 1, sid)
+        
+        with storage.transaction() as conn:
+            if batch['parts_sent'] >= len(parts):
+                conn.execute('''
+                    UPDATE outbound_jobs SET status = ?, updated_at = ?
+                    WHERE batch_id = ? AND status = ?
+                ''', (SENT, time.time(), batch_id, SENDING))
+            else:
+                durable_queue.release(conn, 'outbound_jobs', 'batch_id = ?', (batch_id,), time.time())
+    return len(stale)
+
+def referenced_media():
+    """Digests of the cached attachments that jobs not yet sent still have to deliver"""
+    rows = storage.get_connection().execute('''
+        SELECT media FROM outbound_jobs WHERE status IN (?, ?) AND media IS NOT NULL
+    ''', (PENDING, SENDING))
+    return {attachment['digest'] for row in rows for attachment in json.loads(row['media'])}
+
+def purge_sent():
+    """Drop sent jobs and send log entries past their retention windows"""
+    now = time.time()
+    with storage.transaction() as conn:
+        durable_queue.purge_sent(conn, 'outbound_jobs', SENT_RETENTION_SECONDS, now)
+        conn.execute('''
+            DELETE FROM send_log WHERE sent_at < ?
+        ''', (now - RECIPIENT_CAP_WINDOW_SECONDS,))
@@ -0,0 +1,186 @@
+"""
+Ledger of listed messages already found not to match the filters, or failing.
+
+Messages that do not match stay unread, so a replayed cycle or a full resync
+lists them again. Each one is recorded with the filter set it was judged
+against, and later cycles drop it before any Gmail call for as long as the
+current filters cannot match it either: every current keyword contains a
+keyword of the recorded set, and the current filter fields are among the
+recorded ones. Matching is by substring, so a message containing no
+"invoice" contains no "invoices" either. Removing keywords or fields keeps
+the ledger valid; adding unrelated ones re-evaluates the recorded messages.
+
+Message IDs are stored as 64-bit hashes in a WITHOUT ROWID table and looked
+up through an in-process front cache, so a cycle that lists only known
+messages costs no SQLite reads after the first.
+
+Messages that could not be processed are counted in `failed_messages`. A
+failure keeps the history cursor in place so the next cycle retries the
+message; after `message_max_failures` failed cycles the message is
+dead-lettered instead: later cycles skip it and the cursor moves on.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+import config
+import storage
+
+# Entries kept in the in-process front cache
+FRONT_SIZE = 100000
+
+# Hashes looked up per SQLite query
+LOOKUP_CHUNK_SIZE = 500
+
+# Retention default, overridable with the setting of the same name
+DEFAULT_RETENTION_DAYS = 30
+
+# Failed cycles before a message is dead-lettered, overridable with the setting of the same name
+DEFAULT_MAX_FAILURES = 5
+
+_lock = threading.Lock()
+_front = OrderedDict()
+_set_ids = {}
+_coverage = {}
+
+def _hash(message_id):
+    return int.from_bytes(hashlib.blake2b(message_id.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+def _remember(key, set_id):
+    _front[key] = set_id
+    _front.move_to_end(key)
+    while len(_front) > FRONT_SIZE:
+        _front.popitem(last=False)
+
+def _filter_set_id(filters, fields):
+    """ID of the filter set in `filter_sets`, registering it on first use"""
+    key = (tuple(filters), tuple(fields))
+    set_id = _set_ids.get(key)
+    if set_id is not None:
+        return set_id
+    
+    keywords = sorted({keyword.lower() for keyword in filters if keyword})
+    fingerprint = hashlib.sha256(json.dumps([keywords, sorted(fields)]).encode('utf-8')).hexdigest()
+    with storage.transaction() as conn:
+        conn.execute('''
+            INSERT OR IGNORE INTO filter_sets (fingerprint, keywords, fields, created_at) VALUES (?, ?, ?, ?)
+        ''', (fingerprint, json.dumps(keywords), json.dumps(sorted(fields)), time.time()))
+        set_id = conn.execute('SELECT id FROM filter_sets WHERE fingerprint = ?', (fingerprint,)).fetchone()[0]
+    with _lock:
+        _set_ids[key] = set_id
+    return set_id
+
+def _covers(set_id, filters, fields):
+    """Whether a message that did not match filter set `set_id` cannot match `filters` in `fields` either"""
+    key = (set_id, tuple(filters), tuple(fields))
+    covered = _coverage.get(key)
+    if covered is not None:
+        return covered
+    
+    row = storage.get_connection().execute(
+        'SELECT keywords, fields FROM filter_sets WHERE id = ?', (set_id,)
+    ).fetchone()
+    if row is None:
+        covered = False
+    else:
+        old_keywords = json.loads(row['keywords'])
+        covered = set(fields) <= set(json.loads(row['fields'])) and all(
+            any(old in keyword.lower() for old in old_keywords) for keyword in filters if keyword
+        )
+    with _lock:
+        _coverage[key] = covered
+    return covered
+
+def unevaluated(account_id, message_ids, filters, fields):
+    """The message IDs the current filters still have to be checked against, in order"""
+    keys = {message_id: (account_id, _hash(message_id)) for message_id in message_ids}
+    with _lock:
+        known = {key: _front[key] for key in keys.values() if key in _front}
+    
+    missing = [key[1] for key in keys.values() if key not in known]
+    if missing:
+        conn = storage.get_connection()
+        for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+            chunk = missing[start:start + LOOKUP_CHUNK_SIZE]
+            rows = conn.execute(f'''
+                SELECT id_hash, filter_set FROM evaluated_messages
+                WHERE account_id = ? AND id_hash IN ({','.join('?' * len(chunk))})
+            ''', (account_id, *chunk))
+            for row in rows:
+                known[(account_id, row['id_hash'])] = row['filter_set']
+        with _lock:
+            for key, set_id in known.items():
+                _remember(key, set_id)
+    
+    return [
+        message_id for message_id in message_ids
+        if keys[message_id] not in known or not _covers(known[keys[message_id]], filters, fields)
+    ]
+
+def record(account_id, message_ids, filters, fields):
+    """Record messages found not to match `filters` in `fields`"""
+    if not message_ids:
+        return
+    set_id = _filter_set_id(filters, fields)
+    now = time.time()
+    rows = [(account_id, _hash(message_id), set_id, now) for message_id in message_ids]
+    with storage.transaction() as conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO evaluated_messages (account_id, id_hash, filter_set, evaluated_at)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+    with _lock:
+        for account_id, id_hash, set_id, _ in rows:
+            _remember((account_id, id_hash), set_id)
+
+def record_failures(account_id, errors, snapshot=None):
+    """Count a failed cycle for each message in `errors` (message ID -> error); returns the IDs now dead-lettered"""
+    snapshot = snapshot or config.get_snapshot()
+    max_failures = snapshot.get_int('message_max_failures', DEFAULT_MAX_FAILURES)
+    now = time.time()
+    with storage.transaction() as conn:
+        conn.executemany('''
+            INSERT INTO failed_messages (account_id, message_id, failures, last_error, failed_at)
+            VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT (account_id, message_id) DO UPDATE SET
+                failures = failures + 1,
+                last_error = excluded.last_error,
+                failed_at = excluded.failed_at
+        ''', [(account_id, message_id, str(error), now) for message_id, error in errors.items()])
+        rows = conn.execute(f'''
+            SELECT message_id FROM failed_messages
+            WHERE account_id = ? AND failures >= ? AND message_id IN ({','.join('?' * len(errors))})
+        ''', (account_id, max_failures, *errors)).fetchall()
+    return {row['message_id'] for row in rows}
+
+def dead_letters(account_id, snapshot=None):
+    """IDs of the account's messages dead-lettered after repeated failures"""
+    snapshot = snapshot or config.get_snapshot()
+    max_failures = snapshot.get_int('message_max_failures', DEFAULT_MAX_FAILURES)
+    rows = storage.get_connection().execute('''
+        SELECT message_id FROM failed_messages WHERE account_id = ? AND failures >= ?
+    ''', (account_id, max_failures))
+    return {row['message_id'] for row in rows}
+
+def prune(snapshot=None):
+    """Forget entries older than ledger_retention_days and unused filter sets; returns the number removed"""
+    snapshot = snapshot or config.get_snapshot()
+    retention_days = snapshot.get_float('ledger_retention_days', DEFAULT_RETENTION_DAYS)
+    if retention_days <= 0:
+        return 0
+    with storage.transaction() as conn:
+        cutoff = time.time() - retention_days * 86400
+        removed = conn.execute('DELETE FROM evaluated_messages WHERE evaluated_at < ?', (cutoff,)).rowcount
+        # Dead-lettered messages are retried once their entry expires
+        removed += conn.execute('DELETE FROM failed_messages WHERE failed_at < ?', (cutoff,)).rowcount
+        conn.execute('''
+            DELETE FROM filter_sets
+            WHERE id NOT IN (SELECT DISTINCT filter_set FROM evaluated_messages)
+        ''')
+    # Removed sets may be registered again under a new ID
+    with _lock:
+        _set_ids.clear()
+        _coverage.clear()
+    return removed
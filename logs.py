@@ -0,0 +1,44 @@
+"""
+Structured JSON logging for the worker and the web app.
+
+Every record is written to stdout as one JSON object with a timestamp, level,
+logger name and process ID, plus any `extra` fields passed to the call, so log
+shippers can index them without parsing free text.
+"""
+
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_FIELDS = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+def configure():
+    """Send all logging to stdout as JSON; the level comes from LOG_LEVEL (default INFO)"""
+    root = logging.getLogger()
+    if any(isinstance(handler.formatter, JsonFormatter) for handler in root.handlers):
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    root.handlers[:] = [handler]
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    # Per-request discovery and connection chatter from the Google client
+    logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
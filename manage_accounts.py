@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Manage the Gmail accounts the worker forwards from and the routing of matches to recipients
+"""
+
+import argparse
+import accounts
+import config
+import gmail_auth
+import storage
+
+def list_accounts(args):
+    for account in accounts.get_accounts():
+        print(f"{account.id}\t{account.name}\t{account.email_address or '-'}\t{account.credentials_path}")
+    disabled = storage.get_connection().execute('SELECT id, name FROM accounts WHERE enabled = 0').fetchall()
+    for row in disabled:
+        print(f"{row['id']}\t{row['name']}\t(disabled)")
+
+def add_account(args):
+    with storage.transaction() as conn:
+        cursor = conn.execute('''
+            INSERT INTO accounts (name, email_address, credentials_path) VALUES (?, ?, ?)
+        ''', (args.name, args.email, args.credentials))
+    print(f"Added account {cursor.lastrowid}: {args.name}")
+    if args.authorize:
+        # The worker never runs the consent flow itself
+        gmail_auth.get_credentials(args.credentials, interactive=True)
+        print("Gmail authorization stored")
+
+def authorize_account(args):
+    account = accounts.get_account(args.id)
+    if account is None or not account.credentials_path:
+        raise SystemExit(f"No enabled account {args.id} with Gmail credentials")
+    # A valid stored token is kept; the consent flow only runs without one
+    gmail_auth.get_credentials(account.credentials_path, interactive=True)
+    print(f"Gmail authorization stored for account {account.id}")
+
+def set_enabled(args, enabled):
+    with storage.transaction() as conn:
+        conn.execute('UPDATE accounts SET enabled = ? WHERE id = ?', (1 if enabled else 0, args.id))
+    print(f"Account {args.id} {'enabled' if enabled else 'disabled'}")
+
+def list_routes(args):
+    for route in config.get_snapshot().routes:
+        account = route['account_id'] if route['account_id'] is not None else '*'
+        keyword = route['keyword'] if route['keyword'] is not None else '*'
+        print(f"{route['id']}\taccount {account}\tkeyword {keyword}\t-> {route['to_number']}")
+
+def add_route(args):
+    with storage.transaction() as conn:
+        cursor = conn.execute('''
+            INSERT INTO routing_rules (account_id, keyword, to_number) VALUES (?, ?, ?)
+        ''', (args.account, args.keyword, args.to))
+    print(f"Added routing rule {cursor.lastrowid}")
+
+def remove_route(args):
+    with storage.transaction() as conn:
+        conn.execute('DELETE FROM routing_rules WHERE id = ?', (args.id,))
+    print(f"Removed routing rule {args.id}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    commands.add_parser('list', help='List accounts (account 0 is the one on the settings page)')
+    
+    add = commands.add_parser('add', help='Add a Gmail account')
+    add.add_argument('--name', required=True, help='Unique account name')
+    add.add_argument('--credentials', required=True, help='Path to the OAuth client secrets JSON')
+    add.add_argument('--email', help='Mailbox address, used to route Gmail push notifications')
+    add.add_argument('--authorize', action='store_true', help='Run the Gmail consent flow now')
+    
+    authorize = commands.add_parser('authorize', help='Run the Gmail consent flow for an account and store its token')
+    authorize.add_argument('id', type=int)
+    
+    for name in ('enable', 'disable'):
+        toggle = commands.add_parser(name, help=f'{name.capitalize()} an account')
+        toggle.add_argument('id', type=int)
+    
+    commands.add_parser('routes', help='List routing rules')
+    
+    route = commands.add_parser('route', help='Route matches to a WhatsApp number')
+    route.add_argument('--to', required=True, help='Recipient WhatsApp number, e.g. +1234567890')
+    route.add_argument('--account', type=int, help='Only matches in this account (default: any)')
+    route.add_argument('--keyword', help='Only matches on this filter keyword (default: any)')
+    
+    unroute = commands.add_parser('unroute', help='Remove a routing rule')
+    unroute.add_argument('id', type=int)
+    
+    args = parser.parse_args()
+    storage.migrate()
+    
+    handlers = {
+        'list': list_accounts,
+        'add': add_account,
+        'authorize': authorize_account,
+        'enable': lambda a: set_enabled(a, True),
+        'disable': lambda a: set_enabled(a, False),
+        'routes': list_routes,
+        'route': add_route,
+        'unroute': remove_route,
+    }
+    handlers[args.command](args)
+
+if __name__ == '__main__':
+    main()
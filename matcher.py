@@ -0,0 +1,101 @@
+"""
+Compiled multi-keyword matcher for the email filters.
+
+Keywords are compiled once into an Aho-Corasick automaton, so each subject,
+sender or body is scanned in a single pass no matter how many keywords are
+configured. Matching is case-insensitive substring matching, the same as the
+original per-keyword loop.
+"""
+
+import threading
+from collections import deque
+
+# Email fields the filters can be applied to
+FILTER_FIELDS = ('subject', 'from', 'body')
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over a set of keywords"""
+    
+    def __init__(self, keywords):
+        self.keywords = tuple(keywords)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        
+        for keyword in self.keywords:
+            pattern = keyword.lower()
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[state][ch] = next_state
+                state = next_state
+            self._output[state] = self._output[state] + (keyword,)
+        
+        # Breadth-first pass to wire failure links and merge outputs along them
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+    
+    def _scan(self, text):
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                yield output[state]
+    
+    def find(self, text):
+        """Return the set of keywords found in `text`"""
+        hits = set()
+        if text:
+            for keywords in self._scan(text):
+                hits.update(keywords)
+        return hits
+    
+    def matches(self, text):
+        """Return True as soon as any keyword is found in `text`"""
+        if not text:
+            return False
+        for _ in self._scan(text):
+            return True
+        return False
+
+_lock = threading.Lock()
+_compiled = None
+
+def compile_filters(filters):
+    """Get the matcher for `filters`, compiling it only when the filters change"""
+    global _compiled
+    compiled = _compiled
+    # Identity check first: the config snapshot hands out the same tuple until filters change
+    if compiled is not None and (compiled.keywords is filters or compiled.keywords == tuple(filters)):
+        return compiled
+    with _lock:
+        if _compiled is None or _compiled.keywords != tuple(filters):
+            _compiled = KeywordMatcher(filters)
+        return _compiled
+
+def parse_filter_fields(value):
+    """Parse the comma-separated filter_fields setting, defaulting to the subject only"""
+    fields = [f.strip().lower() for f in (value or '').split(',')]
+    fields = [f for f in fields if f in FILTER_FIELDS]
+    return tuple(fields) or ('subject',)
@@ -0,0 +1,295 @@
+"""
+Content-addressed on-disk cache of email attachments forwarded as WhatsApp media.
+
+Attachments are streamed from the Gmail API in chunks: the base64url `data`
+field of the response is decoded as it arrives and written to a temporary
+file while it is hashed, so memory use does not grow with the attachment.
+The finished file is stored under its SHA-256, which makes re-ingesting the
+same email (or the same PDF attached to many) a cache hit. Files larger than
+`media_max_attachment_bytes` are never downloaded, and the least recently
+used files are evicted once the cache exceeds `media_cache_max_bytes`,
+except those that jobs not yet sent still reference. Each process keeps a
+running estimate of the cache size and only lists the directory when the
+estimate passes the limit, or every SIZE_RESCAN_SECONDS to count the files
+other worker processes stored.
+
+Twilio fetches the files from the web app's /media route through links
+signed with `media_signing_key` that expire after `media_url_ttl_seconds`.
+"""
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlencode
+from werkzeug.utils import secure_filename
+import config
+import gmail_auth
+import gmail_client
+import job_queue
+import metrics
+import storage
+
+log = logging.getLogger(__name__)
+
+# MEDIA_CACHE_DIR must point the worker and the web app at the same directory
+MEDIA_DIR = os.environ.get('MEDIA_CACHE_DIR', 'media_cache')
+
+# Limits, overridable with the settings of the same name; Twilio rejects WhatsApp media over 16 MB
+DEFAULT_MAX_ATTACHMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_URL_TTL_SECONDS = 24 * 3600
+
+# Settings key of the secret media links are signed with, generated on first use
+SIGNING_KEY_SETTING = 'media_signing_key'
+
+# Bytes read from the Gmail response at a time
+CHUNK_BYTES = 64 * 1024
+
+# Longest a process trusts its cache size estimate before listing the directory again
+SIZE_RESCAN_SECONDS = 600
+
+# The response fields before `data` are short; give up if it has not started by then
+MAX_HEADER_CHARS = 4096
+
+_DATA_FIELD = re.compile(r'"data"\s*:\s*"')
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+
+_size_lock = threading.Lock()
+_cache_bytes = None
+_scanned_at = 0.0
+
+class AttachmentTooLarge(Exception):
+    pass
+
+def path_for(digest):
+    return os.path.join(MEDIA_DIR, digest[:2], digest)
+
+def _decode_chunks(chunks):
+    """Decode base64url text arriving in arbitrary pieces, ending at the closing quote"""
+    pending = ''
+    for text in chunks:
+        end = text.find('"')
+        pending += text if end == -1 else text[:end]
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            yield base64.urlsafe_b64decode(pending[:usable])
+            pending = pending[usable:]
+        if end != -1:
+            break
+    if pending:
+        yield base64.urlsafe_b64decode(pending + '=' * (-len(pending) % 4))
+
+def _stream_data_field(raw_chunks):
+    """Decoded bytes of the `data` field of a streamed attachments.get response"""
+    raw_chunks = iter(raw_chunks)
+    head = ''
+    for raw in raw_chunks:
+        # The response is JSON of ASCII keys, digits and base64url, so latin-1 never splits a character
+        head += raw.decode('latin-1')
+        match = _DATA_FIELD.search(head)
+        if match:
+            break
+        if len(head) > MAX_HEADER_CHARS:
+            raise ValueError("Attachment response has no data field")
+    else:
+        raise ValueError("Attachment response has no data field")
+    
+    def texts():
+        yield head[match.end():]
+        for raw in raw_chunks:
+            yield raw.decode('latin-1')
+    
+    yield from _decode_chunks(texts())
+
+def _download(credentials_path, message_id, attachment_id):
+    session = gmail_auth.get_authorized_session(credentials_path)
+    url = gmail_auth.api_url(f'gmail/v1/users/me/messages/{quote(message_id)}/attachments/{quote(attachment_id)}')
+    # Budgeted like the client's own calls
+    gmail_client.get_client(credentials_path).acquire('gmail.users.messages.attachments.get')
+    with metrics.timed('gmail_request', method='attachments.get'):
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            yield from _stream_data_field(response.iter_content(CHUNK_BYTES))
+
+def _write(chunks, max_bytes):
+    """Write chunks to the cache under their SHA-256; returns (digest, size)"""
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.incoming-', dir=MEDIA_DIR)
+    try:
+        sha256 = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise AttachmentTooLarge(f"Attachment exceeds {max_bytes} bytes")
+                sha256.update(chunk)
+                f.write(chunk)
+        
+        digest = sha256.hexdigest()
+        path = path_for(digest)
+        if os.path.exists(path):
+            metrics.inc('attachments_cached_total', result='hit')
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            metrics.inc('attachments_cached_total', result='stored')
+            _add_size(size)
+        return digest, size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def store_attachment(credentials_path, message_id, part, snapshot=None):
+    """Cache one attachment part of a Gmail message
+    
+    Returns {'digest', 'filename', 'size'} for the queued job, or None when
+    the attachment is over the size limit or could not be downloaded; the
+    email is then forwarded without it.
+    """
+    snapshot = snapshot or config.get_snapshot()
+    max_bytes = snapshot.get_int('media_max_attachment_bytes', DEFAULT_MAX_ATTACHMENT_BYTES)
+    filename = secure_filename(part.get('filename', '')) or 'attachment'
+    body = part.get('body', {})
+    
+    if body.get('size', 0) > max_bytes:
+        metrics.inc('attachments_cached_total', result='too_large')
+        log.warning(f"Attachment {filename} of message {message_id} is over {max_bytes} bytes, not forwarding it")
+        return None
+    
+    try:
+        if 'attachmentId' in body:
+            chunks = _download(credentials_path, message_id, body['attachmentId'])
+        else:
+            # Small attachments come inline with the message
+            data = body.get('data', '')
+            chunks = _decode_chunks(data[i:i + CHUNK_BYTES] for i in range(0, len(data), CHUNK_BYTES))
+        digest, size = _write(chunks, max_bytes)
+    except AttachmentTooLarge as e:
+        metrics.inc('attachments_cached_total', result='too_large')
+        log.warning(f"Attachment {filename} of message {message_id} not forwarded: {e}")
+        return None
+    except gmail_client.CircuitOpenError:
+        # Gmail is down for the whole account, not just this file; the message is retried later
+        raise
+    except Exception as e:
+        # A download that failed must not hold back the email's text
+        metrics.inc('attachments_cached_total', result='error')
+        log.error(f"Attachment {filename} of message {message_id} not forwarded, download failed: {e}")
+        return None
+    
+    evict(snapshot)
+    return {'digest': digest, 'filename': filename, 'size': size}
+
+def _add_size(size):
+    global _cache_bytes
+    with _size_lock:
+        if _cache_bytes is not None:
+            _cache_bytes += size
+
+def _scan():
+    """(mtime, size, path) of every cached file, and their total size"""
+    files = []
+    total = 0
+    if os.path.isdir(MEDIA_DIR):
+        for shard in os.scandir(MEDIA_DIR):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process meanwhile
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    return files, total
+
+def evict(snapshot=None):
+    """Remove the least recently used files until the cache fits media_cache_max_bytes; returns the number removed"""
+    global _cache_bytes, _scanned_at
+    snapshot = snapshot or config.get_snapshot()
+    max_bytes = snapshot.get_int('media_cache_max_bytes', DEFAULT_CACHE_MAX_BYTES)
+    
+    with _size_lock:
+        if (_cache_bytes is not None and _cache_bytes <= max_bytes
+                and time.monotonic() - _scanned_at < SIZE_RESCAN_SECONDS):
+            return 0
+    
+    files, total = _scan()
+    removed = 0
+    if total > max_bytes:
+        # Files of queued jobs stay, even if that leaves the cache over its limit for now
+        referenced = job_queue.referenced_media()
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            if os.path.basename(path) in referenced:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        metrics.inc('media_cache_evictions_total', removed)
+        log.info(f"Evicted {removed} files from the media cache")
+    
+    with _size_lock:
+        _cache_bytes = total
+        _scanned_at = time.monotonic()
+    return removed
+
+def _signing_key():
+    key = config.get_setting(SIGNING_KEY_SETTING)
+    if not key:
+        with storage.transaction() as conn:
+            # Another process may have generated it first; everyone keeps the stored one
+            conn.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)',
+                         (SIGNING_KEY_SETTING, secrets.token_hex(32)))
+            key = conn.execute('SELECT value FROM settings WHERE key = ?', (SIGNING_KEY_SETTING,)).fetchone()[0]
+        config.invalidate()
+    return key.encode('utf-8')
+
+def _signature(digest, filename, expires):
+    message = f'{digest}/{filename}:{expires}'.encode('utf-8')
+    return hmac.new(_signing_key(), message, hashlib.sha256).hexdigest()
+
+def signed_url(attachment, snapshot=None):
+    """Public link Twilio downloads a cached attachment from, or None if the file is gone from the cache"""
+    snapshot = snapshot or config.get_snapshot()
+    base_url = snapshot.get('public_base_url')
+    if not base_url:
+        raise Exception("public_base_url is not configured")
+    ttl = snapshot.get_int('media_url_ttl_seconds', DEFAULT_URL_TTL_SECONDS)
+    
+    try:
+        # Counts as a use, so the file is not evicted before Twilio fetches it
+        os.utime(path_for(attachment['digest']))
+    except FileNotFoundError:
+        log.warning(f"Attachment {attachment['filename']} ({attachment['digest']}) is no longer cached")
+        return None
+    expires = int(time.time()) + ttl
+    query = urlencode({'expires': expires, 'sig': _signature(attachment['digest'], attachment['filename'], expires)})
+    return f"{base_url.rstrip('/')}/media/{attachment['digest']}/{quote(attachment['filename'])}?{query}"
+
+def verify(digest, filename, expires, signature):
+    """Path of the cached file a signed link points at, or None if the link is invalid or expired"""
+    if not _DIGEST.fullmatch(digest):
+        return None
+    try:
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, _signature(digest, filename, expires)):
+        return None
+    return path_for(digest)
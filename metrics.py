@@ -0,0 +1,169 @@
+"""
+Counters and latency histograms shared by the worker processes and the web app.
+
+Each process keeps its metrics in memory and a background thread writes them
+to the `metric_samples` table every FLUSH_INTERVAL_SECONDS, one row per series
+and process. /metrics sums the rows of all processes and renders them in the
+Prometheus text format, so one scrape of the web app covers the worker too.
+Values are cumulative per process; a restarted process starts a new set of
+rows, which Prometheus treats as an ordinary counter reset.
+"""
+
+import os
+import socket
+import threading
+import time
+from functools import wraps
+import storage
+from flusher import Flusher
+
+# Latency buckets in seconds, from fast SQLite writes to slow Gmail batches
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+FLUSH_INTERVAL_SECONDS = 10
+
+# Rows of processes that stopped flushing are dropped after this long
+RETENTION_SECONDS = 7 * 24 * 3600
+
+# Metric name -> (type, help); series of unlisted names are rendered untyped
+METRICS = {
+    'gmail_request_duration_seconds': ('histogram', 'Gmail API call latency by method'),
+    'gmail_request_errors_total': ('counter', 'Gmail API calls that raised, by method'),
+    'gmail_quota_units_total': ('counter', 'Gmail quota units spent, by method'),
+    'gmail_retries_total': ('counter', 'Gmail calls retried after rate limiting or server errors, by method'),
+    'gmail_breaker_opened_total': ('counter', 'Times repeated Gmail failures paused ingestion'),
+    'twilio_request_duration_seconds': ('histogram', 'Twilio API call latency by method'),
+    'twilio_request_errors_total': ('counter', 'Twilio API calls that raised, by method'),
+    'sqlite_transaction_duration_seconds': ('histogram', 'SQLite write transaction latency, including lock waits'),
+    'sqlite_transaction_errors_total': ('counter', 'SQLite write transactions rolled back'),
+    'filter_match_duration_seconds': ('histogram', 'Time to match one message against the filter keywords'),
+    'filter_match_errors_total': ('counter', 'Filter matching failures'),
+    'http_request_duration_seconds': ('histogram', 'Web request latency by endpoint'),
+    'http_requests_total': ('counter', 'Web requests by endpoint and status code'),
+    'worker_cycles_total': ('counter', 'Gmail sync cycles by account and result'),
+    'emails_matched_total': ('counter', 'Emails that matched the filters'),
+    'emails_skipped_total': ('counter', 'Listed emails skipped because the ledger shows they cannot match'),
+    'whatsapp_messages_sent_total': ('counter', 'WhatsApp messages accepted by Twilio'),
+    'whatsapp_send_failures_total': ('counter', 'Failed WhatsApp deliveries by resulting job status'),
+    'gmail_replies_sent_total': ('counter', 'WhatsApp replies delivered to Gmail'),
+    'attachments_cached_total': ('counter', 'Attachments stored in, found in or too large for the media cache'),
+    'media_cache_evictions_total': ('counter', 'Files evicted from the media cache'),
+    'message_status_callbacks_total': ('counter', 'Twilio status callbacks received, by reported status'),
+    'message_status_flush_duration_seconds': ('histogram', 'Time to write buffered message statuses to the database'),
+    'message_status_flush_errors_total': ('counter', 'Failed writes of buffered message statuses'),
+}
+
+_lock = threading.Lock()
+_values = {}
+
+def _label_string(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    # `le` goes last so histogram buckets sort by it
+    ordered = sorted(labels.items(), key=lambda item: (item[0] == 'le', item[0]))
+    return ','.join(f'{key}="{escape(value)}"' for key, value in ordered)
+
+def _add(series, labels, amount):
+    key = (series, _label_string(labels))
+    # Before buffering: in a forked child, starting the flusher drops the parent's buffer
+    _flusher.ensure_started()
+    with _lock:
+        _values[key] = _values.get(key, 0.0) + amount
+
+def inc(name, amount=1, **labels):
+    """Increment a counter"""
+    _add(name, labels, amount)
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Record one observation in a histogram"""
+    for bound in buckets:
+        if value <= bound:
+            _add(f'{name}_bucket', dict(labels, le=repr(float(bound))), 1)
+    _add(f'{name}_bucket', dict(labels, le='+Inf'), 1)
+    _add(f'{name}_sum', labels, value)
+    _add(f'{name}_count', labels, 1)
+
+class timed:
+    """Time a block (or function) into `<metric>_duration_seconds`, counting exceptions in `<metric>_errors_total`"""
+    
+    def __init__(self, metric, **labels):
+        self.metric = metric
+        self.labels = labels
+    
+    def __call__(self, fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            # A fresh timer per call: the function may run in several threads at once, or recursively
+            with timed(self.metric, **self.labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        observe(f'{self.metric}_duration_seconds', time.perf_counter() - self._started, **self.labels)
+        if exc_type is not None:
+            inc(f'{self.metric}_errors_total', **self.labels)
+        return False
+
+def _process_key():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def flush():
+    """Write this process's metrics to the database"""
+    with _lock:
+        values = dict(_values)
+    if not values:
+        return
+    now = time.time()
+    process = _process_key()
+    # Not storage.transaction(): that is itself instrumented
+    conn = storage.get_connection()
+    with conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO metric_samples (process, series, labels, value, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(process, series, labels, value, now) for (series, labels), value in values.items()])
+        conn.execute('DELETE FROM metric_samples WHERE updated_at < ?', (now - RETENTION_SECONDS,))
+
+# Forked children drop the parent's values: they are not theirs to report
+_flusher = Flusher('metrics', flush, FLUSH_INTERVAL_SECONDS, on_fork=_values.clear)
+
+def _base_name(series):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if series.endswith(suffix) and series[:-len(suffix)] in METRICS:
+            return series[:-len(suffix)]
+    return series
+
+def _sort_key(row):
+    # Buckets of one series in increasing `le` order, +Inf last
+    labels, _, le = row['labels'].rpartition('le="')
+    if row['series'].endswith('_bucket') and le:
+        bound = le.rstrip('"')
+        return (labels, row['series'], float('inf') if bound == '+Inf' else float(bound))
+    return (row['labels'], row['series'], 0.0)
+
+def render():
+    """All processes' metrics in the Prometheus text exposition format"""
+    flush()
+    rows = storage.get_connection().execute('''
+        SELECT series, labels, SUM(value) AS value FROM metric_samples
+        GROUP BY series, labels
+    ''').fetchall()
+    
+    families = {}
+    for row in rows:
+        families.setdefault(_base_name(row['series']), []).append(row)
+    
+    lines = []
+    for name in sorted(families):
+        if name in METRICS:
+            kind, help_text = METRICS[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+        for row in sorted(families[name], key=_sort_key):
+            labels = f"{{{row['labels']}}}" if row['labels'] else ''
+            lines.append(f"{row['series']}{labels} {row['value']!r}")
+    return '\n'.join(lines) + '\n'
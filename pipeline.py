@@ -0,0 +1,604 @@
+"""
+asyncio pipeline engine for the worker.
+
+Each stage runs as its own task and hands work to the next through a bounded
+queue, so a slow Gmail or Twilio call for one message overlaps with work on
+others and a slow stage applies backpressure upstream:
+
+    list -> fetch -> filter -> send -> ack
+
+The fetch stage downloads headers only; the filter stage downloads the full
+message just for candidates that matched (or need their body checked).
+
+Blocking Gmail, Twilio and SQLite calls run in worker threads. A cycle marker
+follows each cycle's messages through every stage; when it reaches the ack
+stage the history cursor is committed, provided no Gmail call failed outright
+and every message that failed has been dead-lettered by the ledger after
+repeated failures.
+Each worker process runs one pipeline per Gmail account it holds a lease
+for. The process holding the delivery role also runs the deliverer: it sends
+queued WhatsApp jobs, and replies queued by the webhook in a separate task so
+they never wait behind ingestion. Only one process sends at a time, so the
+Twilio rate limit and per-recipient caps hold across the pool; the others
+wake it when they queue a job. On SIGTERM/SIGINT the list stages stop, a stop
+sentinel drains the queues and the deliverer makes a final pass.
+"""
+
+import logging
+import asyncio
+import signal
+import time
+import accounts
+import config
+import conversations
+import delivery_status
+import ledger
+import matcher
+import metrics
+import routing
+import scheduler
+import state
+import wakeup
+import worker
+
+log = logging.getLogger(__name__)
+
+# Default capacity of each inter-stage queue
+DEFAULT_QUEUE_SIZE = 100
+
+# Seconds the ack stage waits for more IDs before flushing a partial batchModify
+ACK_LINGER_SECONDS = 1.0
+
+# Seconds between checks that the Gmail push watch is still active
+WATCH_CHECK_INTERVAL = 3600
+
+# Runtime state key exposing when the worker will next poll Gmail (Unix time)
+NEXT_POLL_KEY = 'worker_next_poll_at'
+
+# Seconds between conversation_map retention passes
+RETENTION_INTERVAL_SECONDS = 3600
+
+# Marks the end of the stream; stages forward it downstream and exit
+STOP = object()
+
+class Cycle:
+    """Per-cycle state shared by the items of one list pass"""
+    
+    def __init__(self, next_cursor, target_whatsapp_number, filters, filter_fields):
+        self.next_cursor = next_cursor
+        self.target_whatsapp_number = target_whatsapp_number
+        self.filters = filters
+        self.filter_fields = filter_fields
+        self.ok = True
+        # Message ID -> error, for messages that failed on their own
+        self.failed = {}
+        self.matches = 0
+        self.done = asyncio.Event()
+
+class CycleEnd:
+    """Travels behind a cycle's last item so the ack stage knows the cycle is complete"""
+    
+    def __init__(self, cycle):
+        self.cycle = cycle
+
+class Pipeline:
+    """Bounded-queue ingestion stages for one account, run together by run()"""
+    
+    def __init__(self, account, on_queued=None, queue_size=DEFAULT_QUEUE_SIZE, poll_scheduler=None):
+        self.account = account
+        self.on_queued = on_queued or (lambda: None)
+        self.scheduler = poll_scheduler or scheduler.PollScheduler()
+        self.fetch_queue = asyncio.Queue(maxsize=queue_size)
+        self.filter_queue = asyncio.Queue(maxsize=queue_size)
+        self.send_queue = asyncio.Queue(maxsize=queue_size)
+        self.ack_queue = asyncio.Queue(maxsize=queue_size)
+        self.stopping = asyncio.Event()
+        self.wakeup = asyncio.Event()
+    
+    def stop(self):
+        log.info(f"Shutting down pipeline for {self.account.name}, draining queues...")
+        self.stopping.set()
+        self.wakeup.set()
+    
+    async def _sleep_until_next_cycle(self, cycle):
+        if cycle is not None:
+            # Let the cycle drain so the scheduler knows whether it found anything
+            await cycle.done.wait()
+        
+        self.scheduler.configure_from(config.get_snapshot())
+        self.scheduler.record_cycle(cycle.matches if cycle else 0)
+        delay = self.scheduler.next_delay()
+        log.info(f"Next Gmail check for {self.account.name} in {delay:.0f} seconds")
+        try:
+            await asyncio.to_thread(state.put, self.account.key(NEXT_POLL_KEY),
+                                    str(int(self.scheduler.next_wake_at)))
+        except Exception as e:
+            log.error(f"Error recording next poll time: {e}")
+        
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+    
+    async def list_stage(self):
+        while not self.stopping.is_set():
+            cycle = await self._list_once()
+            if not self.stopping.is_set():
+                await self._sleep_until_next_cycle(cycle)
+        await self.fetch_queue.put(STOP)
+    
+    async def _list_once(self):
+        try:
+            return await self._list_cycle()
+        except Exception as e:
+            log.error(f"Error in list stage: {e}")
+            worker.record_failed_cycle(self.account)
+            return None
+    
+    async def _list_cycle(self):
+        snapshot = config.get_snapshot()
+        target_whatsapp_number = snapshot.get('target_whatsapp_number')
+        filters = snapshot.filters
+        
+        if not routing.has_recipients(self.account.id, target_whatsapp_number, snapshot):
+            log.warning("Target WhatsApp number not configured")
+            await asyncio.to_thread(worker.record_idle_cycle, self.account)
+            return
+        
+        if not filters:
+            log.warning("No filter keywords configured")
+            await asyncio.to_thread(worker.record_idle_cycle, self.account)
+            return
+        
+        service = await asyncio.to_thread(worker.get_gmail_service, self.account)
+        message_ids, next_cursor = await asyncio.to_thread(worker.list_new_message_ids, service, self.account)
+        
+        cycle = Cycle(next_cursor, target_whatsapp_number, filters,
+                      matcher.parse_filter_fields(snapshot.get('filter_fields')))
+        if message_ids:
+            log.info(f"Found {len(message_ids)} new unread messages in {self.account.name}")
+            message_ids = await asyncio.to_thread(
+                worker.skip_evaluated, self.account, message_ids, filters, cycle.filter_fields
+            )
+        for start in range(0, len(message_ids), worker.GMAIL_BATCH_SIZE):
+            await self.fetch_queue.put((cycle, message_ids[start:start + worker.GMAIL_BATCH_SIZE]))
+        await self.fetch_queue.put(CycleEnd(cycle))
+        return cycle
+    
+    async def fetch_stage(self):
+        while True:
+            item = await self.fetch_queue.get()
+            if item is STOP or isinstance(item, CycleEnd):
+                await self.filter_queue.put(item)
+                if item is STOP:
+                    return
+                continue
+            
+            cycle, message_ids = item
+            try:
+                service = await asyncio.to_thread(worker.get_gmail_service, self.account)
+                # Headers only; the filter stage downloads full bodies for candidates
+                fetched, failures = await asyncio.to_thread(
+                    worker.fetch_messages, service, message_ids,
+                    format='metadata', metadata_headers=worker.METADATA_HEADERS
+                )
+            except Exception as e:
+                cycle.ok = False
+                log.error(f"Error fetching messages: {e}")
+                continue
+            
+            for message_id, error in failures.items():
+                if not worker.is_deleted_message_error(error):
+                    cycle.failed[message_id] = error
+                    log.error(f"Error fetching message {message_id}: {error}")
+            
+            await self.filter_queue.put((cycle, [fetched[i] for i in message_ids if i in fetched]))
+    
+    async def filter_stage(self):
+        while True:
+            item = await self.filter_queue.get()
+            if item is STOP or isinstance(item, CycleEnd):
+                await self.send_queue.put(item)
+                if item is STOP:
+                    return
+                continue
+            
+            cycle, messages = item
+            candidates = []
+            unmatched = []
+            for msg in messages:
+                try:
+                    if worker.screen_message(msg, cycle.filters, cycle.filter_fields) is not False:
+                        candidates.append(msg['id'])
+                    elif 'UNREAD' in msg.get('labelIds', []):
+                        unmatched.append(msg['id'])
+                except Exception as e:
+                    cycle.failed[msg['id']] = e
+                    log.error(f"Error processing message {msg['id']}: {e}")
+            await self._record_unmatched(cycle, unmatched)
+            
+            if not candidates:
+                continue
+            
+            try:
+                service = await asyncio.to_thread(worker.get_gmail_service, self.account)
+                fetched, failures = await asyncio.to_thread(worker.fetch_messages, service, candidates)
+            except Exception as e:
+                cycle.ok = False
+                log.error(f"Error fetching messages: {e}")
+                continue
+            
+            for message_id, error in failures.items():
+                if not worker.is_deleted_message_error(error):
+                    cycle.failed[message_id] = error
+                    log.error(f"Error fetching message {message_id}: {error}")
+            
+            unmatched = []
+            for message_id in candidates:
+                msg = fetched.get(message_id)
+                if msg is None:
+                    continue
+                try:
+                    match = worker.evaluate_message(msg, cycle.filters, cycle.filter_fields)
+                except Exception as e:
+                    cycle.failed[message_id] = e
+                    log.error(f"Error processing message {message_id}: {e}")
+                    continue
+                if match:
+                    cycle.matches += 1
+                    await self.send_queue.put((cycle, match))
+                elif 'UNREAD' in msg.get('labelIds', []):
+                    unmatched.append(message_id)
+            await self._record_unmatched(cycle, unmatched)
+    
+    async def _record_unmatched(self, cycle, message_ids):
+        if not message_ids:
+            return
+        try:
+            await asyncio.to_thread(ledger.record, self.account.id, message_ids, cycle.filters, cycle.filter_fields)
+        except Exception as e:
+            # Only costs a re-check of these messages if they are listed again
+            log.error(f"Error recording evaluated messages: {e}")
+    
+    async def send_stage(self):
+        while True:
+            item = await self.send_queue.get()
+            if item is STOP or isinstance(item, CycleEnd):
+                await self.ack_queue.put(item)
+                if item is STOP:
+                    return
+                continue
+            
+            cycle, match = item
+            try:
+                queued_ids = await asyncio.to_thread(
+                    worker.queue_matches, [match], cycle.target_whatsapp_number, self.account
+                )
+            except Exception as e:
+                cycle.failed[match[0]] = e
+                log.error(f"Error queueing message {match[0]}: {e}")
+                continue
+            
+            # Queued durably: ack right away and let the delivery task send it
+            self.on_queued()
+            for message_id in queued_ids:
+                await self.ack_queue.put((cycle, message_id))
+    
+    async def ack_stage(self):
+        pending = []
+        while True:
+            try:
+                item = await asyncio.wait_for(self.ack_queue.get(), timeout=ACK_LINGER_SECONDS)
+            except asyncio.TimeoutError:
+                await self._flush_acks(pending)
+                continue
+            
+            if item is STOP:
+                await self._flush_acks(pending)
+                return
+            
+            if isinstance(item, CycleEnd):
+                await self._flush_acks(pending)
+                try:
+                    retrying = await self._settle_failures(item.cycle)
+                    if item.cycle.ok and not retrying:
+                        await asyncio.to_thread(worker.commit_cycle, self.account, item.cycle.next_cursor)
+                    else:
+                        worker.record_failed_cycle(self.account)
+                except Exception as e:
+                    # The cursor stays where it was, so the next cycle replays this one
+                    item.cycle.ok = False
+                    log.error(f"Error committing cycle for {self.account.name}: {e}")
+                    worker.record_failed_cycle(self.account)
+                finally:
+                    # The list stage waits on this before scheduling the next cycle
+                    item.cycle.done.set()
+                continue
+            
+            cycle, message_id = item
+            pending.append(message_id)
+            if len(pending) >= worker.GMAIL_BATCH_MODIFY_SIZE:
+                await self._flush_acks(pending)
+    
+    async def _settle_failures(self, cycle):
+        """Count the cycle's failed messages in the ledger; returns those still to be retried"""
+        if not cycle.failed:
+            return set()
+        dead = await asyncio.to_thread(ledger.record_failures, self.account.id, cycle.failed)
+        for message_id in dead:
+            log.error(f"Giving up on message {message_id} in {self.account.name} after repeated failures: "
+                      f"{cycle.failed[message_id]}")
+        if dead:
+            metrics.inc('messages_dead_lettered_total', len(dead), account=self.account.name)
+        return set(cycle.failed) - dead
+    
+    async def _flush_acks(self, pending):
+        if not pending:
+            return
+        message_ids = list(pending)
+        pending.clear()
+        try:
+            service = await asyncio.to_thread(worker.get_gmail_service, self.account)
+            failures = await asyncio.to_thread(worker.mark_emails_as_read, service, message_ids)
+        except Exception as e:
+            log.error(f"Error marking emails as read: {e}")
+            return
+        for message_id, error in failures.items():
+            log.error(f"Error marking email {message_id} as read: {error}")
+    
+    async def watch_task(self):
+        """Keeps the Gmail push watch alive so notifications keep waking the list stage"""
+        while not self.stopping.is_set():
+            try:
+                service = await asyncio.to_thread(worker.get_gmail_service, self.account)
+                await asyncio.to_thread(worker.ensure_gmail_watch, service, self.account)
+            except Exception as e:
+                log.error(f"Error renewing Gmail push watch: {e}")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=WATCH_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def run(self):
+        tasks = [asyncio.create_task(stage) for stage in (
+            self.list_stage(),
+            self.fetch_stage(),
+            self.filter_stage(),
+            self.send_stage(),
+            self.ack_stage(),
+            self.watch_task(),
+        )]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # A stage that died must not leave the others blocked on its queue
+            for task in tasks:
+                task.cancel()
+        log.info(f"Pipeline for {self.account.name} stopped")
+    
+    async def run_once(self):
+        """Run a single list pass through the stages, returning once it has been acked"""
+        stages = asyncio.gather(self.fetch_stage(), self.filter_stage(), self.send_stage(), self.ack_stage())
+        try:
+            await self._list_once()
+        finally:
+            await self.fetch_queue.put(STOP)
+            await stages
+
+class Deliverer:
+    """Sends queued WhatsApp jobs and Gmail replies while this process holds the delivery role"""
+    
+    def __init__(self):
+        self.deliver = asyncio.Event()
+        self.replies = asyncio.Event()
+        self.finishing = asyncio.Event()
+        # Until when the delivery role lease is known to be ours (Unix time)
+        self.lease_until = 0.0
+    
+    def active(self):
+        return time.time() < self.lease_until
+    
+    def notify_queued(self):
+        if self.active():
+            self.deliver.set()
+        else:
+            wakeup.notify_queued()
+    
+    def finish(self):
+        """Make a final delivery pass, then stop"""
+        self.finishing.set()
+        self.deliver.set()
+        self.replies.set()
+    
+    def _interval(self):
+        return config.get_snapshot().get_float('poll_min_interval_seconds', scheduler.DEFAULT_MIN_INTERVAL)
+    
+    async def delivery_task(self):
+        """Runs deliver_pending_jobs whenever new jobs are queued, and periodically for retries"""
+        while True:
+            try:
+                await asyncio.wait_for(self.deliver.wait(), timeout=self._interval())
+            except asyncio.TimeoutError:
+                pass
+            self.deliver.clear()
+            # Checked before delivering so the final pass includes everything the pipelines queued
+            finished = self.finishing.is_set()
+            if self.active():
+                await asyncio.to_thread(worker.deliver_pending_jobs)
+            if finished:
+                return
+    
+    async def reply_task(self):
+        """Sends WhatsApp replies queued by the webhook to Gmail as soon as they arrive"""
+        while not self.finishing.is_set():
+            try:
+                await asyncio.wait_for(self.replies.wait(), timeout=self._interval())
+            except asyncio.TimeoutError:
+                pass
+            self.replies.clear()
+            if self.active():
+                await asyncio.to_thread(worker.deliver_pending_replies)
+    
+    async def run(self):
+        await asyncio.gather(self.delivery_task(), self.reply_task())
+
+class WorkerProcess:
+    """Runs a pipeline for each account leased to this process, plus the shared deliverer"""
+    
+    def __init__(self, slot=0):
+        self.slot = slot
+        self.owner = accounts.owner_id()
+        self.deliverer = Deliverer()
+        self.pipelines = {}
+        self._retired = []
+        self.stopping = asyncio.Event()
+    
+    def stop(self):
+        log.info("Shutting down worker process, draining pipelines...")
+        self.stopping.set()
+    
+    def _start_pipeline(self, account):
+        snapshot = config.get_snapshot()
+        poll_scheduler = scheduler.PollScheduler()
+        poll_scheduler.configure_from(snapshot)
+        pipeline = Pipeline(
+            account,
+            on_queued=self.deliverer.notify_queued,
+            queue_size=snapshot.get_int('pipeline_queue_size', DEFAULT_QUEUE_SIZE),
+            poll_scheduler=poll_scheduler,
+        )
+        log.info(f"Starting pipeline for account {account.name}")
+        self.pipelines[account.id] = (pipeline, asyncio.create_task(pipeline.run()))
+    
+    async def lease_task(self):
+        """Keeps this process's share of accounts running as leases move between processes"""
+        while not self.stopping.is_set():
+            try:
+                available = {account.id: account for account in await asyncio.to_thread(accounts.get_accounts)}
+                owned = await asyncio.to_thread(accounts.sync_leases, self.owner, list(available))
+            except Exception as e:
+                log.error(f"Error renewing account leases: {e}")
+                owned = None
+            await self._renew_delivery_role()
+            
+            self._retired = [task for task in self._retired if not task.done()]
+            if owned is not None:
+                for account_id, (pipeline, task) in list(self.pipelines.items()):
+                    if account_id not in owned or task.done():
+                        if task.done() and not task.cancelled() and task.exception():
+                            log.error(f"Pipeline for {pipeline.account.name} failed, restarting it: {task.exception()!r}")
+                        pipeline.stop()
+                        del self.pipelines[account_id]
+                        self._retired.append(task)
+                for account_id in owned:
+                    if account_id not in self.pipelines:
+                        self._start_pipeline(available[account_id])
+            
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=accounts.LEASE_RENEW_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        
+        for pipeline, task in self.pipelines.values():
+            pipeline.stop()
+        await asyncio.gather(*(task for _, task in self.pipelines.values()), *self._retired,
+                             return_exceptions=True)
+        self.deliverer.finish()
+    
+    async def _renew_delivery_role(self):
+        # Counted from before the renewal, so this process never believes it holds the role longer than it does
+        lease_until = time.time() + accounts.LEASE_SECONDS
+        try:
+            held = await asyncio.to_thread(accounts.hold_role, self.owner, accounts.DELIVERY_ROLE)
+        except Exception as e:
+            # Keep delivering until the current lease runs out; another process takes over after that
+            log.error(f"Error renewing the delivery role: {e}")
+            return
+        if held and not self.deliverer.active():
+            log.info("This process now delivers WhatsApp messages and Gmail replies")
+            # Catch up on jobs queued while no process was delivering
+            self.deliverer.deliver.set()
+            self.deliverer.replies.set()
+        self.deliverer.lease_until = lease_until if held else 0.0
+    
+    async def retention_task(self):
+        """Archives conversation mappings past conversation_ttl_days and prunes the ledger and message statuses"""
+        while not self.stopping.is_set():
+            try:
+                archived = await asyncio.to_thread(conversations.expire_stale)
+                if archived:
+                    log.info(f"Archived {archived} expired conversation mappings")
+            except Exception as e:
+                log.error(f"Error archiving conversation mappings: {e}")
+            try:
+                pruned = await asyncio.to_thread(ledger.prune)
+                if pruned:
+                    log.info(f"Pruned {pruned} evaluated-message ledger entries")
+            except Exception as e:
+                log.error(f"Error pruning the evaluated-message ledger: {e}")
+            try:
+                pruned = await asyncio.to_thread(delivery_status.prune)
+                if pruned:
+                    log.info(f"Pruned {pruned} WhatsApp message statuses")
+            except Exception as e:
+                log.error(f"Error pruning WhatsApp message statuses: {e}")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=RETENTION_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    
+    def _on_wakeup(self, payload):
+        if payload == wakeup.REPLY_SIGNAL:
+            self.deliverer.replies.set()
+            return
+        if payload == wakeup.DELIVER_SIGNAL:
+            self.deliverer.deliver.set()
+            return
+        
+        history_id, email_address = wakeup.parse(payload)
+        log.info(f"Woken by Gmail push notification for {email_address} (historyId {history_id})")
+        pipelines = [pipeline for pipeline, _ in self.pipelines.values()]
+        # Notifications name the mailbox; wake every pipeline if no account claims it
+        targets = [
+            pipeline for pipeline in pipelines
+            if email_address and (pipeline.account.email_address or '').lower() == email_address.lower()
+        ]
+        for pipeline in targets or pipelines:
+            pipeline.wakeup.set()
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers are unavailable on Windows and outside the main thread
+                pass
+        
+        # Push notifications and queued replies relayed by the web app start work immediately
+        listener = await wakeup.listen(self._on_wakeup, self.slot)
+        
+        await asyncio.gather(self.lease_task(), self.deliverer.run(), self.retention_task())
+        try:
+            # After the deliverer's final pass, so no other process starts delivering alongside it
+            await asyncio.to_thread(accounts.release_leases, self.owner)
+        except Exception as e:
+            # The leases expire on their own; other processes take the accounts over then
+            log.error(f"Error releasing leases: {e}")
+        if listener is not None:
+            listener.close()
+        log.info("Worker process stopped")
+
+def run(slot=0):
+    """Run a worker process until SIGTERM or SIGINT"""
+    asyncio.run(WorkerProcess(slot).run())
+
+async def _run_cycles():
+    await asyncio.gather(*(Pipeline(account).run_once() for account in accounts.get_accounts()))
+
+def run_once():
+    """One cycle of every account's pipeline, between a reply and a job delivery pass; no leases or scheduling"""
+    worker.deliver_pending_replies()
+    asyncio.run(_run_cycles())
+    worker.deliver_pending_jobs()
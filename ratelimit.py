@@ -0,0 +1,69 @@
+"""
+Rate limiting and retry pacing shared by the Twilio sender and the Gmail client.
+"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+class TokenBucket:
+    """Thread-safe token bucket handing out `rate` tokens per second
+    
+    A request for more tokens than the bucket holds is granted once the
+    bucket is full and leaves it in debt, so large calls are paced instead of
+    blocking forever. `reserve` keeps that many tokens back from a caller, so
+    callers acquiring without a reserve go first when tokens are short.
+    """
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def acquire(self, tokens=1, reserve=0):
+        """Block until `tokens` are available and take them"""
+        needed = min(tokens + reserve, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                else:
+                    wait = (needed - self._tokens) / self.rate
+            time.sleep(wait)
+    
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a 429"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+def parse_retry_after(value):
+    """Retry-After is either delta-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(retry_after, attempt, base, cap):
+    """Seconds to wait before retrying: the Retry-After value if there is one, else capped backoff with jitter"""
+    delay = parse_retry_after(retry_after)
+    if delay is None:
+        delay = min(cap, base * (2 ** attempt))
+        delay += random.uniform(0, delay / 2)
+    return delay
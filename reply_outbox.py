@@ -0,0 +1,75 @@
+"""
+Durable outbox for WhatsApp replies waiting to be sent to Gmail.
+
+The Twilio webhook only validates the request, stores the reply here and
+answers straight away; the worker delivers replies to Gmail in the background.
+Rows are keyed by Twilio's MessageSid, so a webhook retried by Twilio is stored
+once. Replies move through pending -> sending -> sent, with failed sends going
+back to pending with exponential backoff until they end in the dead state;
+the shared bookkeeping lives in durable_queue.
+"""
+
+import time
+import durable_queue
+import storage
+from durable_queue import PENDING, SENDING, SENT, DEAD
+
+DEFAULT_MAX_ATTEMPTS = 5
+
+# Backoff between retries, see durable_queue.retry_schedule
+BACKOFF_BASE_SECONDS = 15
+BACKOFF_MAX_SECONDS = 1800
+
+# A reply still `sending` after this long belongs to a process that died mid-send
+SENDING_LEASE_SECONDS = 300
+
+# Sent replies are kept this long so webhook retries are still deduplicated
+SENT_RETENTION_SECONDS = 7 * 24 * 3600
+
+def enqueue(message_sid, account_id, from_number, thread_id, body):
+    """Store a reply; returns False if this Twilio message was already stored"""
+    now = time.time()
+    with storage.transaction() as conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO reply_outbox
+                (message_sid, account_id, from_number, thread_id, body, status, next_attempt_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (message_sid, account_id, from_number, thread_id, body, PENDING, now, now, now))
+        return cursor.rowcount == 1
+
+def claim_due(limit):
+    """Move up to `limit` due replies to `sending` and return them"""
+    now = time.time()
+    with storage.immediate_transaction() as conn:
+        replies = durable_queue.select_due(conn, 'reply_outbox', limit, now)
+        conn.executemany('''
+            UPDATE reply_outbox
+            SET status = ?, attempts = attempts + 1, claimed_at = ?, updated_at = ?
+            WHERE message_sid = ?
+        ''', [(SENDING, now, now, reply['message_sid']) for reply in replies])
+    return [dict(reply, status=SENDING, attempts=reply['attempts'] + 1, claimed_at=now) for reply in replies]
+
+def mark_sent(message_sid, gmail_message_id):
+    """Record a reply Gmail accepted"""
+    with storage.transaction() as conn:
+        conn.execute('''
+            UPDATE reply_outbox
+            SET status = ?, gmail_message_id = ?, last_error = NULL, updated_at = ?
+            WHERE message_sid = ?
+        ''', (SENT, gmail_message_id, time.time(), message_sid))
+
+def mark_failed(reply, error, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """Schedule a retry with exponential backoff, or dead-letter the reply"""
+    return durable_queue.mark_failed('reply_outbox', 'message_sid = ?', (reply['message_sid'],), reply['attempts'],
+                                     error, max_attempts, BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS)
+
+def release_stale():
+    """Put replies a crashed process left in `sending` back in the queue"""
+    now = time.time()
+    with storage.transaction() as conn:
+        return durable_queue.release(conn, 'reply_outbox', 'claimed_at < ?', (now - SENDING_LEASE_SECONDS,), now)
+
+def purge_sent():
+    """Drop sent replies past the retention window"""
+    with storage.transaction() as conn:
+        durable_queue.purge_sent(conn, 'reply_outbox', SENT_RETENTION_SECONDS, time.time())
@@ -0,0 +1,33 @@
+"""
+Routing of filter matches to WhatsApp recipients.
+
+A rule in `routing_rules` sends matches to `to_number`. A rule can be limited
+to one account (`account_id`) and to one filter keyword (`keyword`); NULL means
+any. A match goes to every recipient whose rule applies, or to
+`target_whatsapp_number` when no rule does.
+"""
+
+import config
+
+def recipients(account_id, keywords, default_number=None, snapshot=None):
+    """WhatsApp numbers a match on `keywords` in this account is sent to"""
+    snapshot = snapshot or config.get_snapshot()
+    keywords = {keyword.casefold() for keyword in keywords}
+    numbers = []
+    for rule in snapshot.routes:
+        if rule['account_id'] is not None and rule['account_id'] != account_id:
+            continue
+        if rule['keyword'] is not None and rule['keyword'].casefold() not in keywords:
+            continue
+        if rule['to_number'] not in numbers:
+            numbers.append(rule['to_number'])
+    if not numbers and default_number:
+        numbers.append(default_number)
+    return numbers
+
+def has_recipients(account_id, default_number=None, snapshot=None):
+    """Whether any match in this account could be delivered at all"""
+    snapshot = snapshot or config.get_snapshot()
+    return bool(default_number) or any(
+        rule['account_id'] in (None, account_id) for rule in snapshot.routes
+    )
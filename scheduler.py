@@ -0,0 +1,61 @@
+"""
+Adaptive poll scheduler for the worker.
+
+The interval halves after every cycle that forwards something, so bursts are
+drained quickly, and doubles after every idle cycle, so quiet mailboxes cost
+few Gmail calls. It always stays within the configured bounds. Jitter spreads
+replicas that would otherwise wake in lockstep.
+"""
+
+import random
+import time
+
+DEFAULT_MIN_INTERVAL = 15
+DEFAULT_MAX_INTERVAL = 300
+DEFAULT_JITTER = 0.1
+
+# Interval multiplier applied after an idle cycle (and divisor after an active one)
+BACKOFF_FACTOR = 2.0
+
+class PollScheduler:
+    """Computes the delay before the next poll from recent activity"""
+    
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 jitter=DEFAULT_JITTER):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.interval = min_interval
+        self.next_wake_at = None
+    
+    def configure(self, min_interval, max_interval, jitter):
+        """Apply new bounds, keeping the current interval inside them"""
+        self.min_interval = max(1, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.jitter = min(max(0.0, jitter), 1.0)
+        self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+    
+    def configure_from(self, snapshot):
+        """Read poll_min_interval_seconds, poll_max_interval_seconds and poll_jitter from a config snapshot"""
+        self.configure(
+            snapshot.get_float('poll_min_interval_seconds', DEFAULT_MIN_INTERVAL),
+            snapshot.get_float('poll_max_interval_seconds', DEFAULT_MAX_INTERVAL),
+            snapshot.get_float('poll_jitter', DEFAULT_JITTER),
+        )
+    
+    def record_cycle(self, matches):
+        """Shorten the interval after a cycle with matches, back off after an idle one"""
+        if matches:
+            self.interval = max(self.min_interval, self.interval / BACKOFF_FACTOR)
+        else:
+            self.interval = min(self.max_interval, self.interval * BACKOFF_FACTOR)
+    
+    def next_delay(self):
+        """Seconds until the next poll, with jitter; also updates next_wake_at"""
+        spread = self.interval * self.jitter
+        # Jitter within the bounds so replicas pinned at a bound still spread out
+        low = max(self.min_interval, self.interval - spread)
+        high = min(self.max_interval, self.interval + spread)
+        delay = random.uniform(low, high)
+        self.next_wake_at = time.time() + delay
+        return delay
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Google Pub/Sub: posts sample Gmail push notifications to /gmail-push
+"""
+
+import argparse
+import base64
+import json
+import sys
+import time
+import requests
+
+def build_envelope(email_address, history_id, message_id):
+    """Build a Pub/Sub push envelope the way Google delivers Gmail watch notifications"""
+    data = json.dumps({'emailAddress': email_address, 'historyId': history_id})
+    return {
+        'message': {
+            'data': base64.b64encode(data.encode('utf-8')).decode('ascii'),
+            'messageId': str(message_id),
+            'publishTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        'subscription': 'projects/local-standin/subscriptions/gmail-push'
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--url', default='http://localhost:5000/gmail-push', help='Push endpoint URL')
+    parser.add_argument('--token', required=True, help='Value of the gmail_push_token setting')
+    parser.add_argument('--email', default='user@example.com', help='Mailbox address in the payload')
+    parser.add_argument('--history-id', type=int, default=1000, help='First historyId to send')
+    parser.add_argument('--count', type=int, default=1, help='Number of notifications to post')
+    parser.add_argument('--interval', type=float, default=0.5, help='Seconds between notifications')
+    parser.add_argument('--malformed', action='store_true', help='Also post an invalid payload (expects 400)')
+    args = parser.parse_args()
+    
+    failures = 0
+    for i in range(args.count):
+        envelope = build_envelope(args.email, args.history_id + i, 1000 + i)
+        response = requests.post(args.url, params={'token': args.token}, json=envelope, timeout=10)
+        ok = response.status_code == 204
+        failures += not ok
+        print(f"{'✓' if ok else '✗'} historyId {args.history_id + i}: HTTP {response.status_code}")
+        if i + 1 < args.count:
+            time.sleep(args.interval)
+    
+    if args.malformed:
+        response = requests.post(args.url, params={'token': args.token}, json={'message': {}}, timeout=10)
+        ok = response.status_code == 400
+        failures += not ok
+        print(f"{'✓' if ok else '✗'} malformed payload: HTTP {response.status_code}")
+    
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,11 @@
 #!/bin/bash
 
-# Initialize the database
+# Initialize the database (creates or upgrades the schema)
 python -c "
-import sqlite3
-conn = sqlite3.connect('config.db')
-cursor = conn.cursor()
-
-# Create settings table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )
-''')
-
-# Create filters table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS filters (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        keyword TEXT UNIQUE
-    )
-''')
-
-# Create conversation_map table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS conversation_map (
-        thread_id TEXT PRIMARY KEY,
-        whatsapp_user_number TEXT,
-        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-''')
-
-conn.commit()
-conn.close()
+import logs
+import storage
+logs.configure()
+storage.migrate()
 print('Database initialized successfully')
 "
 
@@ -42,4 +15,4 @@ python worker.py &
 
 # Start the Flask web application with gunicorn
 echo "Starting web server..."
-exec gunicorn --bind 0.0.0.0:5000 --workers 2 --timeout 120 app:app 
\ No newline at end of file
+exec gunicorn -c gunicorn.conf.py app:app 
\ No newline at end of file
@@ -0,0 +1,30 @@
+"""
+Runtime state the worker writes as it runs, kept apart from `settings`.
+
+History cursors, cycle and poll times, watch expiries and the number of
+wake-up slots change every cycle. In `settings` each write would bump the
+config counter and make every process reload its configuration snapshot, so
+they live in `runtime_state` instead and are read straight from SQLite.
+Per-account values use the same `<name>:<account id>` keys as settings.
+"""
+
+import storage
+
+def get(key, default=None):
+    row = storage.get_connection().execute('SELECT value FROM runtime_state WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row is not None and row['value'] is not None else default
+
+def values(name):
+    """Every account's value of `name`, keyed by their keys"""
+    rows = storage.get_connection().execute('''
+        SELECT key, value FROM runtime_state WHERE key = ? OR key GLOB ?
+    ''', (name, f'{name}:*'))
+    return {row['key']: row['value'] for row in rows}
+
+def put(key, value):
+    put_many({key: value})
+
+def put_many(items):
+    """Store several values in one transaction"""
+    with storage.transaction() as conn:
+        conn.executemany('INSERT OR REPLACE INTO runtime_state (key, value) VALUES (?, ?)', items.items())
@@ -0,0 +1,439 @@
+"""
+Shared SQLite storage for the web app and the worker.
+
+Connections run in WAL mode with a busy timeout so the gunicorn workers and
+worker.py can read while another process writes. Each thread reuses one
+connection. The schema is created and upgraded by the versioned migrations
+below, tracked with `PRAGMA user_version`.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import metrics
+
+log = logging.getLogger(__name__)
+
+# CONFIG_DB points the app at another database file, e.g. a scratch one for benchmarks
+DB_PATH = os.environ.get('CONFIG_DB', 'config.db')
+
+# How long a writer waits for a competing transaction before "database is locked"
+BUSY_TIMEOUT_MS = 30000
+
+# Tables loaded into config's snapshot; every change to them bumps the `config` counter
+CONFIG_TABLES = ('settings', 'filters', 'accounts', 'routing_rules')
+
+# (version, description, statements) applied in order; never edit a released entry
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS filters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            keyword TEXT UNIQUE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_map (
+            thread_id TEXT PRIMARY KEY,
+            whatsapp_user_number TEXT,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, 'index reply routing lookups', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_map_number_updated
+        ON conversation_map (whatsapp_user_number, last_updated)
+        ''',
+    ]),
+    (3, 'outbound job queue', [
+        '''
+        CREATE TABLE IF NOT EXISTS outbound_jobs (
+            message_id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            to_number TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            twilio_sid TEXT,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbound_jobs_status_due
+        ON outbound_jobs (status, next_attempt_at)
+        ''',
+    ]),
+    (4, 'digest batches and recipient send log', [
+        'ALTER TABLE outbound_jobs ADD COLUMN batch_id TEXT',
+        'ALTER TABLE outbound_jobs ADD COLUMN parts_sent INTEGER NOT NULL DEFAULT 0',
+        # Jobs caught mid-send by the upgrade become single-job batches
+        "UPDATE outbound_jobs SET batch_id = message_id WHERE status = 'sending'",
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbound_jobs_batch
+        ON outbound_jobs (batch_id)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS send_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            to_number TEXT NOT NULL,
+            twilio_sid TEXT,
+            sent_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_send_log_number_sent
+        ON send_log (to_number, sent_at)
+        ''',
+    ]),
+    (5, 'reply outbox', [
+        '''
+        CREATE TABLE IF NOT EXISTS reply_outbox (
+            message_sid TEXT PRIMARY KEY,
+            from_number TEXT NOT NULL,
+            thread_id TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            gmail_message_id TEXT,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_reply_outbox_status_due
+        ON reply_outbox (status, next_attempt_at)
+        ''',
+    ]),
+    (6, 'multiple accounts and routing', [
+        '''
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            email_address TEXT,
+            credentials_path TEXT NOT NULL,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS routing_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_id INTEGER,
+            keyword TEXT,
+            to_number TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS account_leases (
+            account_id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS worker_heartbeats (
+            owner TEXT PRIMARY KEY,
+            heartbeat_at REAL NOT NULL
+        )
+        ''',
+        # Existing rows belong to the default account (0), configured through settings
+        '''
+        CREATE TABLE conversation_map_new (
+            account_id INTEGER NOT NULL DEFAULT 0,
+            thread_id TEXT NOT NULL,
+            whatsapp_user_number TEXT,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (account_id, thread_id)
+        )
+        ''',
+        '''
+        INSERT INTO conversation_map_new (account_id, thread_id, whatsapp_user_number, last_updated)
+        SELECT 0, thread_id, whatsapp_user_number, last_updated FROM conversation_map
+        ''',
+        'DROP TABLE conversation_map',
+        'ALTER TABLE conversation_map_new RENAME TO conversation_map',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_map_number_updated
+        ON conversation_map (whatsapp_user_number, last_updated)
+        ''',
+        # A match can now fan out to several recipients, so they join the job key
+        '''
+        CREATE TABLE outbound_jobs_new (
+            account_id INTEGER NOT NULL DEFAULT 0,
+            message_id TEXT NOT NULL,
+            thread_id TEXT,
+            to_number TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            twilio_sid TEXT,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            batch_id TEXT,
+            parts_sent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (account_id, message_id, to_number)
+        )
+        ''',
+        '''
+        INSERT INTO outbound_jobs_new
+            (account_id, message_id, thread_id, to_number, body, status, attempts, next_attempt_at,
+             claimed_at, twilio_sid, last_error, created_at, updated_at, batch_id, parts_sent)
+        SELECT 0, message_id, thread_id, to_number, body, status, attempts, next_attempt_at,
+               claimed_at, twilio_sid, last_error, created_at, updated_at, batch_id, parts_sent
+        FROM outbound_jobs
+        ''',
+        'DROP TABLE outbound_jobs',
+        'ALTER TABLE outbound_jobs_new RENAME TO outbound_jobs',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbound_jobs_status_due
+        ON outbound_jobs (status, next_attempt_at)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbound_jobs_batch
+        ON outbound_jobs (batch_id)
+        ''',
+        'ALTER TABLE reply_outbox ADD COLUMN account_id INTEGER NOT NULL DEFAULT 0',
+    ]),
+    (7, 'shared metrics', [
+        '''
+        CREATE TABLE IF NOT EXISTS metric_samples (
+            process TEXT NOT NULL,
+            series TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (process, series, labels)
+        )
+        ''',
+    ]),
+    (8, 'conversation routing versions and retention', [
+        '''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO counters (name, value) VALUES ('conversation_map', 0)",
+        'ALTER TABLE conversation_map ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_conversation_map_version ON conversation_map (version)',
+        'CREATE INDEX IF NOT EXISTS idx_conversation_map_updated ON conversation_map (last_updated)',
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_archive (
+            account_id INTEGER NOT NULL,
+            thread_id TEXT NOT NULL,
+            whatsapp_user_number TEXT NOT NULL,
+            last_updated TIMESTAMP,
+            archived_at TIMESTAMP NOT NULL,
+            archived_version INTEGER NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_archive_version
+        ON conversation_archive (archived_version)
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_conversation_archive_archived_at
+        ON conversation_archive (archived_at)
+        ''',
+    ]),
+    (9, 'attachments of outbound jobs', [
+        'ALTER TABLE outbound_jobs ADD COLUMN media TEXT',
+    ]),
+    (10, 'headers for threading replies', [
+        'ALTER TABLE outbound_jobs ADD COLUMN headers TEXT',
+        'ALTER TABLE conversation_map ADD COLUMN message_id_header TEXT',
+        'ALTER TABLE conversation_map ADD COLUMN subject TEXT',
+        'ALTER TABLE conversation_map ADD COLUMN sender TEXT',
+        'ALTER TABLE conversation_map ADD COLUMN references_header TEXT',
+    ]),
+    (11, 'ledger of evaluated messages', [
+        '''
+        CREATE TABLE IF NOT EXISTS filter_sets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fingerprint TEXT UNIQUE NOT NULL,
+            keywords TEXT NOT NULL,
+            fields TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS evaluated_messages (
+            account_id INTEGER NOT NULL,
+            id_hash INTEGER NOT NULL,
+            filter_set INTEGER NOT NULL,
+            evaluated_at REAL NOT NULL,
+            PRIMARY KEY (account_id, id_hash)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_evaluated_messages_evaluated_at
+        ON evaluated_messages (evaluated_at)
+        ''',
+    ]),
+    (12, 'delivery status of WhatsApp messages', [
+        '''
+        CREATE TABLE IF NOT EXISTS message_status (
+            sid TEXT PRIMARY KEY,
+            to_number TEXT,
+            status TEXT NOT NULL,
+            status_rank INTEGER NOT NULL,
+            error_code INTEGER,
+            created_at REAL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_message_status_updated_at ON message_status (updated_at)',
+        '''
+        CREATE TABLE IF NOT EXISTS message_status_emails (
+            sid TEXT NOT NULL,
+            account_id INTEGER NOT NULL,
+            message_id TEXT NOT NULL,
+            PRIMARY KEY (sid, account_id, message_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_message_status_emails_message
+        ON message_status_emails (account_id, message_id)
+        ''',
+    ]),
+    (13, 'version counter of the configuration tables', [
+        "INSERT OR IGNORE INTO counters (name, value) VALUES ('config', 0)",
+        # Triggers, so every writer bumps it, including sqlite3 run by hand
+        *[
+            f'''
+            CREATE TRIGGER IF NOT EXISTS config_version_{table}_{event.lower()} AFTER {event} ON {table}
+            BEGIN
+                UPDATE counters SET value = value + 1 WHERE name = 'config';
+            END
+            '''
+            for table in CONFIG_TABLES for event in ('INSERT', 'UPDATE', 'DELETE')
+        ],
+    ]),
+    (14, 'process-wide roles', [
+        '''
+        CREATE TABLE IF NOT EXISTS role_leases (
+            role TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+    ]),
+    (15, 'runtime state out of settings', [
+        '''
+        CREATE TABLE IF NOT EXISTS runtime_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''',
+        # Keys the worker writes every cycle, with their per-account variants; see state.py
+        *[
+            statement
+            for name in ('gmail_history_id', 'worker_last_cycle_at', 'worker_next_poll_at',
+                         'gmail_watch_expiration', 'worker_wakeup_slots')
+            for statement in (
+                f'''
+                INSERT OR REPLACE INTO runtime_state (key, value)
+                SELECT key, value FROM settings WHERE key = '{name}' OR key GLOB '{name}:*'
+                ''',
+                f"DELETE FROM settings WHERE key = '{name}' OR key GLOB '{name}:*'",
+            )
+        ],
+    ]),
+    (16, 'failure counts of listed messages', [
+        '''
+        CREATE TABLE IF NOT EXISTS failed_messages (
+            account_id INTEGER NOT NULL,
+            message_id TEXT NOT NULL,
+            failures INTEGER NOT NULL,
+            last_error TEXT,
+            failed_at REAL NOT NULL,
+            PRIMARY KEY (account_id, message_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_failed_messages_failed_at ON failed_messages (failed_at)',
+    ]),
+]
+
+_local = threading.local()
+
+def connect(check_same_thread=True):
+    """Open a new connection configured for concurrent access"""
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=check_same_thread)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA journal_mode = WAL')
+    # Safe with WAL: a crash may lose the last commits but never corrupts the database
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+def get_connection():
+    """Get this thread's connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+    # Connections must not cross a fork (e.g. a preloaded gunicorn app)
+    if conn is None or _local.pid != os.getpid():
+        conn = connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+@contextmanager
+def transaction():
+    """Run statements on this thread's connection, committing on success"""
+    conn = get_connection()
+    with metrics.timed('sqlite_transaction', mode='deferred'), conn:
+        yield conn
+
+@contextmanager
+def immediate_transaction():
+    """Like transaction(), but takes the write lock up front for read-then-write sequences"""
+    conn = get_connection()
+    with metrics.timed('sqlite_transaction', mode='immediate'):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def migrate():
+    """Apply pending schema migrations; safe to run from several processes at once"""
+    conn = connect()
+    conn.isolation_level = None
+    try:
+        # The write lock serializes concurrent migrators until COMMIT
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, description, statements in MIGRATIONS:
+                if version <= current:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+                log.info(f"Applied database migration {version}: {description}")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
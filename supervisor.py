@@ -0,0 +1,85 @@
+"""
+Worker supervisor: spreads Gmail accounts across a pool of worker processes.
+
+Each child runs pipeline.run() with its own wake-up slot and takes its share
+of accounts through leases in SQLite (see accounts.py). The supervisor only
+keeps the pool at size: a child that exits is restarted, and its accounts are
+picked up again once its leases expire.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import accounts
+import config
+import logs
+import state
+import storage
+import wakeup
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks that every child is still alive
+CHECK_INTERVAL_SECONDS = 2
+
+# Seconds children get to drain their pipelines on shutdown
+SHUTDOWN_TIMEOUT_SECONDS = 60
+
+def process_count():
+    """worker_processes if set, otherwise one process per core up to the number of accounts"""
+    configured = config.get_snapshot().get_int('worker_processes')
+    if configured:
+        return max(1, configured)
+    return max(1, min(os.cpu_count() or 1, len(accounts.get_accounts())))
+
+def _child(slot):
+    # Imported in the child so the parent never builds Gmail or Twilio clients
+    import pipeline
+    logs.configure()
+    pipeline.run(slot)
+
+def _start(slot):
+    process = multiprocessing.Process(target=_child, args=(slot,), name=f'worker-{slot}')
+    process.start()
+    log.info(f"Started worker process {slot} (pid {process.pid})")
+    return process
+
+def run(processes=None):
+    """Run the worker pool until SIGTERM or SIGINT"""
+    storage.migrate()
+    processes = processes or process_count()
+    
+    # Tell the web app how many wake-up ports to notify
+    state.put(wakeup.SLOTS_KEY, str(processes))
+    
+    log.info(f"Starting {processes} worker process(es)")
+    children = {slot: _start(slot) for slot in range(processes)}
+    
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    while not stopping:
+        for slot, process in list(children.items()):
+            if not process.is_alive():
+                log.warning(f"Worker process {slot} exited with code {process.exitcode}, restarting")
+                children[slot] = _start(slot)
+        time.sleep(CHECK_INTERVAL_SECONDS)
+    
+    log.info("Stopping worker processes...")
+    for process in children.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+    for process in children.values():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            process.kill()
+    log.info("Worker supervisor stopped")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Checks of the worker's subtlest logic against a scratch database: ledger
+coverage as filters change, digest splitting and resumed deliveries, and
+per-recipient send caps. Run directly; no Gmail or Twilio access is needed.
+"""
+
+import os
+import re
+import sys
+import tempfile
+import time
+import storage
+
+# Never touch the real config.db
+storage.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='tpe-logic-'), 'config.db')
+storage.migrate()
+
+import formatter
+import job_queue
+import ledger
+import worker
+
+class FakeSender:
+    """Stands in for WhatsAppSender, recording what would have been sent"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    def send(self, body, to_number, media_url=None):
+        self.sent.append(body)
+        return f"SM{len(self.sent)}"
+
+def long_body(name, sentences=80):
+    return f"{name}. " + ''.join(f"Sentence number {i} of {name} is here. " for i in range(sentences))
+
+def claim(to_number):
+    """Make the recipient's pending jobs due and claim them"""
+    with storage.transaction() as conn:
+        conn.execute('UPDATE outbound_jobs SET next_attempt_at = 0 WHERE to_number = ? AND status = ?',
+                     (to_number, job_queue.PENDING))
+    return [batch for batch in job_queue.claim_due(100) if batch['to_number'] == to_number]
+
+def test_ledger_coverage():
+    """A message that did not match stays skipped only while the filters cannot match it either"""
+    print("Testing ledger coverage...")
+    ledger.record(1, ['m1'], ('invoice',), ('subject',))
+    
+    def skipped(filters, fields=('subject',)):
+        return ledger.unevaluated(1, ['m1'], filters, fields) == []
+    
+    assert skipped(('invoice',))
+    # Every keyword containing a checked one is covered: no "invoice" means no "Invoices"
+    assert skipped(('Invoices',))
+    assert not skipped(('invoice', 'report'))
+    assert ledger.unevaluated(2, ['m1'], ('invoice',), ('subject',)) == ['m1']
+    
+    ledger.record(1, ['m1'], ('invoice', 'report'), ('subject', 'from'))
+    # Removing keywords or fields keeps the entry valid; adding a field does not
+    assert skipped(('report',))
+    assert skipped(('invoice',), ('from',))
+    assert not skipped(('invoice',), ('subject', 'body'))
+    print("✓ Ledger coverage follows keyword and field changes")
+
+def test_segment_split_and_resume():
+    """Splitting is deterministic and loses nothing, so a partly sent batch resumes where it stopped"""
+    print("Testing digest segments...")
+    bodies = [long_body(f"Email {i}") for i in range(3)]
+    parts = formatter.segments_for(bodies)
+    assert len(parts) > 1
+    assert all(len(part) <= formatter.MAX_SEGMENT_CHARS for part in parts)
+    assert parts == formatter.segments_for(bodies)
+    unmarked = ''.join(re.sub(r'^\(\d+/\d+\) ', '', part) for part in parts)
+    assert ''.join(unmarked.split()) == ''.join(formatter.format_digest(bodies).split())
+    
+    for i, body in enumerate(bodies):
+        job_queue.enqueue(0, f'resume-{i}', None, '+100', body)
+    [batch] = claim('+100')
+    assert job_queue.segments(batch) == [(part, None) for part in parts]
+    job_queue.mark_part_sent(batch, 1, 'SM-first')
+    job_queue.mark_failed(batch, 'Twilio unavailable')
+    
+    # A job queued meanwhile must not change the digest being resumed
+    job_queue.enqueue(0, 'resume-late', None, '+100', 'Late email')
+    batches = claim('+100')
+    resumed = next(b for b in batches if b['batch_id'] == batch['batch_id'])
+    assert resumed['parts_sent'] == 1
+    assert job_queue.segments(resumed) == job_queue.segments(batch)
+    assert [job['message_id'] for job in batches[-1]['jobs']] == ['resume-late']
+    print("✓ Segments are deterministic and resume after the last one sent")
+
+def test_recipient_cap_deferral():
+    """Reaching the hourly cap defers the rest of a batch without counting a failed attempt"""
+    print("Testing recipient caps...")
+    job_queue.enqueue(0, 'capped', None, '+200', long_body("Capped email", 120))
+    [batch] = claim('+200')
+    total = len(job_queue.segments(batch))
+    assert total > 2
+    
+    sender = FakeSender()
+    assert worker.deliver_batch(sender, batch, recipient_cap=2) is None
+    assert len(sender.sent) == 2
+    row = storage.get_connection().execute(
+        'SELECT status, attempts, parts_sent, next_attempt_at FROM outbound_jobs WHERE message_id = ?', ('capped',)
+    ).fetchone()
+    assert row['status'] == job_queue.PENDING and row['attempts'] == 0 and row['parts_sent'] == 2
+    _, oldest = job_queue.recipient_sends('+200')
+    assert abs(row['next_attempt_at'] - (oldest + job_queue.RECIPIENT_CAP_WINDOW_SECONDS)) < 1
+    
+    # Once the window has passed the batch finishes from the third segment
+    with storage.transaction() as conn:
+        conn.execute('UPDATE send_log SET sent_at = sent_at - ? WHERE to_number = ?',
+                     (job_queue.RECIPIENT_CAP_WINDOW_SECONDS + 1, '+200'))
+    [batch] = claim('+200')
+    assert worker.deliver_batch(sender, batch, recipient_cap=total) is not None
+    assert sender.sent == [part for part, _ in job_queue.segments(batch)]
+    print("✓ Capped batches are deferred and resume without resending")
+
+def main():
+    """Run all checks"""
+    print("Gmail-to-WhatsApp Bridge Logic Checks")
+    print("=" * 40)
+    
+    tests = [
+        test_ledger_coverage,
+        test_segment_split_and_resume,
+        test_recipient_cap_deferral,
+    ]
+    
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except AssertionError as e:
+            failed += 1
+            print(f"✗ {test.__doc__} ({e or 'assertion failed'})")
+        print()
+    
+    print("=" * 40)
+    print(f"Checks passed: {len(tests) - failed}/{len(tests)}")
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Local wake-up signal from the web app to the worker.
+
+The web app sends a UDP datagram to the worker on localhost when Gmail pushes
+a change notification, so the worker starts a sync immediately instead of
+waiting for its next poll, and when a WhatsApp reply is queued, so it is sent
+to Gmail right away. Worker processes also use it to tell the process that
+delivers WhatsApp messages that they queued one. Datagrams are
+fire-and-forget: if the worker is not listening the notification is dropped
+and the regular poll picks the change up.
+
+Each worker process listens on its own port, WAKEUP_PORT + slot, and the
+notification goes to every slot the supervisor announced.
+"""
+
+import logging
+import asyncio
+import os
+import socket
+import state
+
+log = logging.getLogger(__name__)
+
+WAKEUP_HOST = '127.0.0.1'
+WAKEUP_PORT = int(os.environ.get('WORKER_WAKEUP_PORT', '5055'))
+
+# Payload announcing a queued reply rather than a Gmail change
+REPLY_SIGNAL = 'reply'
+
+# Payload announcing a WhatsApp job queued by another worker process
+DELIVER_SIGNAL = 'deliver'
+
+# Runtime state key holding the number of worker processes listening
+SLOTS_KEY = 'worker_wakeup_slots'
+
+def notify(history_id=None, email_address=None):
+    """Wake the worker; never raises"""
+    payload = f"{history_id or ''} {email_address or ''}".strip()
+    return _send(payload.encode('ascii', 'ignore'))
+
+def notify_reply():
+    """Tell the worker a reply is waiting in the outbox; never raises"""
+    return _send(REPLY_SIGNAL.encode('ascii'))
+
+def notify_queued():
+    """Tell the delivering worker process a WhatsApp job is waiting; never raises"""
+    return _send(DELIVER_SIGNAL.encode('ascii'))
+
+def parse(payload):
+    """Split a Gmail wake-up payload into (history_id, email_address); either may be None"""
+    history_id, _, email_address = (payload or '').partition(' ')
+    return history_id or None, email_address or None
+
+def _send(payload):
+    slots = max(1, int(state.get(SLOTS_KEY, 1)))
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for slot in range(slots):
+                sock.sendto(payload, (WAKEUP_HOST, WAKEUP_PORT + slot))
+        return True
+    except OSError as e:
+        log.error(f"Could not wake worker: {e}")
+        return False
+
+class _WakeupProtocol(asyncio.DatagramProtocol):
+    def __init__(self, callback):
+        self.callback = callback
+    
+    def datagram_received(self, data, addr):
+        self.callback(data.decode('ascii', 'ignore') or None)
+
+async def listen(callback, slot=0):
+    """Call `callback(payload)` for each wake-up (see parse() and the signals); returns the transport, or None if the port is taken"""
+    loop = asyncio.get_running_loop()
+    try:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _WakeupProtocol(callback),
+            local_addr=(WAKEUP_HOST, WAKEUP_PORT + slot)
+        )
+    except OSError as e:
+        log.warning(f"Wake-up listener unavailable on port {WAKEUP_PORT + slot}, relying on polling: {e}")
+        return None
+    return transport
@@ -0,0 +1,159 @@
+"""
+Concurrent WhatsApp sender built on one long-lived Twilio client.
+
+Messages are sent from a bounded thread pool through a pooled HTTP session,
+paced by a token bucket matched to the account's messages-per-second
+allowance. 429 and 5xx responses are retried, honoring Retry-After. With a
+`status_callback` URL, Twilio reports each message's delivery status there.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+import metrics
+from ratelimit import TokenBucket, retry_delay
+
+log = logging.getLogger(__name__)
+
+# Defaults used when the rate settings are not configured
+DEFAULT_RATE_PER_SECOND = 1.0
+DEFAULT_SEND_WORKERS = 4
+DEFAULT_MAX_RETRIES = 3
+
+# Exponential backoff for retryable errors without a Retry-After header
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# Recent messages inspected when checking whether a send already happened
+RECONCILE_LOOKBACK = 50
+
+# Allowance for clock differences between this host and Twilio
+CLOCK_SKEW_SECONDS = 60
+
+TWILIO_API_BASE = 'https://api.twilio.com'
+
+# Base URL replacing TWILIO_API_BASE, e.g. bench/fake_twilio.py
+TWILIO_API_OVERRIDE = os.environ.get('TWILIO_API_BASE')
+
+class _PooledHttpClient(TwilioHttpClient):
+    """TwilioHttpClient sized for the send pool that remembers each thread's last response"""
+    
+    def __init__(self, pool_size):
+        super().__init__(pool_connections=True)
+        self.session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+        self._local = threading.local()
+    
+    def request(self, method, url, *args, **kwargs):
+        if TWILIO_API_OVERRIDE and url.startswith(TWILIO_API_BASE):
+            url = TWILIO_API_OVERRIDE.rstrip('/') + url[len(TWILIO_API_BASE):]
+        self._local.response = None
+        response = super().request(method, url, *args, **kwargs)
+        self._local.response = response
+        return response
+    
+    @property
+    def thread_last_response(self):
+        return getattr(self._local, 'response', None)
+
+def _is_retryable(error):
+    return isinstance(error, TwilioRestException) and (error.status == 429 or error.status >= 500)
+
+class WhatsAppSender:
+    """Sends WhatsApp messages concurrently through a shared, rate-limited Twilio client"""
+    
+    def __init__(self, account_sid, auth_token, from_number,
+                 rate=DEFAULT_RATE_PER_SECOND, burst=None,
+                 max_workers=DEFAULT_SEND_WORKERS, max_retries=DEFAULT_MAX_RETRIES, status_callback=None):
+        self.from_number = from_number
+        self.max_retries = max_retries
+        self.status_callback = status_callback
+        self._http_client = _PooledHttpClient(max_workers)
+        self._client = Client(account_sid, auth_token, http_client=self._http_client)
+        self._bucket = TokenBucket(rate, burst)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='whatsapp-send')
+    
+    def send(self, body, to_number, media_url=None):
+        """Send one message, blocking until Twilio accepts it; returns the message SID"""
+        # WhatsApp takes one media file per message, which Twilio downloads from media_url
+        media = {'media_url': [media_url]} if media_url else {}
+        callback = {'status_callback': self.status_callback} if self.status_callback else {}
+        attempt = 0
+        while True:
+            self._bucket.acquire()
+            try:
+                with metrics.timed('twilio_request', method='messages.create'):
+                    message = self._client.messages.create(
+                        from_=f'whatsapp:{self.from_number}',
+                        body=body,
+                        to=f'whatsapp:{to_number}',
+                        **media,
+                        **callback
+                    )
+                return message.sid
+            except TwilioRestException as e:
+                if not _is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                
+                response = self._http_client.thread_last_response
+                delay = retry_delay(response.headers.get('Retry-After') if response and response.headers else None,
+                                    attempt, BACKOFF_BASE_SECONDS, BACKOFF_MAX_SECONDS)
+                
+                if e.status == 429:
+                    # Throttling applies to the whole account, so hold every sender back
+                    self._bucket.pause(delay)
+                
+                log.warning(f"Twilio returned {e.status}, retrying in {delay:.1f}s")
+                attempt += 1
+                time.sleep(delay)
+    
+    def find_sent_message(self, body, to_number, since):
+        """Return the SID of a message with this body sent to `to_number` after `since`, if any
+        
+        `since` is a Unix timestamp. Used to find out whether a send interrupted
+        by a crash reached Twilio before retrying it.
+        """
+        with metrics.timed('twilio_request', method='messages.list'):
+            recent = self._client.messages.list(
+                to=f'whatsapp:{to_number}',
+                from_=f'whatsapp:{self.from_number}',
+                limit=RECONCILE_LOOKBACK
+            )
+        for message in recent:
+            created = message.date_created.timestamp() if message.date_created else None
+            if message.body == body and created is not None and created >= since - CLOCK_SKEW_SECONDS:
+                return message.sid
+        return None
+    
+    def submit_task(self, fn, *args):
+        """Run `fn(*args)` on the send pool, e.g. to send a sequence of messages in order"""
+        return self._executor.submit(fn, *args)
+    
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._http_client.session.close()
+
+_sender = None
+_sender_key = None
+_sender_lock = threading.Lock()
+
+def get_sender(account_sid, auth_token, from_number, rate=DEFAULT_RATE_PER_SECOND,
+               burst=None, max_workers=DEFAULT_SEND_WORKERS, status_callback=None):
+    """Get the process-wide sender, rebuilding it only when its configuration changes"""
+    global _sender, _sender_key
+    key = (account_sid, auth_token, from_number, rate, burst, max_workers, status_callback)
+    with _sender_lock:
+        if _sender is None or _sender_key != key:
+            previous = _sender
+            _sender = WhatsAppSender(account_sid, auth_token, from_number, rate=rate, burst=burst,
+                                     max_workers=max_workers, status_callback=status_callback)
+            _sender_key = key
+            if previous is not None:
+                # Let in-flight sends on the old client finish in the background
+                threading.Thread(target=previous.close, daemon=True).start()
+        return _sender
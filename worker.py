@@ -1,220 +1,609 @@
 import os
-import sqlite3
+import json
 import time
 import base64
 import email
+import logging
 from datetime import datetime
-import google.auth.transport.requests
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from email.message import EmailMessage
 from googleapiclient.errors import HttpError
-from twilio.rest import Client
 import re
+from concurrent.futures import as_completed
+import accounts
+import config
+import conversations
+import delivery_status
+import email_content
+import gmail_auth
+import gmail_client
+import job_queue
+import ledger
+import logs
+import matcher
+import media_cache
+import metrics
+import reply_outbox
+import routing
+import state
+import storage
+import whatsapp_sender
 
-# Gmail API scopes
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+log = logging.getLogger(__name__)
 
-def get_db_connection():
-    conn = sqlite3.connect('config.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Runtime state key holding the Gmail History API cursor for incremental sync
+HISTORY_CURSOR_KEY = 'gmail_history_id'
+
+# Page size of the listing done when the history cursor is missing or expired (Gmail's maximum)
+FULL_RESYNC_PAGE_SIZE = 500
+
+# Resync bound, overridable with the setting of the same name; 0 lists every unread message
+DEFAULT_FULL_RESYNC_MAX_MESSAGES = 0
+
+# Runtime state key recording when a cycle last completed (Unix time), behind /health's poll lag
+LAST_CYCLE_KEY = 'worker_last_cycle_at'
+
+# Gmail accepts up to 100 calls per batch but recommends staying at 50
+GMAIL_BATCH_SIZE = 50
+
+# Headers fetched for the first, metadata-only filtering pass
+METADATA_HEADERS = ['Subject', 'From', 'Message-ID']
+
+# Maximum number of IDs accepted by a single batchModify call
+GMAIL_BATCH_MODIFY_SIZE = 1000
+
+# Runtime state key holding the Gmail push watch expiry (milliseconds since the epoch)
+WATCH_EXPIRATION_KEY = 'gmail_watch_expiration'
+
+# Renew the push watch once it is within this many seconds of expiring
+WATCH_RENEW_MARGIN_SECONDS = 24 * 3600
+
+# Outbound jobs claimed per delivery pass
+JOB_CLAIM_LIMIT = 100
+
+# Replies claimed from the outbox per delivery pass
+REPLY_CLAIM_LIMIT = 20
+
+# Subject of replies to threads forwarded before their headers were recorded
+FALLBACK_REPLY_SUBJECT = "Re: WhatsApp Reply"
+
+# Follow-ups sent over WhatsApp once a reply has been handled
+REPLY_SENT_STATUS = "Message sent to Gmail successfully!"
+REPLY_FAILED_STATUS = "Sorry, there was an error sending your message to Gmail."
 
 def get_setting(key, default=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-    result = cursor.fetchone()
-    conn.close()
-    return result['value'] if result else default
+    # Served from the in-memory snapshot; no SQLite round-trip on the hot path
+    return config.get_setting(key, default)
 
 def get_filters():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT keyword FROM filters ORDER BY keyword')
-    filters = [row['keyword'] for row in cursor.fetchall()]
-    conn.close()
-    return filters
-
-def store_conversation_mapping(thread_id, whatsapp_number):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO conversation_map (thread_id, whatsapp_user_number, last_updated)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-    ''', (thread_id, whatsapp_number))
-    conn.commit()
-    conn.close()
-
-def get_gmail_service():
-    """Get authenticated Gmail service"""
-    credentials_path = get_setting('gmail_credentials_path')
-    if not credentials_path or not os.path.exists(credentials_path):
-        raise Exception("Gmail credentials not found")
-    
-    # Load credentials and build service
-    flow = InstalledAppFlow.from_client_secrets_file(credentials_path, SCOPES)
-    creds = flow.run_local_server(port=0)
-    
-    return build('gmail', 'v1', credentials=creds)
-
-def extract_email_body(message_data):
-    """Extract plain text body from email message"""
-    try:
-        if 'parts' in message_data['payload']:
-            # Multipart message
-            for part in message_data['payload']['parts']:
-                if part['mimeType'] == 'text/plain':
-                    if 'data' in part['body']:
-                        return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-        else:
-            # Simple message
-            if 'data' in message_data['payload']['body']:
-                return base64.urlsafe_b64decode(message_data['payload']['body']['data']).decode('utf-8')
+    return config.get_filters()
+
+def store_conversation_mapping(thread_id, whatsapp_number, account_id=accounts.DEFAULT_ACCOUNT_ID, headers=None):
+    conversations.store(thread_id, whatsapp_number, account_id, headers)
+
+def commit_cycle(account, next_cursor):
+    """Store the history cursor after a complete cycle and record when it finished"""
+    state.put_many({
+        account.key(HISTORY_CURSOR_KEY): next_cursor,
+        account.key(LAST_CYCLE_KEY): str(int(time.time())),
+    })
+    metrics.inc('worker_cycles_total', account=account.name, result='ok')
+
+def record_idle_cycle(account):
+    """Record a cycle that had nothing to do (no filters or recipients), so /health does not report a lag"""
+    state.put(account.key(LAST_CYCLE_KEY), str(int(time.time())))
+    metrics.inc('worker_cycles_total', account=account.name, result='idle')
+
+def record_failed_cycle(account):
+    metrics.inc('worker_cycles_total', account=account.name, result='error')
+
+def get_gmail_service(account=None):
+    """Get authenticated Gmail service for an account (the default one if not given)"""
+    account = account or accounts.default_account()
+    return gmail_auth.get_gmail_service(account.credentials_path)
+
+def list_unread_message_ids(service, max_messages=DEFAULT_FULL_RESYNC_MAX_MESSAGES):
+    """Full resync: list the unread message IDs, newest first, and a fresh history cursor
+    
+    The listing follows nextPageToken to the end, so a backlog of unread mail
+    that does not match never hides older matches; `max_messages` > 0 stops
+    it at the newest ones instead. It is not narrowed with a search query:
+    Gmail search matches whole words while the filters match substrings, so
+    a query would miss e.g. "Invoices" for the keyword "invoice". Unread mail
+    already found not to match is dropped by the ledger before it is fetched
+    again, so listing it costs only the list pages.
+    """
+    # Read the cursor before listing so nothing added in between is skipped
+    with metrics.timed('gmail_request', method='getProfile'):
+        profile = service.users().getProfile(userId='me').execute()
+    
+    message_ids = []
+    page_token = None
+    while True:
+        page_size = FULL_RESYNC_PAGE_SIZE
+        if max_messages > 0:
+            if len(message_ids) >= max_messages:
+                log.warning(f"Full resync stopped at the newest {max_messages} unread messages "
+                            f"(full_resync_max_messages); older unread mail is not checked")
+                break
+            page_size = min(page_size, max_messages - len(message_ids))
+        with metrics.timed('gmail_request', method='messages.list'):
+            results = service.users().messages().list(
+                userId='me',
+                labelIds=['UNREAD'],
+                maxResults=page_size,
+                pageToken=page_token
+            ).execute()
+        message_ids.extend(m['id'] for m in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    
+    return message_ids, profile['historyId']
+
+def list_history_message_ids(service, start_history_id):
+    """Incremental sync: list unread messages added since the history cursor"""
+    message_ids = []
+    seen = set()
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        with metrics.timed('gmail_request', method='history.list'):
+            results = service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                pageToken=page_token
+            ).execute()
+        
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if 'UNREAD' in message.get('labelIds', []) and message['id'] not in seen:
+                    seen.add(message['id'])
+                    message_ids.append(message['id'])
         
-        return "No plain text content found"
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    
+    return message_ids, latest_history_id
+
+def list_new_message_ids(service, account=None):
+    """List message IDs to evaluate this cycle and the cursor to store afterwards"""
+    account = account or accounts.default_account()
+    cursor = state.get(account.key(HISTORY_CURSOR_KEY))
+    if cursor:
+        try:
+            return list_history_message_ids(service, cursor)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # Gmail only keeps history for a limited time
+            log.warning(f"History cursor {cursor} expired, falling back to full resync")
+    
+    max_messages = config.get_snapshot().get_int('full_resync_max_messages', DEFAULT_FULL_RESYNC_MAX_MESSAGES)
+    return list_unread_message_ids(service, max_messages)
+
+def ensure_gmail_watch(service, account=None):
+    """Start or renew the Gmail push watch when gmail_push_topic is configured"""
+    topic = get_setting('gmail_push_topic')
+    if not topic:
+        return False
+    
+    account = account or accounts.default_account()
+    expiration_ms = int(state.get(account.key(WATCH_EXPIRATION_KEY), '0'))
+    if expiration_ms - WATCH_RENEW_MARGIN_SECONDS * 1000 > time.time() * 1000:
+        return False
+    
+    # A watch lasts 7 days; calling watch again simply extends it
+    with metrics.timed('gmail_request', method='watch'):
+        response = service.users().watch(
+            userId='me',
+            body={'topicName': topic, 'labelIds': ['INBOX'], 'labelFilterBehavior': 'include'}
+        ).execute()
+    state.put(account.key(WATCH_EXPIRATION_KEY), str(response['expiration']))
+    log.info(f"Gmail push watch for {account.name} active until {datetime.fromtimestamp(int(response['expiration']) / 1000)}")
+    return True
+
+def extract_email_body(payload):
+    """Extract plain text body from email message payload"""
+    try:
+        return email_content.extract_text(payload)
     except Exception as e:
-        print(f"Error extracting email body: {e}")
+        log.error(f"Error extracting email body: {e}")
         return "Error extracting email content"
 
-def send_whatsapp_message(message_body, to_number):
-    """Send WhatsApp message via Twilio"""
+def get_whatsapp_sender():
+    """Get the shared WhatsApp sender for the configured Twilio account"""
+    twilio_sid = get_setting('twilio_sid')
+    twilio_token = get_setting('twilio_token')
+    twilio_whatsapp_number = get_setting('twilio_whatsapp_number')
+    
+    if not all([twilio_sid, twilio_token, twilio_whatsapp_number]):
+        raise Exception("Twilio credentials not configured")
+    
+    rate = float(get_setting('twilio_rate_per_second', whatsapp_sender.DEFAULT_RATE_PER_SECOND))
+    burst = get_setting('twilio_rate_burst')
+    workers = int(get_setting('twilio_send_workers', whatsapp_sender.DEFAULT_SEND_WORKERS))
+    
+    return whatsapp_sender.get_sender(
+        twilio_sid, twilio_token, twilio_whatsapp_number,
+        rate=rate, burst=float(burst) if burst else None, max_workers=workers,
+        status_callback=delivery_status.callback_url()
+    )
+
+def fetch_messages(service, message_ids, format='full', metadata_headers=None):
+    """Fetch messages using Gmail HTTP batch requests
+    
+    Returns a dict of message ID to message and a dict of message ID to the
+    exception raised for that message. With format='metadata' only the
+    headers in `metadata_headers` are returned.
+    """
+    params = {'format': format}
+    if metadata_headers:
+        params['metadataHeaders'] = metadata_headers
+    
+    messages = {}
+    failures = {}
+    
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            failures[request_id] = exception
+        else:
+            messages[request_id] = response
+    
+    for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        requests = []
+        for message_id in message_ids[start:start + GMAIL_BATCH_SIZE]:
+            requests.append(service.users().messages().get(userId='me', id=message_id, **params))
+            batch.add(requests[-1], request_id=message_id)
+        try:
+            with metrics.timed('gmail_request', method=f'messages.get.{format}'):
+                # Charged as one messages.get per message
+                gmail_client.execute_batch(batch, requests)
+        except Exception as e:
+            # The whole batch round-trip failed; report every message in it
+            for message_id in message_ids[start:start + GMAIL_BATCH_SIZE]:
+                if message_id not in messages:
+                    failures.setdefault(message_id, e)
+    
+    return messages, failures
+
+def is_deleted_message_error(error):
+    """A 404 means the message was deleted since it was listed; nothing left to forward"""
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+def mark_emails_as_read(service, message_ids):
+    """Mark emails as read with batchModify, returning failures by message ID"""
+    failures = {}
+    for start in range(0, len(message_ids), GMAIL_BATCH_MODIFY_SIZE):
+        chunk = message_ids[start:start + GMAIL_BATCH_MODIFY_SIZE]
+        try:
+            with metrics.timed('gmail_request', method='messages.batchModify'):
+                service.users().messages().batchModify(
+                    userId='me',
+                    body={'ids': chunk, 'removeLabelIds': ['UNREAD']}
+                ).execute()
+            log.info(f"Marked {len(chunk)} emails as read")
+        except Exception as e:
+            # batchModify is all-or-nothing; retry individually to find the culprits
+            log.warning(f"batchModify failed ({e}), marking emails individually")
+            for message_id in chunk:
+                try:
+                    with metrics.timed('gmail_request', method='messages.modify'):
+                        service.users().messages().modify(
+                            userId='me',
+                            id=message_id,
+                            body={'removeLabelIds': ['UNREAD']}
+                        ).execute()
+                except Exception as individual_error:
+                    failures[message_id] = individual_error
+    return failures
+
+@metrics.timed('filter_match')
+def find_filter_matches(fields, filters):
+    """Return the filter keywords found in each email field, e.g. {'subject': {'invoice'}}"""
+    compiled = matcher.compile_filters(filters)
+    hits = {}
+    for field, text in fields.items():
+        found = compiled.find(text)
+        if found:
+            hits[field] = found
+    return hits
+
+def get_header(headers, name, default=None):
+    return next((h['value'] for h in headers if h['name'].lower() == name.lower()), default)
+
+def reply_headers(headers):
+    """What a reply to this message needs to be threaded, recorded when it is forwarded"""
+    return {
+        'message_id': get_header(headers, 'Message-ID'),
+        'subject': get_header(headers, 'Subject', ''),
+        'sender': get_header(headers, 'Reply-To') or get_header(headers, 'From', ''),
+        'references': get_header(headers, 'References', ''),
+    }
+
+def screen_message(msg, filters, filter_fields):
+    """First pass over a metadata-only message
+    
+    Returns True when the headers already match, None when only the body can
+    decide (so the full message must be fetched) and False to drop it.
+    """
+    # Skip messages read since they were added (e.g. on a replayed cycle)
+    if 'UNREAD' not in msg.get('labelIds', []):
+        return False
+    
+    headers = msg['payload']['headers']
+    subject = get_header(headers, 'Subject', 'No Subject')
+    sender = get_header(headers, 'From', '')
+    
+    log.debug(f"Processing email: {subject}")
+    
+    header_fields = {'subject': subject, 'from': sender}
+    if find_filter_matches(
+        {field: header_fields[field] for field in filter_fields if field in header_fields},
+        filters
+    ):
+        return True
+    
+    if 'body' in filter_fields:
+        return None
+    
+    log.debug(f"Email does not match filters: {subject}")
+    return False
+
+def evaluate_message(msg, filters, filter_fields):
+    """Check a fully fetched message against the filters
+    
+    Returns (message_id, thread_id, subject, whatsapp_message, keywords,
+    attachment_parts, reply_headers) for an unread matching message,
+    otherwise None.
+    """
+    # Skip messages read since they were added (e.g. on a replayed cycle)
+    if 'UNREAD' not in msg.get('labelIds', []):
+        return None
+    
+    # Extract headers
+    headers = msg['payload']['headers']
+    subject = get_header(headers, 'Subject', 'No Subject')
+    sender = get_header(headers, 'From', '')
+    thread_id = msg['threadId']
+    
+    # Check the configured header fields in one pass each
+    header_fields = {'subject': subject, 'from': sender}
+    hits = find_filter_matches(
+        {field: header_fields[field] for field in filter_fields if field in header_fields},
+        filters
+    )
+    
+    email_body = None
+    if not hits and 'body' in filter_fields:
+        email_body = extract_email_body(msg['payload'])
+        hits = find_filter_matches({'body': email_body}, filters)
+    
+    if not hits:
+        log.debug(f"Email does not match filters: {subject}")
+        return None
+    
+    matched = ', '.join(f"{field}: {', '.join(sorted(words))}" for field, words in hits.items())
+    log.info(f"Email matches filters: {subject} ({matched})")
+    metrics.inc('emails_matched_total')
+    
+    # Extract email body
+    if email_body is None:
+        email_body = extract_email_body(msg['payload'])
+    
+    # Create WhatsApp message with subject
+    whatsapp_message = f"Subject: {subject}\n\n{email_body}"
+    keywords = set().union(*hits.values())
+    return (msg['id'], thread_id, subject, whatsapp_message, keywords,
+            email_content.attachment_parts(msg['payload']), reply_headers(headers))
+
+def skip_evaluated(account, message_ids, filters, filter_fields):
+    """Drop messages the ledger shows cannot match the current filters, and dead-lettered ones"""
+    remaining = ledger.unevaluated(account.id, message_ids, filters, filter_fields)
+    skipped = len(message_ids) - len(remaining)
+    if skipped:
+        metrics.inc('emails_skipped_total', skipped)
+        log.info(f"Skipped {skipped} messages already checked against the current filters")
+    
+    dead = ledger.dead_letters(account.id)
+    if dead:
+        remaining = [message_id for message_id in remaining if message_id not in dead]
+    return remaining
+
+def queue_matches(matches, target_whatsapp_number, account=None):
+    """Add matches to the outbound queue, returning the message IDs that are safe to mark read"""
+    account = account or accounts.default_account()
+    snapshot = config.get_snapshot()
+    digest_window = snapshot.get_float('digest_window_seconds', 0)
+    # Twilio can only fetch attachments when the web app is reachable from the internet
+    forward_attachments = bool(snapshot.get('public_base_url'))
+    queued_ids = []
+    for message_id, thread_id, subject, whatsapp_message, keywords, attachments, headers in matches:
+        numbers = routing.recipients(account.id, keywords, target_whatsapp_number, snapshot)
+        if not numbers:
+            log.warning(f"No recipient routed for email: {subject}")
+            continue
+        media = []
+        if forward_attachments:
+            for part in attachments:
+                attachment = media_cache.store_attachment(account.credentials_path, message_id, part, snapshot)
+                if attachment:
+                    media.append(attachment)
+        for to_number in numbers:
+            if job_queue.enqueue(account.id, message_id, thread_id, to_number, whatsapp_message,
+                                 digest_window, media, headers):
+                log.info(f"Queued email for WhatsApp delivery to {to_number}: {subject}")
+            else:
+                log.info(f"Email already queued for {to_number}: {subject}")
+        queued_ids.append(message_id)
+    return queued_ids
+
+def deliver_batch(sender, batch, recipient_cap):
+    """Send a batch's remaining segments in order
+    
+    Returns the SID of the last segment, or None if the recipient cap was
+    reached and the rest of the batch was deferred.
+    """
+    parts = job_queue.segments(batch)
+    sid = None
+    for index in range(batch['parts_sent'], len(parts)):
+        if recipient_cap:
+            sent, oldest = job_queue.recipient_sends(batch['to_number'])
+            if sent >= recipient_cap:
+                resume_at = oldest + job_queue.RECIPIENT_CAP_WINDOW_SECONDS
+                job_queue.defer(batch, resume_at)
+                log.warning(f"Recipient cap reached for {batch['to_number']}, deferring "
+                      f"{len(parts) - index} message(s) until {datetime.fromtimestamp(resume_at)}")
+                return None
+        
+        body, attachment = parts[index]
+        # A file gone from the cache is still announced by its "📎 filename" line, just without the media
+        media_url = media_cache.signed_url(attachment) if attachment else None
+        sid = sender.send(body, batch['to_number'], media_url)
+        job_queue.mark_part_sent(batch, index + 1, sid)
+        metrics.inc('whatsapp_messages_sent_total')
+    
+    job_queue.mark_sent(batch)
+    return sid
+
+def deliver_recipient_batches(sender, batches, recipient_cap, max_attempts):
+    """Deliver one recipient's batches one after another so their segments stay in order"""
+    for position, batch in enumerate(batches):
+        try:
+            sid = deliver_batch(sender, batch, recipient_cap)
+        except Exception as e:
+            status = job_queue.mark_failed(batch, e, max_attempts)
+            metrics.inc('whatsapp_send_failures_total', status=status)
+            log.error(f"Failed to send WhatsApp message for {len(batch['jobs'])} email(s) ({status}): {e}")
+            continue
+        
+        if sid is None:
+            # Deferred by the cap; later batches for this recipient would be too
+            for later in batches[position + 1:]:
+                job_queue.defer(later, time.time())
+            return
+        
+        for job in batch['jobs']:
+            # Store conversation mapping
+            store_conversation_mapping(job['thread_id'], job['to_number'], job['account_id'],
+                                       json.loads(job['headers']) if job['headers'] else None)
+        log.info(f"WhatsApp message sent: {sid} ({len(batch['jobs'])} email(s))")
+
+def deliver_pending_jobs():
+    """Send due jobs from the outbound queue as per-recipient digests, recording each outcome"""
     try:
-        twilio_sid = get_setting('twilio_sid')
-        twilio_token = get_setting('twilio_token')
-        twilio_whatsapp_number = get_setting('twilio_whatsapp_number')
+        sender = get_whatsapp_sender()
         
-        if not all([twilio_sid, twilio_token, twilio_whatsapp_number]):
-            raise Exception("Twilio credentials not configured")
+        # Settle batches a crashed process left mid-send before anything is retried
+        recovered = job_queue.recover_stale(sender.find_sent_message)
+        if recovered:
+            log.warning(f"Recovered {recovered} interrupted WhatsApp deliveries")
         
-        client = Client(twilio_sid, twilio_token)
+        snapshot = config.get_snapshot()
+        max_attempts = snapshot.get_int('job_max_attempts', job_queue.DEFAULT_MAX_ATTEMPTS)
+        recipient_cap = snapshot.get_int('recipient_max_messages_per_hour', 0)
         
-        message = client.messages.create(
-            from_=f'whatsapp:{twilio_whatsapp_number}',
-            body=message_body,
-            to=f'whatsapp:{to_number}'
-        )
+        by_recipient = {}
+        for batch in job_queue.claim_due(JOB_CLAIM_LIMIT):
+            by_recipient.setdefault(batch['to_number'], []).append(batch)
         
-        print(f"WhatsApp message sent: {message.sid}")
-        return True
+        futures = [
+            sender.submit_task(deliver_recipient_batches, sender, batches, recipient_cap, max_attempts)
+            for batches in by_recipient.values()
+        ]
+        for future in as_completed(futures):
+            future.result()
+        
+        job_queue.purge_sent()
         
     except Exception as e:
-        print(f"Error sending WhatsApp message: {e}")
-        return False
+        log.error(f"Error delivering WhatsApp messages: {e}")
+
+def build_reply(message_body, headers=None):
+    """MIME reply to the forwarded email described by `headers` (see reply_headers())"""
+    reply = EmailMessage()
+    if headers:
+        subject = headers.get('subject') or ''
+        reply['Subject'] = subject if subject.lower().startswith('re:') else f'Re: {subject}'.rstrip()
+        if headers.get('sender'):
+            reply['To'] = headers['sender']
+        reply['In-Reply-To'] = headers['message_id']
+        reply['References'] = ' '.join(filter(None, [headers.get('references'), headers['message_id']]))
+    else:
+        reply['Subject'] = FALLBACK_REPLY_SUBJECT
+    reply.set_content(message_body)
+    return reply
 
-def mark_email_as_read(service, message_id):
-    """Mark email as read in Gmail"""
+def send_gmail_reply(service, thread_id, message_body, headers=None):
+    """Send a reply to a Gmail thread; returns the sent message ID"""
+    message = {
+        'threadId': thread_id,
+        'raw': base64.urlsafe_b64encode(build_reply(message_body, headers).as_bytes()).decode('utf-8')
+    }
+    
+    with metrics.timed('gmail_request', method='messages.send'):
+        return service.users().messages().send(userId='me', body=message).execute()['id']
+
+def send_reply_status(reply, text):
+    """Best-effort WhatsApp follow-up telling the sender what happened to their reply"""
     try:
-        service.users().messages().modify(
-            userId='me',
-            id=message_id,
-            body={'removeLabelIds': ['UNREAD']}
-        ).execute()
-        print(f"Marked email {message_id} as read")
+        get_whatsapp_sender().send(text, reply['from_number'])
     except Exception as e:
-        print(f"Error marking email as read: {e}")
-
-def check_email_filters(subject, filters):
-    """Check if email subject matches any filter keywords"""
-    subject_lower = subject.lower()
-    for keyword in filters:
-        if keyword.lower() in subject_lower:
-            return True
-    return False
+        log.error(f"Error sending reply status to {reply['from_number']}: {e}")
 
-def process_emails():
-    """Main function to process unread emails"""
+def deliver_pending_replies():
+    """Send queued WhatsApp replies to Gmail and report the outcome back over WhatsApp"""
     try:
-        # Get configuration
-        target_whatsapp_number = get_setting('target_whatsapp_number')
-        filters = get_filters()
-        
-        if not target_whatsapp_number:
-            print("Target WhatsApp number not configured")
-            return
+        released = reply_outbox.release_stale()
+        if released:
+            log.warning(f"Released {released} interrupted Gmail replies for retry")
         
-        if not filters:
-            print("No filter keywords configured")
+        replies = reply_outbox.claim_due(REPLY_CLAIM_LIMIT)
+        if not replies:
             return
         
-        # Get Gmail service
-        service = get_gmail_service()
+        max_attempts = config.get_snapshot().get_int('reply_max_attempts', reply_outbox.DEFAULT_MAX_ATTEMPTS)
         
-        # Get unread messages
-        results = service.users().messages().list(
-            userId='me',
-            labelIds=['UNREAD'],
-            maxResults=10
-        ).execute()
-        
-        messages = results.get('messages', [])
-        
-        if not messages:
-            print("No unread messages found")
-            return
-        
-        print(f"Found {len(messages)} unread messages")
-        
-        for message in messages:
+        for reply in replies:
             try:
-                # Get full message details
-                msg = service.users().messages().get(
-                    userId='me',
-                    id=message['id'],
-                    format='full'
-                ).execute()
-                
-                # Extract headers
-                headers = msg['payload']['headers']
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                thread_id = msg['threadId']
-                
-                print(f"Processing email: {subject}")
-                
-                # Check if subject matches filters
-                if check_email_filters(subject, filters):
-                    print(f"Email matches filters: {subject}")
-                    
-                    # Extract email body
-                    email_body = extract_email_body(msg['payload'])
-                    
-                    # Create WhatsApp message with subject
-                    whatsapp_message = f"Subject: {subject}\n\n{email_body}"
-                    
-                    # Send to WhatsApp
-                    if send_whatsapp_message(whatsapp_message, target_whatsapp_number):
-                        # Store conversation mapping
-                        store_conversation_mapping(thread_id, target_whatsapp_number)
-                        
-                        # Mark email as read
-                        mark_email_as_read(service, message['id'])
-                        
-                        print(f"Successfully forwarded email: {subject}")
-                    else:
-                        print(f"Failed to send WhatsApp message for: {subject}")
-                else:
-                    print(f"Email does not match filters: {subject}")
-                    
+                account = accounts.get_account(reply['account_id'])
+                if account is None:
+                    raise Exception(f"Account {reply['account_id']} is no longer configured")
+                # Recorded when the email was forwarded; no Gmail read needed to thread the reply
+                headers = conversations.thread_headers(reply['account_id'], reply['thread_id'])
+                service = get_gmail_service(account)
+                # Replies go ahead of ingestion and are still sent while its Gmail breaker is open
+                with gmail_client.priority():
+                    gmail_message_id = send_gmail_reply(service, reply['thread_id'], reply['body'], headers)
             except Exception as e:
-                print(f"Error processing message {message['id']}: {e}")
+                status = reply_outbox.mark_failed(reply, e, max_attempts)
+                log.error(f"Error sending Gmail reply {reply['message_sid']} ({status}): {e}")
+                if status == reply_outbox.DEAD:
+                    send_reply_status(reply, REPLY_FAILED_STATUS)
                 continue
-                
+            
+            reply_outbox.mark_sent(reply['message_sid'], gmail_message_id)
+            metrics.inc('gmail_replies_sent_total')
+            log.info(f"Gmail reply sent for thread {reply['thread_id']}")
+            send_reply_status(reply, REPLY_SENT_STATUS)
+        
+        reply_outbox.purge_sent()
+        
     except Exception as e:
-        print(f"Error in process_emails: {e}")
+        log.error(f"Error delivering Gmail replies: {e}")
 
 def main():
     """Main worker loop"""
-    print("Starting Gmail-to-WhatsApp worker...")
+    logs.configure()
+    log.info("Starting Gmail-to-WhatsApp worker...")
     
-    while True:
-        try:
-            process_emails()
-        except Exception as e:
-            print(f"Error in main loop: {e}")
-        
-        # Wait 60 seconds before next check
-        print("Waiting 60 seconds before next check...")
-        time.sleep(60)
+    # Imported here because the worker processes drive the stage functions in this module
+    import supervisor
+    supervisor.run()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file